@@ -0,0 +1,97 @@
+import sys, time, random, tracemalloc
+import lib.libitg as libitg
+from lib.libitg import Nonterminal
+from misc.helper import load_lexicon, log_info, parse_source, parse_target
+
+# Arguments.
+if len(sys.argv) < 2:
+    print("Use: python benchmark_parsers.py <lexicon> [nb_sentences]")
+    sys.exit()
+
+lexicon = load_lexicon(sys.argv[1], top_n=5)
+nb_sentences = 3 if len(sys.argv) < 3 else int(sys.argv[2])
+lengths = [5, 10, 15, 20, 25, 30]
+bitext_lengths = [3, 5, 7, 9]  # D(x,y) grows much faster with the length
+
+# Random sentences over the source vocabulary (every word has a translation, thus every sentence has a parse).
+rng = random.Random(0)
+vocabulary = sorted(word for word in lexicon if word != "-EPS-")
+
+# Speedups are measured against "earley-plain": Item objects on the uncompiled, uncached CFG of
+# make_source_side_finite_itg. "earley" (compiled grammars, see source_grammar) is reported alongside.
+parsers = ["earley-plain", "earley", "cky"]
+
+log_info("Comparing earley and cky on %d sentences per length..." % nb_sentences)
+print("length\tedges\tearley-plain (s)\tearley (s)\tcky (s)\tspeedup")
+for length in lengths:
+    sentences = [" ".join(rng.choice(vocabulary) for _ in range(length)) for _ in range(nb_sentences)]
+    timings = {}
+    forests = {}
+    for parser in parsers:
+        start = time.time()
+        forests[parser] = [parse_source(sentence, lexicon, parser) for sentence in sentences]
+        timings[parser] = (time.time() - start) / nb_sentences
+    # all parsers must yield the same forests
+    for parser in parsers[:-1]:
+        for earley_forest, cky_forest in zip(forests[parser], forests["cky"]):
+            assert set(earley_forest) == set(cky_forest), "The parsers disagree"
+    nb_edges = sum(len(forest) for forest in forests["cky"]) / nb_sentences
+    print("%d\t%d\t%.3f\t%.3f\t%.3f\t%.1fx" % (length, nb_edges, timings["earley-plain"], timings["earley"],
+                                             timings["cky"], timings["earley-plain"] / timings["cky"]))
+
+# Targets translate every source word (monotone, possibly into -EPS-), thus every pair has a parse.
+log_info("Comparing earley and cky for D(x,y) on %d sentence pairs per length..." % nb_sentences)
+print("length\tedges\tearley-plain (s)\tearley (s)\tcky (s)\tspeedup")
+for length in bitext_lengths:
+    sources = [[rng.choice(vocabulary) for _ in range(length)] for _ in range(nb_sentences)]
+    pairs = [(" ".join(source), " ".join(y for y in (rng.choice(sorted(lexicon[x])) for x in source) if y != "-EPS-"))
+             for source in sources]
+    Dxs = [parse_source(chinese, lexicon, "cky") for chinese, _ in pairs]
+    timings = {}
+    forests = {}
+    for parser in parsers:
+        start = time.time()
+        forests[parser] = [parse_target(Dx, chinese, english, lexicon, parser)
+                           for Dx, (chinese, english) in zip(Dxs, pairs)]
+        timings[parser] = (time.time() - start) / nb_sentences
+    for parser in parsers[:-1]:
+        for earley_forest, cky_forest in zip(forests[parser], forests["cky"]):
+            assert set(earley_forest) == set(cky_forest), "The parsers disagree"
+    nb_edges = sum(len(forest) for forest in forests["cky"]) / nb_sentences
+    print("%d\t%d\t%.3f\t%.3f\t%.3f\t%.1fx" % (length, nb_edges, timings["earley-plain"], timings["earley"],
+                                             timings["cky"], timings["earley-plain"] / timings["cky"]))
+
+# Earley with interned Item objects against the compact mode (items packed into ints), on the D(x,y) pass.
+# The baseline is the number of Item objects the parse creates, as counted by Item.nb_instances() (see earley).
+def run_earley(Dx, english, compact, stats=None):
+    fsa = libitg.make_fsa(english)
+    return libitg.earley(Dx, fsa, start_symbol=Nonterminal("D(x)"), sprime_symbol=Nonterminal("D(x,y)"),
+                         compact=compact, stats=stats)
+
+log_info("Comparing Item objects and compact items in Earley for D(x,y)...")
+print("length\tItem.nb_instances()\tcompact items\tearley (s)\tcompact (s)\tspeedup\t"
+      "earley peak (MB)\tcompact peak (MB)")
+for length in bitext_lengths:
+    source = [rng.choice(vocabulary) for _ in range(length)]
+    chinese = " ".join(source)
+    english = " ".join(y for y in (rng.choice(sorted(lexicon[x])) for x in source) if y != "-EPS-")
+    Dx = parse_source(chinese, lexicon, "cky")
+    stats = {}
+    timings = {}
+    peaks = {}
+    forests = {}
+    for compact in [False, True]:
+        stats[compact] = {}
+        start = time.time()
+        forests[compact] = run_earley(Dx, english, compact, stats[compact])
+        timings[compact] = time.time() - start
+        # memory is measured in a second run, tracing allocations slows the parser down
+        tracemalloc.start()
+        run_earley(Dx, english, compact)
+        peaks[compact] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    assert set(forests[False]) == set(forests[True]), "The parsers disagree"
+    # compact items are plain ints, and the compiled grammar filters predictions by left corner
+    print("%d\t%d\t%d\t%.3f\t%.3f\t%.1fx\t%.1f\t%.1f" % (length, stats[False]["items"], stats[True]["items"],
+                                                        timings[False], timings[True],
+                                                        timings[False] / timings[True], peaks[False], peaks[True]))
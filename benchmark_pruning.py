@@ -0,0 +1,52 @@
+import sys, time, itertools
+from misc.helper import load_lexicon, load_ibm1_probs, scan_line, log_info, parse_training_instance
+from misc.itg_parser import Pruning
+
+# Arguments.
+if len(sys.argv) < 4:
+    print("Use: python benchmark_pruning.py <training_data> <lexicon> <ibm1_probs> [nb_sentences]")
+    sys.exit()
+
+top_n = 50  # large lexicons are where forests blow up
+max_length = 15  # in words
+nb_sentences = 100 if len(sys.argv) < 5 else int(sys.argv[4])
+
+lexicon = load_lexicon(sys.argv[2], top_n=top_n)
+ibm1_probs = load_ibm1_probs(sys.argv[3])
+with open(sys.argv[1]) as f:
+    pairs = [scan_line(line) for line in f]
+pairs = list(itertools.islice((pair for pair in pairs if len(pair[0].split()) <= max_length), nb_sentences))
+
+# The first setting is exact, the coverage loss of the others is measured against it.
+# max_complete is only supported by earley, the other settings use the (faster) cky parsers.
+settings = [Pruning(),
+            Pruning(max_inversion_width=5),
+            Pruning(max_inversion_width=3),
+            Pruning(beam=50, ibm1_probs=ibm1_probs),
+            Pruning(beam=20, ibm1_probs=ibm1_probs),
+            Pruning(max_inversion_width=3, beam=20, ibm1_probs=ibm1_probs),
+            Pruning(max_complete=20),
+            Pruning(max_complete=5)]
+
+log_info("Parsing %d sentence pairs (top_n=%d, at most %d words) per pruning setting..." %
+         (len(pairs), top_n, max_length))
+print("setting\tparser\tcoverage\tloss\tDx edges\tDxy edges\ttime (s)")
+exact = None
+for pruning in settings:
+    parser = "earley" if pruning.max_complete is not None else "cky"
+    covered = []
+    nb_edges_x = nb_edges_xy = 0
+    start = time.time()
+    for chinese, english in pairs:
+        Dx, Dxy = parse_training_instance(chinese, english, lexicon, parser, pruning)
+        covered.append(len(Dxy) > 0)
+        nb_edges_x += len(Dx)
+        nb_edges_xy += len(Dxy)
+    elapsed = (time.time() - start) / max(len(pairs), 1)
+    if exact is None:
+        exact = covered
+    # pairs parsed exactly but not with pruning (pruned forests are subsets of the exact ones)
+    loss = sum(e and not c for e, c in zip(exact, covered))
+    print("%r\t%s\t%d/%d\t%d\t%.1f\t%.1f\t%.3f" % (pruning, parser, sum(covered), len(pairs), loss,
+                                                  nb_edges_x / max(len(pairs), 1), nb_edges_xy / max(len(pairs), 1),
+                                                  elapsed))
@@ -8,107 +8,122 @@ from collections import defaultdict
 from .formal import Symbol, CFG, FSA
 
 
-def iter_useful_edges(forest: CFG, root: Symbol) -> CFG:
+def useful_edge_mask(nb_nodes: int, heads, tail_offsets, tails, root: int, is_terminal, edge_mask=None) -> list:
     """
-    This algorithm performs a recursive cleanup of the forest by deleting edges which will surely have 0 probability
-    without actually computing probabilities.
-    
-    We do so by running inside-outside algorithm in the boolean semiring, 
-    this tells us whether nodes are relevant to the forest (because it tells us whether some complete derivation
-    goes through that node). 
+    Boolean inside-outside over integer-indexed nodes, this tells us which edges take part in some complete derivation
+    without computing probabilities.
+
+    Both passes use worklists, thus they run in time linear in the size of the forest, need no recursion and work
+    even with cyclic forests:
+        * inside: a node is derivable if it is a terminal or if all children of one of its edges are derivable
+          (each edge counts the children it still misses, a derivable node is processed once)
+        * outside: from the root down, a derivable edge makes its children reachable
+
+    :param nb_nodes: nodes are 0..nb_nodes-1
+    :param heads: head node of each edge
+    :param tail_offsets: the tails of edge e are tails[tail_offsets[e]:tail_offsets[e+1]]
+    :param tails: tail nodes of all edges
+    :param root: node that represents the root of the forest
+    :param is_terminal: whether each node is a terminal
+    :param edge_mask: if given, only edges set in this mask are considered
+    :returns: a list with a boolean per edge
+    """
+    heads = list(heads)
+    tail_offsets = list(tail_offsets)
+    tails = list(tails)
+    nb_edges = len(heads)
+    # occurrences of nodes as tails, edges by head, and the number of children each edge misses
+    occurrences = [[] for _ in range(nb_nodes)]
+    edges_by_head = [[] for _ in range(nb_nodes)]
+    missing = [0] * nb_edges
+    derivable = [bool(flag) for flag in is_terminal]
+    agenda = [v for v in range(nb_nodes) if derivable[v]]
+    for e, head, first, last in zip(range(nb_edges), heads, tail_offsets, tail_offsets[1:]):
+        if edge_mask is not None and not edge_mask[e]:
+            continue
+        edges_by_head[head].append(e)
+        missing[e] = last - first
+        if first == last and not derivable[head]:  # edges without children
+            derivable[head] = True
+            agenda.append(head)
+        for t in tails[first:last]:
+            occurrences[t].append(e)
+
+    # inside
+    while agenda:
+        for e in occurrences[agenda.pop()]:
+            missing[e] -= 1
+            if missing[e] == 0:
+                head = heads[e]
+                if not derivable[head]:
+                    derivable[head] = True
+                    agenda.append(head)
+
+    # outside
+    useful = [False] * nb_edges
+    if 0 <= root < nb_nodes and derivable[root]:
+        reachable = [False] * nb_nodes
+        reachable[root] = True
+        agenda = [root]
+        while agenda:
+            for e in edges_by_head[agenda.pop()]:
+                if missing[e] == 0:
+                    useful[e] = True
+                    for t in tails[tail_offsets[e]:tail_offsets[e + 1]]:
+                        if not reachable[t]:
+                            reachable[t] = True
+                            agenda.append(t)
+    return useful
 
-    This is a **recursive** that does not require top-sorting and works even with cyclic forests.
-    The reason why this works with cyclic forests is that in the boolean semiring there's a neat solution to avoid infinite loops
-    (check below).
+
+def iter_useful_edges(forest: CFG, root: Symbol) -> CFG:
+    """
+    This algorithm performs a cleanup of the forest by deleting edges which will surely have 0 probability
+    without actually computing probabilities (see useful_edge_mask), it works even with cyclic forests.
 
     :param forest: a cyclic or acyclic forest
     :param root: Nonterminal/Span that represents the root of the forest
     :returns: a generator of useful edges
-
-    :author: Wilker Aziz
     """
-    value = defaultdict(int)  # maps from nodes to boolean value
-    fwd_star = defaultdict(set)
-    rev_value = defaultdict(int)
-        
-    for edge in forest:
-        for child in edge.rhs:
-            fwd_star[child].add(edge)
+    rules = list(forest)
+    for rule, useful in zip(rules, _edge_mask(rules, root)):
+        if useful:
+            yield rule
+
+
+def _edge_mask(rules: list, root: Symbol) -> list:
+    """Integer-indexes the nodes of a list of rules and returns their useful_edge_mask"""
+    # symbols are interned (equality is identity), thus ids are cheaper keys than the symbols themselves
+    ids = {}
+    symbols = []
+    heads = []
+    tail_offsets = [0]
+    tails = []
+    for rule in rules:
+        head = ids.get(id(rule.lhs), None)
+        if head is None:
+            head = ids[id(rule.lhs)] = len(symbols)
+            symbols.append(rule.lhs)
+        heads.append(head)
+        for symbol in rule.rhs:
+            v = ids.get(id(symbol), None)
+            if v is None:
+                v = ids[id(symbol)] = len(symbols)
+                symbols.append(symbol)
+            tails.append(v)
+        tail_offsets.append(len(tails))
+    return useful_edge_mask(len(symbols), heads, tail_offsets, tails, ids.get(id(root), -1),
+                            [symbol.is_terminal() for symbol in symbols])
+
+
+def cleanup_forest(forest: CFG, root: Symbol, return_mask=False):
+    """
+    This wraps iter_useful_edges and return a clean CFG where every edge is useful
     
-    def get_boolean_value(node):  
-        # first we check whether we have a color for this node
-        color = value.get(node, None)        
-        if color is None:  # here we don't
-            value[node] = -1  # but we mark the node so we know are visiting it
-        elif color == -1:  # we are visiting this node
-            return True  # so we just assume things went well
-        else:  # here we have color 1 (which implies True) or color 0 (which implies False)
-            return color == 1
-        
-        # here we need to compute the node's color
-        bs = forest.get(node)
-        if not bs:  # no incoming edges
-            flag = node.is_terminal()  # then color depends on type of symbol, if Terminal, color is 1 (as in True)
-            color = 1 if node.is_terminal() else 0
-        else:
-            # there are incoming edges, we check whether there are valid paths below the node
-            n = 0
-            for edge in bs:  # for each incoming edge
-                for child in edge.rhs:  # for each child node
-                    if get_boolean_value(child):  # flag = flag or get_boolean_value(child)
-                        n += 1
-            color = 1 if n > 0 else 0
-        value[node] = color
-        return color == 1
-
-    def get_boolean_rev_value(node):
-        color = rev_value.get(node, None)
-        if color is None:  # here we don't
-            rev_value[node] = -1  # but we mark the node so we know are visiting it
-        elif color == -1:  # we are visiting this node
-            return True  # so we just assume things went well
-        else:  # here we have color 1 (which implies True) or color 0 (which implies False)
-            return color == 1
-
-        fs = fwd_star.get(node, {})
-        
-        if not fs:  # no outgoing edge
-            color = 1 if node == root else 0  # this must be the root to get 1
-        else:
-            n = 0
-            for edge in fs:
-                edge_rev = get_boolean_rev_value(edge.lhs)
-                edge_value = True
-                for sibling in edge.rhs:
-                    if sibling != node:
-                        if value.get(sibling, 0) != 1:
-                            edge_value = False
-                            break
-                if edge_rev and edge_value:
-                    n += 1
-            color = 1 if n > 0 else 0
-        rev_value[node] = color
-        return color == 1
-
-    get_boolean_value(root)
-    for node, color in value.items():
-        if node.is_terminal() and color == 1 and node not in rev_value:
-            get_boolean_rev_value(node)
-
-    for edge in forest:
-        if value[edge.lhs] != 1 or rev_value[edge.lhs] != 1:
-            continue
-        selected = True
-        for child in edge.rhs:
-            if value[child] != 1 or rev_value[child] != 1:
-                selected = False
-                break
-        if selected:
-            yield edge
-
-
-def cleanup_forest(forest: CFG, root: Symbol) -> CFG:
-    """This wraps iter_useful_edges and return a clean CFG where every edge is useful"""
+    :param return_mask: if True, returns instead a list with a boolean per rule of the forest (in iteration order) 
+    """
+    if return_mask:
+        return _edge_mask(list(forest), root)
     return CFG(iter_useful_edges(forest, root))
 
 
@@ -0,0 +1,195 @@
+"""
+Here I implement a compact mode of the Earley intersection in earley.py.
+
+Items are python ints packing (rule id, number of dots, dots), thus they are neither interned nor weakly referenced,
+and the agenda indexes are dictionaries keyed by ints. The grammar is read through its integer tables (see
+compiled_grammar.py), which may be compiled once and reused across FSAs.
+The intersected forest is exactly the one built by earley.earley.
+"""
+
+from collections import deque
+from .formal import Symbol, Terminal, Span
+from .formal import Rule, CFG, FSA
+from .alg import cleanup_forest
+from .compiled_grammar import CompiledGrammar
+
+
+class ItemCodec:
+    """
+    Packs an item [X -> alpha * beta, [q0, ..., qk]] into an int
+
+        ((rule id * W + number of dots) * B^M) + sum_t q_t * B^t
+
+    where B is the number of FSA states, M the maximum number of dots and W = M + 1.
+    """
+
+    __slots__ = ['base', 'width', 'block', 'powers']
+
+    def __init__(self, nb_states: int, max_arity: int):
+        self.base = max(nb_states, 1)
+        self.width = max_arity + 2
+        self.powers = [self.base ** t for t in range(max_arity + 2)]
+        self.block = self.powers[-1]
+
+    def axiom(self, rule_id: int, state: int) -> int:
+        return (rule_id * self.width + 1) * self.block + state
+
+    def rule(self, item: int) -> int:
+        return item // (self.width * self.block)
+
+    def nb_dots(self, item: int) -> int:
+        return (item // self.block) % self.width
+
+    def state(self, item: int, t: int) -> int:
+        """The state associated with the t-th dot"""
+        return (item // self.powers[t]) % self.base
+
+    def dot(self, item: int) -> int:
+        return self.state(item, self.nb_dots(item) - 1)
+
+    def start(self, item: int) -> int:
+        return item % self.base
+
+    def advance(self, item: int, state: int) -> int:
+        return item + self.block + state * self.powers[self.nb_dots(item)]
+
+
+def compact_earley(cfg: CFG, fsa: FSA, start_symbol: Symbol, sprime_symbol=None, eps_symbol=Terminal('-EPS-'),
+                   clean=True, stats=None, max_complete=None, prune=None):
+    """
+    Earley intersection between a CFG and an FSA (same arguments and result as earley.earley).
+
+    :param cfg: a CFG or a CompiledGrammar (compiled with the same eps_symbol)
+
+    Pruning (the result is then a subset of the exact intersection):
+    :param max_complete: if set, at most this many end states are kept for each (lhs, start), the first ones found
+        (complete items that end in a kept state are all kept)
+    :param prune: if set, a function (lhs: Symbol, start: int, end: int) -> bool, complete items for which it returns
+        True are discarded
+    :param stats: if a dict is given, it receives the number of items created ('items') and of complete items
+        discarded by pruning ('pruned')
+    :returns: a CFG object representing the intersection between the cfg and the fsa
+    """
+    # integer view of the grammar: symbol ids, and rules as (lhs id, tuple of rhs ids)
+    grammar = cfg if isinstance(cfg, CompiledGrammar) else CompiledGrammar(cfg, eps_symbol)
+    rules = grammar.rules
+    symbols = grammar.symbols
+    rule_lhs = grammar.rule_lhs
+    rule_rhs = grammar.rule_rhs
+    rules_by_lhs = grammar.rules_by_lhs
+    is_terminal = grammar.is_terminal
+    is_eps = grammar.is_eps
+    # terminal id -> origin -> destinations, and the labels leaving each state (to filter predictions)
+    arcs = grammar.arcs(fsa)
+    out_labels = [set() for _ in range(fsa.nb_states())]
+    for sid, origins in enumerate(arcs):
+        if origins is not None:
+            for q in origins:
+                out_labels[q].add(grammar.labels[sid])
+    predictable = grammar.predictable
+
+    codec = ItemCodec(fsa.nb_states(), grammar.max_arity)
+    B = codec.base
+    item_rule = codec.rule
+    nb_dots = codec.nb_dots
+    advance = codec.advance
+
+    # agenda: a stack of active items, the items seen so far, incomplete items by (next symbol, dot) and
+    # complete items by (lhs, start) then end
+    active = []
+    seen = set()
+    waiting = {}
+    complete = {}
+    predicted = set()
+    nb_pruned = 0
+
+    def push(item):
+        if item not in seen:
+            active.append(item)
+            seen.add(item)
+
+    start_id = grammar.symbol_id(start_symbol)
+    if start_id is not None:
+        for q0 in fsa.iterinitial():
+            for rid in rules_by_lhs[start_id]:
+                push(codec.axiom(rid, q0))
+
+    while active:
+        item = active.pop()
+        rid = item_rule(item)
+        rhs = rule_rhs[rid]
+        n = nb_dots(item)
+        dot = codec.state(item, n - 1)
+        if n == len(rhs) + 1:  # complete: advance the items waiting for lhs from start
+            start = codec.start(item)
+            context = rule_lhs[rid] * B + start
+            ends = complete.setdefault(context, {})
+            # max_complete caps the distinct end states of (lhs, start), not the complete items
+            if dot not in ends and ((max_complete is not None and len(ends) >= max_complete) or
+                                    (prune is not None and prune(rules[rid].lhs, start, dot))):
+                nb_pruned += 1
+                continue
+            for incomplete in waiting.get(context, ()):
+                push(advance(incomplete, dot))
+            ends.setdefault(dot, []).append(item)
+            continue
+        next_symbol = rhs[n - 1]
+        if is_terminal[next_symbol]:  # scan
+            if is_eps[next_symbol]:
+                push(advance(item, dot))
+            elif arcs[next_symbol] is not None:
+                for destination in arcs[next_symbol].get(dot, ()):
+                    push(advance(item, destination))
+        else:
+            context = next_symbol * B + dot
+            if context not in predicted:  # predict (rules that cannot start in this state are filtered)
+                for r in rules_by_lhs[next_symbol]:
+                    if predictable(r, out_labels[dot]):
+                        push(codec.axiom(r, dot))
+                predicted.add(context)
+            else:  # complete with what is known already
+                for destination in complete.get(context, {}).keys():
+                    push(advance(item, destination))
+        waiting.setdefault(next_symbol * B + dot, []).append(item)
+
+    if stats is not None:
+        stats['items'] = len(seen)
+        stats['pruned'] = nb_pruned
+
+    def iter_intersected_rules():
+        """Top-down conversion of complete items into CFG rules (as in earley.earley)"""
+        to_do = deque()
+        discovered_set = set()
+        top_symbols = []
+        if start_id is not None:
+            for q0 in fsa.iterinitial():
+                to_do.append(start_id * B + q0)
+                discovered_set.add(start_id * B + q0)
+        while to_do:
+            context = to_do.popleft()
+            for end, items in complete.get(context, {}).items():
+                for item in items:
+                    rid = item_rule(item)
+                    start = codec.start(item)
+                    lhs = Span(rules[rid].lhs, start, end)
+                    if rule_lhs[rid] == start_id:
+                        if not (fsa.is_initial(start) and fsa.is_final(end)):
+                            continue
+                        top_symbols.append(lhs)
+                    rhs = []
+                    for t, sid in enumerate(rule_rhs[rid]):
+                        origin = codec.state(item, t)
+                        child_context = sid * B + origin
+                        if not is_terminal[sid] and child_context not in discovered_set:
+                            to_do.append(child_context)
+                            discovered_set.add(child_context)
+                        rhs.append(Span(symbols[sid], origin, codec.state(item, t + 1)))
+                    yield Rule(lhs, rhs)
+        if sprime_symbol:
+            for lhs in top_symbols:
+                yield Rule(sprime_symbol, [lhs])
+
+    out_forest = CFG(iter_intersected_rules())
+    if clean:
+        out_forest = cleanup_forest(out_forest, sprime_symbol)
+    return out_forest
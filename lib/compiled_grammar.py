@@ -0,0 +1,141 @@
+"""
+Here I implement an integer view of a CFG for the compact Earley intersection (compact_earley.py).
+
+A CompiledGrammar does not depend on the FSA, thus it is built once and reused across sentences:
+    * symbols and rules get ids, rules are indexed by the id of their LHS
+    * terminals are indexed by label, so that the arcs of an FSA map to terminal ids
+    * nullable symbols and left corners filter predictions: a rule is only predicted in a state if it can derive the
+      empty string or if it can start with the label of an arc leaving that state
+"""
+
+from .formal import Symbol, Terminal, CFG, FSA
+
+
+class CompiledGrammar:
+    """
+    Integer-indexed tables of a CFG:
+        * symbols[sid], rules[rid], rule_lhs[rid] (a symbol id) and rule_rhs[rid] (a tuple of symbol ids)
+        * rules_by_lhs[sid]: ids of the rules rewriting a symbol
+        * is_terminal[sid], is_eps[sid] and labels[sid] (the string a terminal matches in the FSA)
+        * first[sid]: labels a non-empty derivation of the symbol can start with
+        * rule_nullable[rid] and rule_corners[rid]: the symbols a rule can start with (its RHS up to the first symbol
+          that is not nullable)
+    """
+
+    def __init__(self, cfg: CFG, eps_symbol=Terminal('-EPS-')):
+        self.cfg = cfg
+        self.eps_symbol = eps_symbol
+        self.rules = list(cfg)
+        self.symbol_ids = {}
+        self.symbols = []
+        self.rule_lhs = [self._add_symbol(rule.lhs) for rule in self.rules]
+        self.rule_rhs = [tuple(self._add_symbol(s) for s in rule.rhs) for rule in self.rules]
+        self.rules_by_lhs = [[] for _ in self.symbols]
+        for rid, lhs in enumerate(self.rule_lhs):
+            self.rules_by_lhs[lhs].append(rid)
+        self.is_terminal = [s.is_terminal() for s in self.symbols]
+        self.is_eps = [eps_symbol is not None and s.root() == eps_symbol for s in self.symbols]
+        self.labels = [s.root().obj() if s.is_terminal() else None for s in self.symbols]
+        self.terminals_by_label = {}
+        for sid, label in enumerate(self.labels):
+            if label is not None and not self.is_eps[sid]:
+                self.terminals_by_label.setdefault(label, []).append(sid)
+        self.max_arity = max((len(rhs) for rhs in self.rule_rhs), default=0)
+        self._left_corners()
+
+    def _add_symbol(self, symbol: Symbol) -> int:
+        sid = self.symbol_ids.get(symbol, None)
+        if sid is None:
+            sid = self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return sid
+
+    def _left_corners(self):
+        """Computes nullable symbols, first labels and the corners of each rule (worklist algorithms)"""
+        # nullable: a rule is nullable once all of its RHS symbols are
+        nullable = list(self.is_eps)
+        missing = [len(rhs) for rhs in self.rule_rhs]
+        occurrences = [[] for _ in self.symbols]
+        for rid, rhs in enumerate(self.rule_rhs):
+            for sid in rhs:
+                occurrences[sid].append(rid)
+        agenda = [sid for sid, is_eps in enumerate(nullable) if is_eps]
+        for rid, rhs in enumerate(self.rule_rhs):
+            if not rhs and not nullable[self.rule_lhs[rid]]:
+                nullable[self.rule_lhs[rid]] = True
+                agenda.append(self.rule_lhs[rid])
+        while agenda:
+            sid = agenda.pop()
+            for rid in occurrences[sid]:
+                missing[rid] -= 1
+                lhs = self.rule_lhs[rid]
+                if missing[rid] == 0 and not nullable[lhs]:
+                    nullable[lhs] = True
+                    agenda.append(lhs)
+        self.nullable = nullable
+        self.rule_nullable = [all(nullable[sid] for sid in rhs) for rhs in self.rule_rhs]
+
+        # corners: the RHS of a rule up to (and including) its first symbol that is not nullable
+        self.rule_corners = []
+        parents = [set() for _ in self.symbols]
+        for rid, rhs in enumerate(self.rule_rhs):
+            corners = []
+            for sid in rhs:
+                corners.append(sid)
+                if not nullable[sid]:
+                    break
+            self.rule_corners.append(tuple(corners))
+            for sid in corners:
+                parents[sid].add(self.rule_lhs[rid])
+
+        # first labels flow from terminals up to the symbols they are left corners of
+        first = [set() for _ in self.symbols]
+        agenda = []
+        for sid, label in enumerate(self.labels):
+            if label is not None and not self.is_eps[sid]:
+                first[sid].add(label)
+                agenda.append(sid)
+        while agenda:
+            sid = agenda.pop()
+            for parent in parents[sid]:
+                if not first[sid] <= first[parent]:
+                    first[parent] |= first[sid]
+                    agenda.append(parent)
+        self.first = first
+
+    def nb_symbols(self) -> int:
+        return len(self.symbols)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def symbol_id(self, symbol: Symbol, default=None):
+        return self.symbol_ids.get(symbol, default)
+
+    def arcs(self, fsa: FSA) -> list:
+        """
+        For each symbol id, the arcs of the FSA it matches as a dict origin -> list of destinations
+        (None for symbols without arcs)
+        """
+        arcs = [None] * len(self.symbols)
+        if type(fsa).destinations is FSA.destinations:
+            labelled_arcs = ((origin, label, destinations) for origin in range(fsa.nb_states())
+                             for label, destinations in fsa.iterarcs(origin, group_by='label'))
+        else:  # automata that match labels their own way (e.g. wildcards) are queried for every label
+            labelled_arcs = ((origin, label, fsa.destinations(origin, label)) for origin in range(fsa.nb_states())
+                             for label in self.terminals_by_label)
+        for origin, label, destinations in labelled_arcs:
+            if not destinations:
+                continue
+            for sid in self.terminals_by_label.get(label, ()):
+                if arcs[sid] is None:
+                    arcs[sid] = {}
+                arcs[sid].setdefault(origin, []).extend(destinations)
+        return arcs
+
+    def predictable(self, rid: int, labels: set) -> bool:
+        """Whether a rule may derive something from a state whose outgoing arcs have the given labels"""
+        if self.rule_nullable[rid]:
+            return True
+        first = self.first
+        return any(not first[sid].isdisjoint(labels) for sid in self.rule_corners[rid])
@@ -6,9 +6,11 @@ Here I implement Earley intersection between an arbitrary CFG (including eps rul
 
 from collections import defaultdict, deque
 from weakref import WeakValueDictionary
-from .formal import Symbol, Terminal, Span
+from .formal import Symbol, Terminal, Span, InternArena
 from .formal import Rule, CFG, FSA
 from .alg import cleanup_forest
+from .compact_earley import compact_earley
+from .compiled_grammar import CompiledGrammar
 
 # ## Items
 # 
@@ -27,6 +29,13 @@ class Item:
     def __new__(cls, rule: Rule, dots: list):
         assert len(dots) > 0, 'I do not accept an empty list of dots'
         dots = tuple(dots)
+        if InternArena._stack:
+            def constructor():
+                instance = object.__new__(Item)
+                instance._rule = rule
+                instance._dots = dots
+                return instance
+            return InternArena.intern(Item, (rule, dots), constructor, Item.__repositories.get(rule, None), dots)
         repository = Item.__repositories[rule]
         instance = repository.get(dots, None)
         if instance is None:
@@ -268,7 +277,8 @@ def complete(agenda: Agenda, item: Item):
         # look for completions of item.next spanning from item.dot
         return [item.advance(destination) for destination in agenda.destinations(item.next, item.dot)]
     
-def earley(cfg: CFG, fsa: FSA, start_symbol: Symbol, sprime_symbol=None, eps_symbol=Terminal('-EPS-'), clean=True):
+def earley(cfg: CFG, fsa: FSA, start_symbol: Symbol, sprime_symbol=None, eps_symbol=Terminal('-EPS-'), clean=True,
+           compact=False, max_complete=None, prune=None, stats=None):
     """
     Earley intersection between a CFG and an FSA.
     
@@ -278,8 +288,18 @@ def earley(cfg: CFG, fsa: FSA, start_symbol: Symbol, sprime_symbol=None, eps_sym
     :param sprime_symbol: if specified, the resulting forest will have sprime_symbol as its starting symbol
     :param eps_symbol: if not None, the parser will support epsilon rules
     :param clean: if True, returns a forest without dead edges.
+    :param compact: if True, items are packed into ints instead of interned Item objects (see compact_earley),
+        implied if cfg is a CompiledGrammar
+    :param max_complete: pruning, see compact_earley (implies compact)
+    :param prune: pruning, see compact_earley (implies compact)
+    :param stats: if a dict is given, it receives the number of items created ('items'), with Item objects this is
+        the growth of Item.nb_instances() over the parse (items interned in an InternArena are not counted)
     :returns: a CFG object representing the intersection between the cfg and the fsa 
     """
+    if compact or isinstance(cfg, CompiledGrammar) or max_complete is not None or prune is not None:
+        return compact_earley(cfg, fsa, start_symbol, sprime_symbol, eps_symbol, clean, stats=stats,
+                              max_complete=max_complete, prune=prune)
+    nb_instances = Item.nb_instances() if stats is not None else 0
     
     # start an agenda of items
     A = Agenda()
@@ -312,6 +332,10 @@ def earley(cfg: CFG, fsa: FSA, start_symbol: Symbol, sprime_symbol=None, eps_sym
         # mark this antecedent as processed
         A.make_passive(antecedent)
 
+    # items are only weakly referenced by their repository, thus they must be counted while the agenda is alive
+    if stats is not None:
+        stats['items'] = Item.nb_instances() - nb_instances
+
     def iter_intersected_rules():
         """
         Here we convert complete items into CFG rules.
@@ -11,6 +11,7 @@ Here I define a number of immutable objects that will be useful in designing the
 They all manage instances of their classes in a way that we are guaranteed to have one instance per object.
 This allows us to design more efficient comparison and hash functions.
 This also saves memory.
+Span, Rule and Item instances may be interned in a scoped InternArena instead of global weak repositories.
 
 :author: Wilker Aziz
 """
@@ -21,6 +22,76 @@ from collections import defaultdict
 
 # This notebook should help you with project 2, in particular, it implements a basic ITG parser.
 
+# # Interning arenas
+#
+# Instances are interned in class-level weak repositories: they live as long as some forest uses them, but every
+# instance pays for a weak reference. Within an InternArena, new Span/Rule/Item instances are kept in plain
+# dictionaries that are released in bulk when the arena is done (e.g. after a batch).
+
+
+class InternArena:
+    """
+    A scope in which new Span, Rule and Item instances are interned in plain dictionaries, released in bulk when
+    leaving the scope (or calling release). Instances that exist already (globally or in an enclosing arena) are
+    still shared, and Terminal/Nonterminal instances (a bounded vocabulary) are always interned globally.
+
+    Instances created in an arena must not outlive it: once the arena is released, an equal instance created later
+    is a different object (and equality is identity).
+
+        with InternArena() as arena:
+            ...  # parse/featurize a batch
+            print(arena.stats())
+    """
+
+    _stack = []
+
+    def __init__(self, release_on_exit=True):
+        self._tables = defaultdict(dict)
+        self.release_on_exit = release_on_exit
+
+    def __enter__(self):
+        InternArena._stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        InternArena._stack.remove(self)
+        if self.release_on_exit:
+            self.release()
+        return False
+
+    @classmethod
+    def current(cls):
+        """The innermost active arena (None if there is none)"""
+        return cls._stack[-1] if cls._stack else None
+
+    @classmethod
+    def intern(cls, kind, key, constructor, repository=None, repository_key=None):
+        """
+        Returns the instance of `kind` for `key`: active arenas are searched from the innermost, then the global
+        repository, a new instance goes to the innermost arena
+        """
+        for arena in reversed(cls._stack):
+            instance = arena._tables[kind].get(key, None)
+            if instance is not None:
+                return instance
+        instance = None if repository is None else repository.get(repository_key, None)
+        if instance is None:
+            instance = constructor()
+            cls._stack[-1]._tables[kind][key] = instance
+        return instance
+
+    def release(self):
+        """Forgets all instances interned in this arena"""
+        self._tables.clear()
+
+    def __len__(self):
+        return sum(len(table) for table in self._tables.values())
+
+    def stats(self) -> dict:
+        """Number of instances interned in this arena by class name"""
+        return {kind.__name__: len(table) for kind, table in self._tables.items()}
+
+
 # # Symbols
 # 
 # Let's start by defining the symbols that can be used in our grammars.
@@ -47,6 +118,8 @@ class Symbol:
 
     def __new__(cls, key, constructor):
         repository = Symbol.__repositories[cls]
+        if InternArena._stack and cls is Span:
+            return InternArena.intern(cls, key, constructor, repository, key)
         instance = repository.get(key, None)
         if instance is None:
             instance = constructor()
@@ -222,6 +295,13 @@ class Rule(object):
         assert len(rhs) > 0, 'If you want an empty RHS, use an epsilon Terminal'
         assert all(isinstance(s, Symbol) for s in rhs), 'RHS must be a sequence of Symbol objects'
         rhs = tuple(rhs)
+        if InternArena._stack:
+            def constructor():
+                instance = object.__new__(Rule)
+                instance._lhs = lhs
+                instance._rhs = rhs
+                return instance
+            return InternArena.intern(Rule, (lhs, rhs), constructor, Rule.__repositories.get(lhs, None), rhs)
         repository = Rule.__repositories[lhs]
         instance = repository.get(rhs, None)
         if instance is None:
@@ -438,7 +518,7 @@ class FSA:
         return iter(self._final)
    
     def iterarcs(self, origin: int, group_by='destination') -> dict:
-        if origin + 1 < self.nb_states():
+        if origin < self.nb_states():
             return self._states[origin].by_destination.items() if group_by == 'destination' else self._states[origin].by_label.items()
         return dict()
     
@@ -81,8 +81,12 @@ def make_fsa(string: str) -> FSA:
 # 
 # Now we can project the forest onto the target vocabulary by using ITG rules.
 
-def make_target_side_itg(source_forest: CFG, lexicon: dict) -> CFG:
-    """Constructs the target side of an ITG from a source forest and a dictionary"""    
+def make_target_side_itg(source_forest: CFG, lexicon: dict, max_inversion_width=None) -> CFG:
+    """
+    Constructs the target side of an ITG from a source forest and a dictionary
+    
+    :param max_inversion_width: if set, binary rules are only inverted if their LHS spans at most this many words
+    """
     def iter_rules():
         for lhs, rules in source_forest.items():            
             for r in rules:
@@ -99,6 +103,10 @@ def make_target_side_itg(source_forest: CFG, lexicon: dict) -> CFG:
                         yield r  # nonterminal rules
                 elif r.arity == 2:
                     yield r  # monotone
+                    if max_inversion_width is not None and isinstance(r.lhs, Span):
+                        _, start, end = r.lhs.obj()
+                        if end - start > max_inversion_width:  # pruning: no long distance reordering
+                            continue
                     if r.rhs[0] != r.rhs[1]:  # avoiding some spurious derivations by blocking invertion of identical spans
                         yield Rule(r.lhs, [r.rhs[1], r.rhs[0]])  # inverted
                 else:
@@ -187,6 +195,8 @@ def make_target_side_finite_itg(source_forest: CFG, lexicon: dict,
 # 
 # For maximum lenght \\(n\\), this special FSA must accept the language \\(\Sigma^0 \cup \Sigma^1 \cup \cdots \cup \Sigma^n\\). You can implement this FSA designing a special FSA class which never rejects a terminal (for example by defining a *wildcard* symbol).
 # 
+# Note that misc/constrained_forest.py builds the same constrained forests without running Earley again (constrain_forest), or keeps the forest as it is and treats the constraint as a semiring dimension (constrained_inside).
+# 
 
 
 class LengthConstraint(FSA):
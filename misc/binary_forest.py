@@ -0,0 +1,184 @@
+# This file contains a compact binary encoding of forests that can be loaded without pickle/dill
+#
+# Layout of an encoded forest (little endian, every array starts at a multiple of 8 bytes):
+#     header: MAGIC, nb_nodes, nb_symbols, nb_edges, nb_tails, nb_strings, nb_string_bytes
+#     symbols: kind, ref, start, end (int32 * nb_symbols each)
+#     nodes: depth (int32 * nb_nodes)
+#     edges: heads (int32 * nb_edges), tail_offsets (int32 * (nb_edges + 1)), tails (int32 * nb_tails)
+#     strings: offsets (int32 * (nb_strings + 1)), utf-8 bytes
+#
+# Symbols 0..nb_nodes-1 are the nodes of the compiled forest (see CompiledForest), the remaining symbols are only
+# reachable from within spans (e.g. the Nonterminal of a Span). A terminal/nonterminal refers to a string, a span
+# refers to the symbol it wraps.
+import struct
+import numpy as np
+from lib.formal import Symbol, Terminal, Nonterminal, Span, Rule, CFG
+from misc.compiled_forest import CompiledForest, compile_forest
+
+MAGIC = b'BFOREST1'
+_HEADER = struct.Struct('<8s6Q')
+
+# kinds of symbols, spans record whether they wrap a terminal so that terminal_mask is a vectorized test
+TERMINAL, NONTERMINAL, TERMINAL_SPAN, NONTERMINAL_SPAN = range(4)
+
+
+def _padded(nb_bytes):
+    return (nb_bytes + 7) // 8 * 8
+
+
+class LazySequence():
+    """
+    A read-only sequence whose items are created by a function the first time they are accessed
+    """
+
+    def __init__(self, length, make_item):
+        self._items = [None] * length
+        self._make_item = make_item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        item = self._items[i]
+        if item is None:
+            item = self._make_item(i if i >= 0 else i + len(self))
+            self._items[i] = item
+        return item
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class BinaryForest():
+    """
+    A forest backed by its binary encoding: the arrays are views of the buffer (np.frombuffer, thus a memory map
+    works as well) and Symbol/Rule objects are only interned when they are accessed.
+    Pickling a BinaryForest only stores its encoding.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, nb_nodes, nb_symbols, nb_edges, nb_tails, nb_strings, nb_string_bytes = \
+            _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a binary forest')
+        offset = _HEADER.size
+
+        def array(count):
+            nonlocal offset
+            values = np.frombuffer(buffer, dtype='<i4', count=count, offset=offset)
+            offset += _padded(4 * count)
+            return values
+
+        self.symbol_kind = array(nb_symbols)
+        self.symbol_ref = array(nb_symbols)
+        self.symbol_start = array(nb_symbols)
+        self.symbol_end = array(nb_symbols)
+        self.depth = array(nb_nodes)
+        self.heads = array(nb_edges)
+        self.tail_offsets = array(nb_edges + 1)
+        self.tails = array(nb_tails)
+        self.string_offsets = array(nb_strings + 1)
+        self._strings_offset = offset
+        self.nb_nodes = nb_nodes
+        self.symbols = LazySequence(nb_symbols, self._make_symbol)
+        self.rules = LazySequence(nb_edges, self._make_rule)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def __reduce__(self):
+        return BinaryForest, (self.tobytes(),)
+
+    def tobytes(self) -> bytes:
+        return bytes(self.buffer)
+
+    def string(self, i) -> str:
+        first = self._strings_offset + int(self.string_offsets[i])
+        last = self._strings_offset + int(self.string_offsets[i + 1])
+        return bytes(self.buffer[first:last]).decode('utf-8')
+
+    def _make_symbol(self, i) -> Symbol:
+        kind = self.symbol_kind[i]
+        if kind == TERMINAL:
+            return Terminal(self.string(self.symbol_ref[i]))
+        if kind == NONTERMINAL:
+            return Nonterminal(self.string(self.symbol_ref[i]))
+        return Span(self.symbols[int(self.symbol_ref[i])], int(self.symbol_start[i]), int(self.symbol_end[i]))
+
+    def _make_rule(self, e) -> Rule:
+        tails = self.tails[self.tail_offsets[e]:self.tail_offsets[e + 1]]
+        return Rule(self.symbols[int(self.heads[e])], [self.symbols[int(v)] for v in tails])
+
+    def compile(self) -> CompiledForest:
+        """Returns the compiled forest straight from the arrays (nodes and rules are interned on demand)"""
+        forest = CompiledForest.__new__(CompiledForest)
+        forest.nodes = LazySequence(self.nb_nodes, lambda v: self.symbols[v])
+        forest._node_ids = None
+        forest.depth = self.depth.astype(np.int64)
+        forest.level_offsets = np.searchsorted(forest.depth, np.arange(forest.depth.max(initial=-1) + 2)).astype(np.int64)
+        kind = self.symbol_kind[:self.nb_nodes]
+        forest.terminal_mask = (kind == TERMINAL) | (kind == TERMINAL_SPAN)
+        forest.root = self.nb_nodes - 1
+        forest.rules = self.rules
+        forest.heads = self.heads.astype(np.int64)
+        forest.tails = self.tails.astype(np.int64)
+        forest.tail_offsets = self.tail_offsets.astype(np.int64)
+        forest.edge_offsets = np.searchsorted(forest.heads, np.arange(self.nb_nodes + 1)).astype(np.int64)
+        return forest
+
+    def to_cfg(self) -> CFG:
+        """Materializes the forest as a CFG (rules in edge order)"""
+        return CFG(list(self.rules))
+
+
+def encode_forest(forest: CFG) -> BinaryForest:
+    """Encodes a forest (nodes and edges follow the order of its compiled version)"""
+    if isinstance(forest, BinaryForest):
+        return forest
+    compiled = compile_forest(forest)
+    symbols = list(compiled.nodes)
+    symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+    strings = []
+    string_ids = {}
+    kind = []
+    ref = []
+    start = []
+    end = []
+    i = 0
+    while i < len(symbols):  # symbols wrapped by spans are appended while we go
+        symbol = symbols[i]
+        if isinstance(symbol, Span):
+            wrapped, symbol_start, symbol_end = symbol.obj()
+            if wrapped not in symbol_ids:
+                symbol_ids[wrapped] = len(symbols)
+                symbols.append(wrapped)
+            kind.append(TERMINAL_SPAN if symbol.is_terminal() else NONTERMINAL_SPAN)
+            ref.append(symbol_ids[wrapped])
+            start.append(symbol_start)
+            end.append(symbol_end)
+        else:
+            string = symbol.obj()
+            if string not in string_ids:
+                string_ids[string] = len(strings)
+                strings.append(string)
+            kind.append(TERMINAL if symbol.is_terminal() else NONTERMINAL)
+            ref.append(string_ids[string])
+            start.append(-1)
+            end.append(-1)
+        i += 1
+
+    encoded_strings = [string.encode('utf-8') for string in strings]
+    string_offsets = np.concatenate(([0], np.cumsum([len(s) for s in encoded_strings], dtype=np.int64)))
+    arrays = [kind, ref, start, end, compiled.depth, compiled.heads, compiled.tail_offsets, compiled.tails,
+              string_offsets]
+    parts = [_HEADER.pack(MAGIC, compiled.nb_nodes(), len(symbols), compiled.nb_edges(), len(compiled.tails),
+                          len(strings), int(string_offsets[-1]))]
+    for values in arrays:
+        data = np.asarray(values, dtype='<i4').tobytes()
+        parts.append(data + bytes(_padded(len(data)) - len(data)))
+    parts.extend(encoded_strings)
+    return BinaryForest(b''.join(parts))
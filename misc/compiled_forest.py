@@ -0,0 +1,163 @@
+# This file contains an array-backed representation of acyclic forests used by the inference routines
+import numpy as np
+from collections import deque
+from lib.formal import Symbol, CFG
+from lib.alg import useful_edge_mask
+
+
+class CompiledForest():
+    """
+    A forest compiled once into dense integer ids, so that inference can sweep NumPy arrays instead of
+    looking up interned Span/Rule objects in dictionaries.
+
+    Nodes are numbered in topological order (children before parents, the root is the last node) and
+    grouped in levels of equal depth, nodes in the same level never depend on each other.
+    Edges are grouped by their head node: edges rewriting node v are edge_offsets[v]:edge_offsets[v+1],
+    and the tails of edge e are tails[tail_offsets[e]:tail_offsets[e+1]].
+    """
+
+    def __init__(self, forest: CFG, root: Symbol=None):
+        # 1. assign temporary ids in order of discovery
+        ids = {}
+        symbols = []
+        edge_heads = []
+        edge_tails = []
+        for rule in forest._rules:
+            for symbol in (rule.lhs,) + rule.rhs:
+                if symbol not in ids:
+                    ids[symbol] = len(symbols)
+                    symbols.append(symbol)
+            edge_heads.append(ids[rule.lhs])
+            edge_tails.append([ids[symbol] for symbol in rule.rhs])
+
+        # 2. compute the depth of each node with Kahn's algorithm (terminals have depth 0)
+        nb_nodes = len(symbols)
+        pending = [0] * nb_nodes  # number of tail occurrences a node still waits for
+        parents = [[] for _ in range(nb_nodes)]
+        for head, tails in zip(edge_heads, edge_tails):
+            pending[head] += len(tails)
+            for tail in tails:
+                parents[tail].append(head)
+        depth = [0] * nb_nodes
+        queue = deque(v for v in range(nb_nodes) if pending[v] == 0)
+        nb_sorted = 0
+        while queue:
+            child = queue.popleft()
+            nb_sorted += 1
+            for parent in parents[child]:
+                depth[parent] = max(depth[parent], depth[child] + 1)
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    queue.append(parent)
+        if nb_sorted != nb_nodes:
+            raise ValueError('I can only compile acyclic forests')
+
+        # 3. relabel nodes in topological order making sure the root comes last
+        if root is None:
+            root_id = max(range(nb_nodes), key=lambda v: (not parents[v], depth[v]), default=-1)
+        else:
+            root_id = ids[root]
+        if root_id >= 0:  # nothing depends on the root, so it can sit alone in the top level
+            depth[root_id] = max(depth[root_id], max((d for v, d in enumerate(depth) if v != root_id), default=-1) + 1)
+        order = sorted(range(nb_nodes), key=lambda v: depth[v])
+        new_ids = [0] * nb_nodes
+        for new_id, old_id in enumerate(order):
+            new_ids[old_id] = new_id
+
+        self.nodes = [symbols[v] for v in order]
+        self._node_ids = {symbol: v for v, symbol in enumerate(self.nodes)}
+        self.depth = np.array([depth[v] for v in order], dtype=np.int64)
+        # nodes of the same depth are contiguous: level d holds nodes level_offsets[d]:level_offsets[d+1]
+        self.level_offsets = np.searchsorted(self.depth, np.arange(self.depth.max(initial=-1) + 2)).astype(np.int64)
+        self.terminal_mask = np.array([symbol.is_terminal() for symbol in self.nodes], dtype=bool)
+        self.root = nb_nodes - 1
+
+        # 4. group edges by head (a stable sort keeps the original order of edges sharing a head)
+        edge_order = sorted(range(len(edge_heads)), key=lambda e: new_ids[edge_heads[e]])
+        self.rules = [forest._rules[e] for e in edge_order]
+        self.heads = np.array([new_ids[edge_heads[e]] for e in edge_order], dtype=np.int64)
+        self.tails = np.array([new_ids[tail] for e in edge_order for tail in edge_tails[e]], dtype=np.int64)
+        arities = np.array([len(edge_tails[e]) for e in edge_order], dtype=np.int64)
+        self.tail_offsets = np.concatenate(([0], np.cumsum(arities))).astype(np.int64)
+        self.edge_offsets = np.searchsorted(self.heads, np.arange(nb_nodes + 1)).astype(np.int64)
+
+    @property
+    def node_ids(self) -> dict:
+        """Maps symbols to node ids (built on first use when nodes are created lazily, see BinaryForest)"""
+        if self._node_ids is None:
+            self._node_ids = {symbol: v for v, symbol in enumerate(self.nodes)}
+        return self._node_ids
+
+    def nb_nodes(self) -> int:
+        return len(self.nodes)
+
+    def nb_edges(self) -> int:
+        return len(self.rules)
+
+    def nb_levels(self) -> int:
+        return len(self.level_offsets) - 1
+
+    def node(self, v: int) -> Symbol:
+        """The symbol associated with node id v"""
+        return self.nodes[v]
+
+    def node_id(self, symbol: Symbol) -> int:
+        """The node id associated with a symbol"""
+        return self.node_ids[symbol]
+
+    def edges(self, v: int) -> range:
+        """Ids of the edges whose head is node v"""
+        return range(self.edge_offsets[v], self.edge_offsets[v + 1])
+
+    def edge_tails(self, e: int) -> np.ndarray:
+        """Node ids of the tails of edge e"""
+        return self.tails[self.tail_offsets[e]:self.tail_offsets[e + 1]]
+
+    def tail_sum(self, node_values: np.ndarray) -> np.ndarray:
+        """Sums node values over the tails of every edge (a vectorized pass over all edges)"""
+        if self.nb_edges() == 0:
+            return np.zeros(0, dtype=node_values.dtype)
+        return np.add.reduceat(node_values[self.tails], self.tail_offsets[:-1])
+
+    def without_symbols(self) -> 'CompiledForest':
+        """
+        A copy that shares the arrays but where nodes and rules are only numbered (node(v) is v and rules[e] is e),
+        it is cheap to pickle, e.g. to run inference in another process
+        """
+        forest = CompiledForest.__new__(CompiledForest)
+        forest.__dict__.update(self.__dict__)
+        forest.nodes = range(self.nb_nodes())
+        forest.rules = range(self.nb_edges())
+        forest._node_ids = None
+        return forest
+
+    def useful_edges(self, edge_mask: np.ndarray=None) -> np.ndarray:
+        """
+        A boolean mask of the edges that take part in a complete derivation (see lib.alg.useful_edge_mask),
+        e.g. after pruning the edges that are not set in edge_mask
+        """
+        return np.array(useful_edge_mask(self.nb_nodes(), self.heads.tolist(), self.tail_offsets.tolist(),
+                                         self.tails.tolist(), self.root, self.terminal_mask.tolist(),
+                                         None if edge_mask is None else edge_mask.tolist()), dtype=bool)
+
+
+def compile_forest(forest: CFG) -> CompiledForest:
+    """
+    Returns the compiled version of a forest, the forest is compiled (and sorted) only the first time.
+    Forests that are already stored as arrays (e.g. BinaryForest) provide their own compile method,
+    and a CompiledForest is returned as it is.
+    """
+    if isinstance(forest, CompiledForest):
+        return forest
+    compiled = getattr(forest, '_compiled', None)
+    if compiled is None:
+        compiled = forest.compile() if hasattr(forest, 'compile') else CompiledForest(forest)
+        forest._compiled = compiled
+    return compiled
+
+
+def compile_edge_weights(forest: CompiledForest, edge_weights) -> np.ndarray:
+    """Returns edge weights indexed by edge id, given either such an array or a dictionary rule -> weight"""
+    if isinstance(edge_weights, dict):
+        return np.array([edge_weights[rule] for rule in forest.rules], dtype=float)
+    return np.asarray(edge_weights, dtype=float)
@@ -0,0 +1,157 @@
+# This file contains length/insertion constrained forests built without intersecting an FSA (see LengthConstraint
+# and InsertionConstraint in lib/libitg.py)
+import numpy as np
+from lib.formal import Symbol, Span, Rule, CFG
+from misc.compiled_forest import CompiledForest, compile_forest
+
+# what the counter of a constraint counts: terminals that are not -EPS- (length) or -EPS- terminals (insertions)
+LENGTH = 'length'
+INSERTIONS = 'insertions'
+
+
+def counted_terminals(forest: CompiledForest, constraint=LENGTH, eps_str='-EPS-') -> np.ndarray:
+    """Returns 1 for the terminal nodes the constraint counts and 0 for the other nodes"""
+    if constraint not in (LENGTH, INSERTIONS):
+        raise ValueError('Unknown constraint: %s' % constraint)
+    counted = np.zeros(forest.nb_nodes(), dtype=np.int64)
+    for v in np.flatnonzero(forest.terminal_mask).tolist():
+        is_eps = forest.node(v).root().obj() == eps_str
+        counted[v] = is_eps if constraint == INSERTIONS else not is_eps
+    return counted
+
+
+def _bits(mask: int) -> list:
+    """The counts set in a bitset"""
+    counts = []
+    c = 0
+    while mask:
+        if mask & 1:
+            counts.append(c)
+        mask >>= 1
+        c += 1
+    return counts
+
+
+def constrain_forest(forest: CFG, n: int, constraint=LENGTH, strict=False, eps_str='-EPS-',
+                     goal_symbol: Symbol=None) -> CFG:
+    """
+    Returns the forest restricted to derivations with at most n (exactly n if strict) counted terminals, the same
+    derivations as earley(forest, LengthConstraint(n, strict)) (or InsertionConstraint with eps_symbol=None).
+
+    Instead of intersecting every node with all pairs of FSA states, a node is annotated with the count of
+    its yield only, as Span(node, 0, c):
+        * bottom-up, the achievable counts of each node are a bitset, counts above n are pruned on the fly
+        * top-down from the accepted counts of the root, only the (node, count) pairs and the splits of the count
+          among the tails of an edge that take part in a derivation become rules
+    :param goal_symbol: if given, goal -> root:0-c rules are added for every accepted count c
+    """
+    compiled = compile_forest(forest)
+    counted = counted_terminals(compiled, constraint, eps_str).tolist()
+    nb_nodes = compiled.nb_nodes()
+    if nb_nodes == 0:
+        return CFG([])
+    full = (1 << (n + 1)) - 1
+    edge_offsets = compiled.edge_offsets.tolist()
+    tail_offsets = compiled.tail_offsets.tolist()
+    tails = compiled.tails.tolist()
+
+    # 1. bottom-up (nodes are in topological order): achievable counts of each node
+    counts = [0] * nb_nodes
+    edge_counts = [0] * compiled.nb_edges()
+    for v in range(nb_nodes):
+        if compiled.terminal_mask[v]:
+            counts[v] = (1 << counted[v]) & full
+            continue
+        for e in range(edge_offsets[v], edge_offsets[v + 1]):
+            mask = 1
+            for t in tails[tail_offsets[e]:tail_offsets[e + 1]]:
+                combined = 0
+                for c in _bits(mask):
+                    combined |= counts[t] << c
+                mask = combined & full
+            edge_counts[e] = mask
+            counts[v] |= mask
+
+    # 2. top-down: needed counts of each node, and rules
+    accepted = (1 << n) if strict else full
+    needed = [0] * nb_nodes
+    needed[compiled.root] = counts[compiled.root] & accepted
+    spans = {}
+
+    def span(v, c):
+        symbol = spans.get((v, c), None)
+        if symbol is None:
+            symbol = spans[v, c] = Span(compiled.node(v), 0, c)
+        return symbol
+
+    def splits(edge_tails, c):
+        """Yields the counts of the tails that add up to c"""
+        if not edge_tails:
+            if c == 0:
+                yield ()
+            return
+        if len(edge_tails) == 1:
+            if counts[edge_tails[0]] >> c & 1:
+                yield (c,)
+            return
+        for first in _bits(counts[edge_tails[0]]):
+            if first > c:
+                break
+            for rest in splits(edge_tails[1:], c - first):
+                yield (first,) + rest
+
+    rules = []
+    if goal_symbol is not None:
+        rules.extend(Rule(goal_symbol, [span(compiled.root, c)]) for c in _bits(needed[compiled.root]))
+    for v in range(nb_nodes - 1, -1, -1):
+        if not needed[v] or compiled.terminal_mask[v]:
+            continue
+        for e in range(edge_offsets[v], edge_offsets[v + 1]):
+            edge_tails = tails[tail_offsets[e]:tail_offsets[e + 1]]
+            for c in _bits(needed[v] & edge_counts[e]):
+                for split in splits(edge_tails, c):
+                    rules.append(Rule(span(v, c), [span(t, tc) for t, tc in zip(edge_tails, split)]))
+                    for t, tc in zip(edge_tails, split):
+                        needed[t] |= 1 << tc
+    return CFG(rules)
+
+
+def constrained_inside(forest: CompiledForest, edge_weights: np.ndarray, n: int, constraint=LENGTH,
+                       eps_str='-EPS-') -> np.ndarray:
+    """
+    The constraint as a semiring dimension: the graph is not expanded, instead the inside value of a node is a vector
+    over counts, I[v, c] is the log total weight of the derivations of v with c counted terminals (c <= n).
+    Edges combine the vectors of their tails with a (log) convolution truncated at n.
+
+    Constrained quantities are read from the root, e.g. the log normalizer of derivations of length at most n is
+    np.logaddexp.reduce(I[forest.root]), I[forest.root, n] for exactly n.
+    """
+    edge_weights = np.asarray(edge_weights, dtype=float)
+    K = n + 1
+    counted = counted_terminals(forest, constraint, eps_str)
+    I = np.full((forest.nb_nodes(), K), -np.inf)
+    terminals = np.flatnonzero(forest.terminal_mask & (counted <= n))
+    I[terminals, counted[terminals]] = 0.
+    edge_offsets = forest.edge_offsets
+    tail_offsets = forest.tail_offsets
+    arities = np.diff(tail_offsets)
+
+    def convolve(A, B):
+        result = np.full(A.shape, -np.inf)
+        for c in range(K):
+            result[:, c:] = np.logaddexp(result[:, c:], A[:, c:c + 1] + B[:, :K - c])
+        return result
+
+    for first, last in zip(forest.level_offsets[1:-1], forest.level_offsets[2:]):
+        e_first, e_last = edge_offsets[first], edge_offsets[last]
+        edge_arities = arities[e_first:e_last]
+        starts = tail_offsets[e_first:e_last]
+        # the count vector of each edge: its tails convolved one after the other
+        scores = np.full((e_last - e_first, K), -np.inf)
+        scores[:, 0] = 0.
+        for p in range(edge_arities.max(initial=0)):
+            has_tail = edge_arities > p
+            scores[has_tail] = convolve(scores[has_tail], I[forest.tails[starts[has_tail] + p]])
+        scores += edge_weights[e_first:e_last, None]
+        I[first:last] = np.logaddexp.reduceat(scores, edge_offsets[first:last] - e_first, axis=0)
+    return I
@@ -0,0 +1,320 @@
+# This file contains a memory-mapped training set: forests and their feature matrices, featurized once
+#
+# A dataset is a directory with
+#     dataset.store: one record per training instance (see ForestStore), records are not pickled but laid out as
+#         [part lengths: uint64 * 6] followed by the parts, each padded to a multiple of 8 bytes:
+#         Dx, Dxy (see BinaryForest), the feature matrices of Dx and Dxy, source and target sentence (utf-8)
+#     features.pkl: the feature names, the columns of the feature matrices
+# (dense feature blocks are stored in the sparse matrices, see Features.full_matrix)
+#
+# A feature matrix is stored as [nb_rows: uint64][nb_values: uint64] indptr (int64), indices (int32), data (float64).
+#
+# A feature cache (see FeatureCache) is a directory with
+#     features.store: one record per instance of a stream, laid out as [nb_parts: uint64][part lengths: uint64 *
+#         nb_parts] followed by the parts (padded as above): source sentence (utf-8), then the feature matrix and
+#         the dense blocks of D(x) and of each D(x,y)
+#     features.pkl: the feature names
+#     key.pkl: what the features were computed from (see feature_cache_key), written once the cache is complete
+#
+# Dense blocks are stored as [nb_blocks: uint64] then for each block [nb_rows: uint64][dim: uint64] feature ids
+# (int64), rows (int64), values (float64, nb_rows x dim).
+import os
+import struct
+import dill as pickle
+import numpy as np
+from scipy.sparse import csr_matrix
+from misc.binary_forest import BinaryForest, encode_forest
+from misc.compiled_forest import compile_forest
+from misc.features import Features, FeatureIndex, DenseBlock
+from misc.forest_store import ForestStore, ForestStoreWriter
+
+DATASET_STORE = "dataset.store"
+FEATURE_NAMES = "features.pkl"
+CACHE_STORE = "features.store"
+CACHE_KEY = "key.pkl"
+_PARTS = struct.Struct('<6Q')
+_MATRIX = struct.Struct('<QQ')
+_COUNT = struct.Struct('<Q')
+_BLOCK = struct.Struct('<QQ')
+
+
+def _padded(data: bytes) -> bytes:
+    return data + bytes(-len(data) % 8)
+
+
+def _encode_matrix(matrix: csr_matrix) -> bytes:
+    return b''.join([_MATRIX.pack(matrix.shape[0], matrix.nnz),
+                     np.asarray(matrix.indptr, dtype='<i8').tobytes(),
+                     _padded(np.asarray(matrix.indices, dtype='<i4').tobytes()),
+                     np.asarray(matrix.data, dtype='<f8').tobytes()])
+
+
+def _decode_matrix(buffer, nb_columns, column_map=None) -> csr_matrix:
+    nb_rows, nb_values = _MATRIX.unpack_from(buffer, 0)
+    offset = _MATRIX.size
+    indptr = np.frombuffer(buffer, dtype='<i8', count=nb_rows + 1, offset=offset)
+    offset += 8 * (nb_rows + 1)
+    indices = np.frombuffer(buffer, dtype='<i4', count=nb_values, offset=offset)
+    offset += 4 * nb_values + (-4 * nb_values) % 8
+    data = np.frombuffer(buffer, dtype='<f8', count=nb_values, offset=offset)
+    if column_map is not None:
+        indices = column_map[indices]
+    return csr_matrix((data, indices, indptr), shape=(nb_rows, nb_columns), copy=False)
+
+
+def _encode_blocks(blocks) -> bytes:
+    parts = [_COUNT.pack(len(blocks))]
+    for block in blocks:
+        parts.extend([_BLOCK.pack(len(block.rows), len(block.ids)),
+                      np.asarray(block.ids, dtype='<i8').tobytes(),
+                      np.asarray(block.rows, dtype='<i8').tobytes(),
+                      np.asarray(block.values, dtype='<f8').tobytes()])
+    return b''.join(parts)
+
+
+def _decode_blocks(buffer, column_map=None) -> list:
+    nb_blocks, = _COUNT.unpack_from(buffer, 0)
+    offset = _COUNT.size
+    blocks = []
+    for _ in range(nb_blocks):
+        nb_rows, dim = _BLOCK.unpack_from(buffer, offset)
+        offset += _BLOCK.size
+        ids = np.frombuffer(buffer, dtype='<i8', count=dim, offset=offset)
+        offset += 8 * dim
+        rows = np.frombuffer(buffer, dtype='<i8', count=nb_rows, offset=offset)
+        offset += 8 * nb_rows
+        values = np.frombuffer(buffer, dtype='<f8', count=nb_rows * dim, offset=offset).reshape(nb_rows, dim)
+        offset += 8 * nb_rows * dim
+        if column_map is not None:
+            ids = column_map[ids]
+        blocks.append(DenseBlock(ids, rows, values))
+    return blocks
+
+
+def _column_map(names, feature_index: FeatureIndex):
+    """Registers feature names in an index, returns the map from their positions to ids (None if the identity)"""
+    column_map = np.array([feature_index.get_id(name) for name in names], dtype=np.int64)
+    # columns only need to be translated if the index already knew other features
+    return None if np.array_equal(column_map, np.arange(len(names))) else column_map
+
+
+def write_dataset(output_dir, instances, featurizer):
+    """
+    Featurizes (Dx, Dxy, source, target) instances (e.g. from load_parse_trees) and writes them as a dataset,
+    the features depend on the featurizer settings, thus a dataset has to be written again when they change.
+    Returns the number of instances written.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with ForestStoreWriter(os.path.join(output_dir, DATASET_STORE)) as writer:
+        for Dx, Dxy, source, target in instances:
+            features = featurizer.featurize_parse_trees(Dx, Dxy, source)
+            parts = [encode_forest(Dx).tobytes(), encode_forest(Dxy).tobytes(),
+                     _encode_matrix(features.full_matrix(compile_forest(Dx))),
+                     _encode_matrix(features.full_matrix(compile_forest(Dxy))),
+                     source.encode('utf-8'), target.encode('utf-8')]
+            writer.append_bytes(b''.join([_PARTS.pack(*[len(part) for part in parts])] +
+                                         [_padded(part) for part in parts]))
+        nb_instances = len(writer)
+    with open(os.path.join(output_dir, FEATURE_NAMES), "wb") as f:
+        pickle.dump(list(featurizer.feature_index.names), f)
+    return nb_instances
+
+
+class MappedDataset():
+    """
+    Read access to a dataset through a memory map: forests and feature matrices are views of the mapped file,
+    thus reading an instance costs almost nothing once its pages are cached, processes training on the same
+    dataset share these pages and resident memory does not grow with the size of the corpus.
+    """
+
+    def __init__(self, dataset_dir, feature_index: FeatureIndex=None):
+        """
+        :param feature_index: the index the feature matrices are expressed in (use the one of the CRF), the
+            features of the dataset are registered in it
+        """
+        self.feature_index = feature_index if feature_index is not None else FeatureIndex()
+        with open(os.path.join(dataset_dir, FEATURE_NAMES), "rb") as f:
+            names = pickle.load(f)
+        self.column_map = _column_map(names, self.feature_index)
+        self.store = ForestStore(os.path.join(dataset_dir, DATASET_STORE), memory_map=True)
+
+    def __len__(self):
+        return len(self.store)
+
+    def _parts(self, i) -> list:
+        view = self.store.record_view(i)
+        parts = []
+        offset = _PARTS.size
+        for length in _PARTS.unpack_from(view, 0):
+            parts.append(view[offset:offset + length])
+            offset += length + (-length % 8)
+        return parts
+
+    def __getitem__(self, i):
+        """Returns instance i as (Dx, Dxy, source, target)"""
+        Dx, Dxy, _, _, source, target = self._parts(i)
+        return BinaryForest(Dx), BinaryForest(Dxy), bytes(source).decode('utf-8'), bytes(target).decode('utf-8')
+
+    def add_features(self, features: Features, i, instance):
+        """Adds the feature matrices of instance i (as returned by self[i]) to features"""
+        _, _, Dx_matrix, Dxy_matrix, _, _ = self._parts(i)
+        Dx, Dxy, _, _ = instance
+        nb_columns = len(self.feature_index)
+        features.add(compile_forest(Dx), _decode_matrix(Dx_matrix, nb_columns, self.column_map))
+        features.add(compile_forest(Dxy), _decode_matrix(Dxy_matrix, nb_columns, self.column_map))
+
+    def batches(self, batch_size):
+        """Yields (batch, features) in the order of the dataset, features are what Featurizer would compute"""
+        for first in range(0, len(self), batch_size):
+            batch = []
+            features = Features(self.feature_index)
+            for i in range(first, min(first + batch_size, len(self))):
+                instance = self[i]
+                self.add_features(features, i, instance)
+                batch.append(instance)
+            yield batch, features
+
+    def close(self):
+        self.store.close()
+
+
+def feature_cache_key(featurizer, input_files) -> dict:
+    """
+    What cached features depend on: the featurizer flags and the size and modification time of the input files
+    (e.g. the parsed data, the lexicon and the embeddings), the files of a directory are all taken into account
+    """
+    files = []
+    for path in input_files:
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            paths = [path]
+        for file_path in paths:
+            stat = os.stat(file_path)
+            files.append((os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns))
+    return {'flags': featurizer.flags(), 'files': files}
+
+
+class FeatureCache():
+    """
+    Feature matrices of a stream of instances read in the same order again and again (e.g. the training set, once
+    per epoch): they are computed with a featurizer during a first complete pass and memory-mapped afterwards.
+
+    The cache is only used once complete (see finish) and is computed again when the featurizer flags or the input
+    files change (see feature_cache_key).
+    """
+
+    def __init__(self, cache_dir, featurizer, input_files=()):
+        self.cache_dir = cache_dir
+        self.featurizer = featurizer
+        self.feature_index = featurizer.feature_index
+        self.key = feature_cache_key(featurizer, input_files)
+        self.store = None
+        self.column_map = None
+        self._writer = None
+        self._nb_instances = 0  # instances seen during the first pass
+        if self._stored_key() == self.key:
+            self._open()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _stored_key(self):
+        try:
+            with open(self._path(CACHE_KEY), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _open(self):
+        with open(self._path(FEATURE_NAMES), "rb") as f:
+            self.column_map = _column_map(pickle.load(f), self.feature_index)
+        self.store = ForestStore(self._path(CACHE_STORE), memory_map=True)
+
+    def is_complete(self) -> bool:
+        return self.store is not None
+
+    def __len__(self):
+        return len(self.store) if self.store is not None else 0
+
+    def batch_features(self, first, batch) -> Features:
+        """Features of a batch of (Dx, Dxy, source, target) instances, instances first, first + 1, ... of the stream"""
+        if self.is_complete():
+            features = Features(self.feature_index)
+            for i, (Dx, Dxy, source, _) in enumerate(batch, first):
+                self._read(features, i, source, [Dx, Dxy])
+            return features
+        features = self.featurizer.featurize_parse_trees_batch(batch)
+        for i, (Dx, Dxy, source, _) in enumerate(batch, first):
+            self._write(i, features, source, [Dx, Dxy])
+        return features
+
+    def reference_features(self, i, Dx, Dxys, source) -> Features:
+        """Features of instance i of the stream: D(x) and the D(x,y) forests of its references"""
+        forests = [Dx] + list(Dxys)
+        if self.is_complete():
+            features = Features(self.feature_index)
+            self._read(features, i, source, forests)
+            return features
+        features = self.featurizer.featurize_references(Dx, Dxys, source)
+        self._write(i, features, source, forests)
+        return features
+
+    def _read(self, features, i, source, forests):
+        view = self.store.record_view(i)
+        nb_parts, = _COUNT.unpack_from(view, 0)
+        offset = _COUNT.size + 8 * nb_parts
+        parts = []
+        for length in struct.unpack_from('<%dQ' % nb_parts, view, _COUNT.size):
+            parts.append(view[offset:offset + length])
+            offset += length + (-length % 8)
+        if nb_parts != 1 + 2 * len(forests) or bytes(parts[0]).decode('utf-8') != source:
+            raise ValueError('The feature cache in %s does not match instance %d' % (self.cache_dir, i))
+        nb_columns = len(self.feature_index)
+        for k, forest in enumerate(forests):
+            features.add(compile_forest(forest), _decode_matrix(parts[1 + 2 * k], nb_columns, self.column_map),
+                         _decode_blocks(parts[2 + 2 * k], self.column_map))
+
+    def _write(self, i, features, source, forests):
+        """Appends the features of instance i, a first pass writes the instances in order starting from 0"""
+        self._nb_instances = max(self._nb_instances, i + 1)
+        if self._writer is None:
+            if i != 0:
+                return
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            if os.path.exists(self._path(CACHE_KEY)):
+                os.remove(self._path(CACHE_KEY))  # the old cache is not valid anymore
+            self._writer = ForestStoreWriter(self._path(CACHE_STORE))
+        if i != len(self._writer):
+            return
+        parts = [source.encode('utf-8')]
+        for forest in forests:
+            forest = compile_forest(forest)
+            parts.extend([_encode_matrix(features.matrix(forest)), _encode_blocks(features.blocks(forest))])
+        lengths = struct.pack('<%dQ' % len(parts), *[len(part) for part in parts])
+        self._writer.append_bytes(b''.join([_COUNT.pack(len(parts)), lengths] + [_padded(part) for part in parts]))
+
+    def finish(self):
+        """Ends the first pass over the stream, the cache is used from then on if no instance was skipped"""
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        nb_records = len(writer)
+        writer.close()
+        if nb_records != self._nb_instances:
+            return
+        with open(self._path(FEATURE_NAMES), "wb") as f:
+            pickle.dump(list(self.feature_index.names), f)
+        with open(self._path(CACHE_KEY), "wb") as f:  # written last: it marks the cache as complete
+            pickle.dump(self.key, f)
+        self._open()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -1,5 +1,6 @@
 import pickle
 import re
+import numpy as np
 
 class WordEmbeddings():
 
@@ -23,6 +24,18 @@ class WordEmbeddings():
         word_id = self.word2id[word]
         return self.id2cluster[word_id]
 
+    # Returns the ids of a list of words (each word is normalized once).
+    def get_ids(self, words):
+        return np.array([self.word2id[self._normalize(word)] for word in words], dtype=np.int64)
+
+    # Returns the embeddings of a list of word ids as a matrix.
+    def get_matrix(self, ids):
+        return self.embeddings[ids]
+
+    # Returns the cluster indices of a list of word ids.
+    def get_cluster_ids(self, ids):
+        return [self.id2cluster[word_id] for word_id in ids]
+
     def dim(self):
         return self.emb_dim
 
@@ -73,3 +86,36 @@ class WordEmbeddings():
       if index != 1e12:
         return w
       return word
+
+
+class WordTable():
+    """
+    The embeddings and clusters of a set of words (e.g. the words of a batch) resolved at once: each word is
+    normalized once and the embeddings are gathered with a single indexing operation. It has the lookup methods
+    of WordEmbeddings, words that were not in the set are looked up (and kept) on demand.
+    """
+
+    def __init__(self, embeddings, words=()):
+        self.embeddings = embeddings
+        words = sorted(set(words))
+        ids = embeddings.get_ids(words)
+        self.word2vector = dict(zip(words, embeddings.get_matrix(ids)))
+        self.word2cluster = dict(zip(words, embeddings.get_cluster_ids(ids.tolist())))
+
+    def __len__(self):
+        return len(self.word2vector)
+
+    def get(self, word):
+        vector = self.word2vector.get(word, None)
+        if vector is None:
+            vector = self.word2vector[word] = self.embeddings.get(word)
+        return vector
+
+    def get_cluster_id(self, word):
+        cluster = self.word2cluster.get(word, None)
+        if cluster is None:
+            cluster = self.word2cluster[word] = self.embeddings.get_cluster_id(word)
+        return cluster
+
+    def dim(self):
+        return self.embeddings.dim()
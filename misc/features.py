@@ -1,35 +1,164 @@
-from lib.libitg import Span, Nonterminal, Rule
+import numpy as np
+from scipy.sparse import csr_matrix
+from lib.libitg import Span, Nonterminal
 
-class Features():
+
+class FeatureIndex():
+    """
+    A registry of feature names, it assigns dense integer ids in order of first appearance.
+    """
 
     def __init__(self):
-        self.edge2fmap = dict()
+        self.name2id = dict()
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2id
+
+    def get_id(self, name, add=True):
+        """Returns the id of a feature name, registering it if necessary (or returning None if add is False)"""
+        feature_id = self.name2id.get(name, None)
+        if feature_id is None and add:
+            feature_id = len(self.names)
+            self.name2id[name] = feature_id
+            self.names.append(name)
+        return feature_id
+
+    def name(self, feature_id):
+        return self.names[feature_id]
+
+    def block_ids(self, prefix, dim) -> np.ndarray:
+        """Returns the ids of the features prefix0, ..., prefix<dim-1> of a dense block (registered if necessary)"""
+        return np.array([self.get_id('%s%d' % (prefix, i)) for i in range(dim)], dtype=np.int64)
+
+
+class DenseBlock():
+    """
+    Dense features of some edges of a forest: values (a rows x dim array) holds the features of the edges `rows`
+    over the feature ids `ids` (e.g. the dimensions of an embedding)
+    """
+
+    def __init__(self, ids: np.ndarray, rows: np.ndarray, values: np.ndarray):
+        self.ids = ids
+        self.rows = rows
+        self.values = values
+
+
+class Features():
+    """
+    Feature matrices (edges x features) of compiled forests, rows follow the edge ids of each forest
+    and columns the ids of a shared FeatureIndex.
+
+    A forest has a sparse matrix of indicator-like features and dense blocks: a feature map value that is an array
+    (e.g. an embedding) under a prefix is stored in a DenseBlock over the features prefix0, prefix1, ...
+    """
+
+    def __init__(self, index=None):
+        self.index = index if index is not None else FeatureIndex()
+        self.forest2matrix = dict()
+        self.forest2blocks = dict()
+        self.forest2edge_ids = dict()  # reference forest -> {(head, tails): edge id}, see edge_rows
+
+    def make_matrix(self, fmaps) -> csr_matrix:
+        """Builds a CSR matrix from a list of feature maps (one per edge), registering unseen feature names"""
+        indptr = [0]
+        indices = []
+        data = []
+        for fmap in fmaps:
+            for feature_name, feature_value in fmap.items():
+                if type(feature_value) is np.ndarray:  # see make_blocks
+                    continue
+                indices.append(self.index.get_id(feature_name))
+                data.append(feature_value)
+            indptr.append(len(indices))
+        return csr_matrix((np.array(data, dtype=float), np.array(indices, dtype=np.int64), np.array(indptr)),
+                          shape=(len(fmaps), len(self.index)))
+
+    def make_blocks(self, fmaps) -> list:
+        """Builds the dense blocks of a list of feature maps (one per edge) from their array values"""
+        block_rows = dict()
+        for row, fmap in enumerate(fmaps):
+            for feature_name, feature_value in fmap.items():
+                if type(feature_value) is np.ndarray:
+                    block_rows.setdefault(feature_name, []).append(row)
+        blocks = []
+        for prefix, rows in block_rows.items():
+            values = np.array([fmaps[row][prefix] for row in rows], dtype=float)
+            blocks.append(DenseBlock(self.index.block_ids(prefix, values.shape[1]), np.array(rows, dtype=np.int64),
+                                     values))
+        return blocks
+
+    def add(self, forest, matrix: csr_matrix, blocks=()):
+        """Stores the feature matrix (and dense blocks) of a compiled forest"""
+        assert matrix.shape[0] == forest.nb_edges(), 'I expected one row per edge'
+        self.forest2matrix[forest] = matrix
+        self.forest2blocks[forest] = list(blocks)
+
+    def matrix(self, forest) -> csr_matrix:
+        """Returns the sparse feature matrix of a compiled forest"""
+        return self.forest2matrix[forest]
 
-    def _extract_rule_repr(self, rule):
-        lhs = rule.lhs
-        rhs = list(rule.rhs)
+    def blocks(self, forest) -> list:
+        """Returns the dense blocks of a compiled forest"""
+        return self.forest2blocks.get(forest, [])
 
-        # Remove bispans from the lhs.
-        if isinstance(rule.lhs, Span):
-            s, _, _ = rule.lhs.obj()
-            if isinstance(s, Span) or s == Nonterminal("D(x)"):
-                lhs = s
+    def feature_ids(self, forest) -> np.ndarray:
+        """Returns the ids of the features that fire in a compiled forest"""
+        return np.unique(np.concatenate([self.matrix(forest).indices] +
+                                        [block.ids for block in self.blocks(forest)]))
 
-        # And the same for the rhs.
-        for i in range(len(rule.rhs)):
-            if isinstance(rule.rhs[i], Span):
-                s, _, _ = rule.rhs[i].obj()
-                if isinstance(s, Span):
-                        rhs[i] = s
+    def edge_scores(self, forest, parameters: np.ndarray) -> np.ndarray:
+        """Scores every edge of a compiled forest: a sparse mat-vec plus a dense mat-vec per block"""
+        matrix = self.matrix(forest)
+        scores = matrix.dot(parameters[:matrix.shape[1]])
+        for block in self.blocks(forest):
+            scores[block.rows] += block.values.dot(parameters[block.ids])
+        return scores
 
-        new_rule = Rule(lhs, tuple(rhs))
-        return new_rule
+    def full_matrix(self, forest) -> csr_matrix:
+        """Returns the features of a compiled forest (dense blocks included) as a single sparse matrix"""
+        matrix = self.matrix(forest).tocoo()
+        blocks = self.blocks(forest)
+        rows = np.concatenate([matrix.row] + [np.repeat(block.rows, len(block.ids)) for block in blocks])
+        columns = np.concatenate([matrix.col] + [np.tile(block.ids, len(block.rows)) for block in blocks])
+        data = np.concatenate([matrix.data] + [block.values.ravel() for block in blocks])
+        return csr_matrix((data, (rows, columns)), shape=(matrix.shape[0], len(self.index)))
 
-    def add(self, edge, fmap):
-        key = self._extract_rule_repr(edge)
-        self.edge2fmap[key] = fmap
+    def _edge_ids(self, reference_forest) -> dict:
+        """Edges of a compiled forest by (head, tails) node ids, computed once per forest"""
+        edge_ids = self.forest2edge_ids.get(reference_forest, None)
+        if edge_ids is None:
+            heads = reference_forest.heads.tolist()
+            tails = reference_forest.tails.tolist()
+            tail_offsets = reference_forest.tail_offsets.tolist()
+            edge_ids = {(head, tuple(tails[tail_offsets[e]:tail_offsets[e + 1]])): e for e, head in enumerate(heads)}
+            self.forest2edge_ids[reference_forest] = edge_ids
+        return edge_ids
 
-    def get(self, edge):
-        key = self._extract_rule_repr(edge)
-        return self.edge2fmap[key]
+    def edge_rows(self, forest, reference_forest) -> list:
+        """
+        Maps each edge of a forest (e.g. D(x,y)) to the row of its counterpart in a reference forest (e.g. D(x)),
+        edges without a counterpart map to None.
 
+        The counterpart of a node is found by removing its bispan annotation (see get_bispans): LHS nodes are
+        unwrapped when they annotate a span or D(x), RHS nodes when they annotate a span. Nodes are mapped once to
+        ids of the reference forest, and edges are then matched by their node ids.
+        """
+        node_ids = reference_forest.node_ids
+        head_ids = []
+        tail_ids = []
+        for v in range(forest.nb_nodes()):
+            symbol = forest.node(v)
+            inner = symbol.obj()[0] if isinstance(symbol, Span) else None
+            head_ids.append(node_ids.get(inner if isinstance(inner, Span) or inner == Nonterminal("D(x)") else symbol,
+                                         -1))
+            tail_ids.append(node_ids.get(inner if isinstance(inner, Span) else symbol, -1))
+        edge_ids = self._edge_ids(reference_forest)
+        tails = forest.tails.tolist()
+        tail_offsets = forest.tail_offsets.tolist()
+        return [edge_ids.get((head_ids[head], tuple([tail_ids[t] for t in tails[tail_offsets[e]:tail_offsets[e + 1]]])),
+                             None)
+                for e, head in enumerate(forest.heads.tolist())]
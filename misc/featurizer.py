@@ -4,48 +4,126 @@ from lib.libitg import Symbol, Terminal, Nonterminal, Span, Rule, FSA
 
 import lib.libitg as libitg
 from .spans import get_target_word, get_source_word, get_phrase
-from .features import Features
+from .features import Features, FeatureIndex
+from .compiled_forest import compile_forest
+from .embeddings import WordTable
+
+
+class SourceSpans():
+    """
+    Span-level quantities of a source sentence, computed once per span instead of once per edge:
+        * the summed embeddings inside/outside a span are differences of prefix sums of the embedding matrix
+        * feature maps of spans and of binary splits are memoized (many edges share them)
+    """
+
+    def __init__(self, words, embeddings):
+        self.words = words
+        self.embeddings = embeddings  # WordEmbeddings or a WordTable of the words
+        self.prefix_sums = np.zeros((len(words) + 1, embeddings.dim()))
+        if words:
+            np.cumsum([embeddings.get(word) for word in words], axis=0, out=self.prefix_sums[1:])
+        self.span_features = {}  # (start, end) -> feature map
+        self.split_features = {}  # (start1, end1, start2, end2) -> feature map
+
+    def inside(self, start, end) -> np.ndarray:
+        """Sum of the embeddings of the words in [start, end)"""
+        return self.prefix_sums[end] - self.prefix_sums[start]
+
+    def outside(self, start, end) -> np.ndarray:
+        """Sum of the embeddings of the words outside [start, end)"""
+        return self.prefix_sums[-1] - self.inside(start, end)
+
+
+class BatchVocabulary():
+    """
+    Lookups shared by the sentences of a batch: source and target words are resolved once (see WordTable), and
+    the feature maps of terminal rules are memoized by (rule type, source word, target word).
+    """
+
+    def __init__(self, embeddings_ch, embeddings_en, source_words=(), target_words=()):
+        self.ch = WordTable(embeddings_ch, source_words)
+        self.en = WordTable(embeddings_en, target_words)
+        self.terminal_features = {}
+
 
 class Featurizer():
 
     def __init__(self, ibm1_probs, embeddings_ch, embeddings_en, word_class_features=True, \
-            dense_word_emb_features=True, sparse_word_features=True):
+            dense_word_emb_features=True, sparse_word_features=True, feature_index=None):
         self.ibm1_probs = ibm1_probs
         self.embeddings_ch = embeddings_ch
         self.embeddings_en = embeddings_en
         self.word_class_features = word_class_features
         self.dense_word_emb_features = dense_word_emb_features
         self.sparse_word_features = sparse_word_features
+        # shared by all feature matrices this featurizer creates (use the index of the CRF that consumes them)
+        self.feature_index = feature_index if feature_index is not None else FeatureIndex()
 
     def featurize_parse_trees_batch(self, batch):
-        features = Features()
+        features = Features(self.feature_index)
+        vocabulary = self.make_vocabulary([source for _, _, source, _ in batch], [Dx for Dx, _, _, _ in batch])
         for Dx, Dxy, source, target in batch:
-            src_fsa = libitg.make_fsa(source)
-            for edge in Dx:
-                features.add(edge, self._featurize_edge(edge, src_fsa))
-            features.add(Dxy._rules[-1], self._featurize_edge(Dxy._rules[-1], src_fsa))
+            self._featurize_forests(features, Dx, [] if Dxy is None else [Dxy], source, vocabulary)
         return features
 
     def featurize_parse_trees(self, Dx, Dxy, x):
-        src_fsa = libitg.make_fsa(x)
-        features = Features()
-        for edge in Dx:
-            features.add(edge, self._featurize_edge(edge, src_fsa))
-        if Dxy is not None:
-            features.add(Dxy._rules[-1], self._featurize_edge(Dxy._rules[-1], src_fsa))
+        return self.featurize_references(Dx, [] if Dxy is None else [Dxy], x)
+
+    def featurize_references(self, Dx, Dxys, x):
+        """Features of D(x) and of the D(x,y) forests of several references of x (D(x) is featurized once)"""
+        features = Features(self.feature_index)
+        self._featurize_forests(features, Dx, Dxys, x, self.make_vocabulary([x], [Dx]))
         return features
 
-    def _featurize_edge(self, edge, src_fsa):
+    def flags(self) -> tuple:
+        """The settings the features depend on (besides the input data)"""
+        return self.word_class_features, self.dense_word_emb_features, self.sparse_word_features
+
+    def make_vocabulary(self, sentences, forests) -> BatchVocabulary:
+        """Resolves the source words of some sentences and the target words of their D(x) forests at once"""
+        source_words = set(word for x in sentences for word in x.split())
+        target_words = set()
+        for forest in forests:
+            forest = compile_forest(forest)
+            target_words.update(forest.node(v).root().obj() for v in np.flatnonzero(forest.terminal_mask).tolist())
+        return BatchVocabulary(self.embeddings_ch, self.embeddings_en, source_words, target_words)
+
+    def _featurize_forests(self, features, Dx, Dxys, x, vocabulary):
+        """
+        Adds the feature matrices of D(x) and of D(x,y) forests to features. Edges of D(x,y) share the features
+        of their counterparts in D(x) (only the target spans differ), the remaining ones (the top rule) are
+        featurized on their own.
+
+        Embeddings are dense features: a feature map holds them as a single array under the prefix of their
+        names (e.g. fmap["inside-phrase-"] for inside-phrase-0, inside-phrase-1, ...), see Features.make_blocks.
+        """
+        src_fsa = libitg.make_fsa(x)
+        spans = SourceSpans(x.split(), vocabulary.ch)
+        Dx_forest = compile_forest(Dx)
+        Dx_fmaps = [self._featurize_edge(edge, src_fsa, spans, vocabulary) for edge in Dx_forest.rules]
+        features.add(Dx_forest, features.make_matrix(Dx_fmaps), features.make_blocks(Dx_fmaps))
+        for Dxy in Dxys:
+            Dxy_forest = compile_forest(Dxy)
+            rows = features.edge_rows(Dxy_forest, Dx_forest)
+            Dxy_fmaps = [Dx_fmaps[row] if row is not None else self._featurize_edge(edge, src_fsa, spans, vocabulary)
+                         for row, edge in zip(rows, Dxy_forest.rules)]
+            features.add(Dxy_forest, features.make_matrix(Dxy_fmaps), features.make_blocks(Dxy_fmaps))
+
+    def _featurize_edge(self, edge, src_fsa, spans=None, vocabulary=None):
         fmap = defaultdict(float)
+        if vocabulary is None:
+            vocabulary = BatchVocabulary(self.embeddings_ch, self.embeddings_en)
 
         # Check if the edge represents a binary or unary rule.
         if len(edge.rhs) == 2:
-            self._featurize_binary_rule(edge, src_fsa, fmap)
+            if spans is None:
+                spans = SourceSpans(get_phrase(src_fsa, 0, src_fsa.nb_states()), vocabulary.ch)
+            self._featurize_binary_rule(edge, src_fsa, fmap, spans)
         else:
 
             # Check the type of rule that we're dealing with.
             if edge.rhs[0].is_terminal():
-                self._featurize_terminal_rule(edge, src_fsa, fmap)
+                self._featurize_terminal_rule(edge, src_fsa, fmap, vocabulary)
             elif edge.lhs.obj()[0] != Nonterminal("X"):
                 if not isinstance(edge.lhs, Nonterminal):
                     self._featurize_start_rule(edge, src_fsa, fmap)
@@ -66,7 +144,7 @@ class Featurizer():
             elif rhs_symbol == Nonterminal("T"):
                 fmap["type:upgrade_t"] += 1.0
 
-    def _featurize_binary_rule(self, rule, src_fsa, fmap):
+    def _featurize_binary_rule(self, rule, src_fsa, fmap, spans):
         fmap['type:binary'] += 1.0
 
         # here we could have sparse features of the source string as a function of spans being concatenated
@@ -84,61 +162,82 @@ class Featurizer():
             else:
                 fmap["binary:monotone"] += 1.0
 
-            # Use the inside span of X rules to represent phrases, we use
-            # average representations of word vectors for this.
-            src_inside_phrase = get_phrase(src_fsa, lhs_start, lhs_end)
-            assert len(src_inside_phrase) > 0
-            inside_repr = np.zeros(self.embeddings_ch.dim())
-            for word in src_inside_phrase:
-                inside_repr += self.embeddings_ch.get(word)
-
-            for dim, val in enumerate(inside_repr):
-                fmap["inside-phrase-%d" % dim] = val
-
-            # Add a representation for the outside phrase.
-            src_outside_phrase = get_phrase(src_fsa, 0, lhs_start) + \
-                    get_phrase(src_fsa, lhs_end, src_fsa.nb_states())
-            if len(src_outside_phrase) > 0:
-                outside_repr = np.zeros(self.embeddings_ch.dim())
-                for word in src_outside_phrase:
-                    outside_repr += self.embeddings_ch.get(word)
-
-                for dim, val in enumerate(outside_repr):
-                    fmap["outside-phrase-%d" % dim] = val
-
-            # Add skip-gram features for the rhs.
-            rhs_phrase = get_phrase(src_fsa, rhs_start_1, rhs_end_1) + \
-                    get_phrase(src_fsa, rhs_start_2, rhs_end_2)
-            for i in range(len(rhs_phrase)):
-                for j in range(i+1, len(rhs_phrase)):
-                    fmap["skip-gram:%s/%s" % (rhs_phrase[i], rhs_phrase[j])] += 1.0
-
-            # Add skip-gram word class features for the rhs.
-            if self.word_class_features:
-                rhs_word_classes = [self.embeddings_ch.get_cluster_id(word) for word in rhs_phrase]
-                for i in range(len(rhs_word_classes)):
-                    for j in range(i+1, len(rhs_word_classes)):
-                        fmap["skip-gram:word-classes:%d/%d" % (rhs_word_classes[i], rhs_word_classes[j])] += 1.0
+            # Features of the source span and of its split, shared by all the edges with the same spans.
+            span_fmap = spans.span_features.get((lhs_start, lhs_end), None)
+            if span_fmap is None:
+                span_fmap = spans.span_features[lhs_start, lhs_end] = self._featurize_span(spans, lhs_start, lhs_end)
+            fmap.update(span_fmap)
+            split = (rhs_start_1, rhs_end_1, rhs_start_2, rhs_end_2)
+            split_fmap = spans.split_features.get(split, None)
+            if split_fmap is None:
+                split_fmap = spans.split_features[split] = self._featurize_split(spans, *split)
+            fmap.update(split_fmap)
 
             # Add source span length features.
             source_span_len = lhs_end - lhs_start
             fmap["source-span-len-%d" % source_span_len] += 1.0
 
+    def _featurize_span(self, spans, start, end):
+        fmap = defaultdict(float)
+
+        # Use the inside span of X rules to represent phrases, we use
+        # average representations of word vectors for this.
+        assert end > start
+        fmap["inside-phrase-"] = spans.inside(start, end)
+
+        # Add a representation for the outside phrase.
+        if end - start < len(spans.words):
+            fmap["outside-phrase-"] = spans.outside(start, end)
+        return fmap
+
+    def _featurize_split(self, spans, start_1, end_1, start_2, end_2):
+        fmap = defaultdict(float)
+
+        # Add skip-gram features for the rhs.
+        rhs_phrase = spans.words[start_1:end_1] + spans.words[start_2:end_2]
+        for i in range(len(rhs_phrase)):
+            for j in range(i+1, len(rhs_phrase)):
+                fmap["skip-gram:%s/%s" % (rhs_phrase[i], rhs_phrase[j])] += 1.0
+
+        # Add skip-gram word class features for the rhs.
+        if self.word_class_features:
+            rhs_word_classes = [spans.embeddings.get_cluster_id(word) for word in rhs_phrase]
+            for i in range(len(rhs_word_classes)):
+                for j in range(i+1, len(rhs_word_classes)):
+                    fmap["skip-gram:word-classes:%d/%d" % (rhs_word_classes[i], rhs_word_classes[j])] += 1.0
+        return fmap
+
     def _featurize_start_rule(self, rule, src_fsa, fmap):
         fmap["top"] += 1.0
 
-    def _featurize_terminal_rule(self, rule, src_fsa, fmap):
+    def _featurize_terminal_rule(self, rule, src_fsa, fmap, vocabulary):
         fmap["type:terminal"] += 1.0
 
         lhs_symbol, lhs_start, lhs_end = rule.lhs.obj()
         rhs_symbol, rhs_start, rhs_end = rule.rhs[0].obj()
 
+        # The other features only depend on the words, they are computed once per batch.
+        if lhs_symbol == Nonterminal("D"):
+            key = (lhs_symbol, get_source_word(src_fsa, lhs_start, lhs_end), None)
+        elif lhs_symbol == Nonterminal("I"):
+            key = (lhs_symbol, None, get_target_word(rhs_symbol))
+        elif lhs_symbol == Nonterminal("T"):
+            key = (lhs_symbol, get_source_word(src_fsa, lhs_start, lhs_end), get_target_word(rhs_symbol))
+        else:
+            return
+        word_fmap = vocabulary.terminal_features.get(key, None)
+        if word_fmap is None:
+            word_fmap = vocabulary.terminal_features[key] = self._featurize_words(vocabulary, *key)
+        fmap.update(word_fmap)
+
+    def _featurize_words(self, vocabulary, lhs_symbol, src_word, tgt_word):
+        fmap = defaultdict(float)
+
         if lhs_symbol == Nonterminal("D"):
             # Deletion of a source word.
             fmap["type:deletion"] += 1.0
 
             # IBM 1 deletion probabilities.
-            src_word = get_source_word(src_fsa, lhs_start, lhs_end)
             fmap["ibm1:del:logprob"] += np.log(self.ibm1_probs[(src_word, "-EPS-")] + 1e-10)
 
             # Sparse deletion feature for specific words.
@@ -147,20 +246,17 @@ class Featurizer():
 
             # Sparse deletion feature for word classes.
             if self.word_class_features and self.sparse_word_features:
-                src_class = self.embeddings_ch.get_cluster_id(src_word)
+                src_class = vocabulary.ch.get_cluster_id(src_word)
                 fmap["del:class:%d" % src_class] += 1.0
 
             # Word embeddings for deletion.
             if self.dense_word_emb_features:
-                ch_emb = self.embeddings_ch.get(src_word)
-                for i in range(self.embeddings_ch.dim()):
-                    fmap["del:emb:dim-%d" % i] = ch_emb[i]
+                fmap["del:emb:dim-"] = vocabulary.ch.get(src_word)
 
         elif lhs_symbol == Nonterminal("I"):
             # Insertion of a target word.
             fmap["type:insertion"] += 1.0
             fmap["target-len"] += 1.0
-            tgt_word = get_target_word(rhs_symbol)
 
             # IBM 1 insertion probability.
             fmap["ibm1:ins:logprob"] += np.log(self.ibm1_probs[("-EPS-", tgt_word)] + 1e-10)
@@ -171,21 +267,17 @@ class Featurizer():
 
             # Sparse insertion feature for word classes.
             if self.word_class_features and self.sparse_word_features:
-                tgt_class = self.embeddings_en.get_cluster_id(tgt_word)
+                tgt_class = vocabulary.en.get_cluster_id(tgt_word)
                 fmap["ins:class:%d" % tgt_class]
 
             # Word embedding for insertion.
             if self.dense_word_emb_features:
-                en_emb = self.embeddings_en.get(tgt_word)
-                for i in range(self.embeddings_ch.dim()):
-                    fmap["ins:emb:dim-%d" % i] = en_emb[i]
+                fmap["ins:emb:dim-"] = vocabulary.en.get(tgt_word)[:vocabulary.ch.dim()]
 
         elif lhs_symbol == Nonterminal("T"):
             # Translation of a source word into a target word.
             fmap["type:translation"] += 1.0
             fmap["target-len"] += 1.0
-            src_word = get_source_word(src_fsa, lhs_start, lhs_end)
-            tgt_word = get_target_word(rhs_symbol)
 
             # IBM 1 translation probabilities.
             fmap["ibm1:x2y:logprob"] += np.log(self.ibm1_probs[(src_word, tgt_word)] + 1e-10)
@@ -199,13 +291,14 @@ class Featurizer():
 
             # Sparse word class translation features.
             if self.word_class_features and self.sparse_word_features:
-                src_class = self.embeddings_ch.get_cluster_id(src_word)
-                tgt_class = self.embeddings_en.get_cluster_id(tgt_word)
+                src_class = vocabulary.ch.get_cluster_id(src_word)
+                tgt_class = vocabulary.en.get_cluster_id(tgt_word)
                 fmap["trans:class:%d/%d" % (src_class, tgt_class)] += 1.0
 
             # Word embeddings of translation pairs.
             if self.dense_word_emb_features:
-                ch_emb = self.embeddings_ch.get(src_word)
-                en_emb = self.embeddings_en.get(tgt_word)
-                for i in range(self.embeddings_ch.dim()):
-                    fmap["trans:emb:dim-%d" % i] = ch_emb[i] - en_emb[i]
+                ch_emb = vocabulary.ch.get(src_word)
+                en_emb = vocabulary.en.get(tgt_word)
+                dim = vocabulary.ch.dim()
+                fmap["trans:emb:dim-"] = ch_emb[:dim] - en_emb[:dim]
+        return fmap
@@ -0,0 +1,166 @@
+# This file contains a single-file container of training records (Dx, Dxy, source, target) with an offset index.
+#
+# Layout of a store:
+#     header: MAGIC
+#     records: [length: uint64][payload: pickled record] ...
+#     footer: [offsets: uint64 * nb_records][nb_records: uint64][index offset: uint64][INDEX_MAGIC]
+#
+# Records are length-prefixed, thus the index can be rebuilt by scanning the records when the footer is missing
+# (e.g. the writer crashed before closing the store).
+import os
+import mmap
+import struct
+import dill as pickle
+import numpy as np
+
+MAGIC = b'FSTORE1\n'
+INDEX_MAGIC = b'FSINDEX\n'
+_LENGTH = struct.Struct('<Q')
+_FOOTER = struct.Struct('<QQ8s')
+
+
+def _read_offsets(f) -> np.ndarray:
+    """Returns the offsets of the records of an open store (rebuilding the index if there is no footer)"""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a forest store: %s' % f.name)
+    if size >= len(MAGIC) + _FOOTER.size:
+        f.seek(size - _FOOTER.size)
+        nb_records, index_offset, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+        if magic == INDEX_MAGIC and index_offset + 8 * nb_records + _FOOTER.size == size:
+            f.seek(index_offset)
+            return np.frombuffer(f.read(8 * nb_records), dtype='<u8').astype(np.int64)
+    # no (valid) footer: scan complete records
+    offsets = []
+    position = len(MAGIC)
+    f.seek(position)
+    while position + _LENGTH.size <= size:
+        length, = _LENGTH.unpack(f.read(_LENGTH.size))
+        if position + _LENGTH.size + length > size:
+            break  # truncated record
+        offsets.append(position)
+        position += _LENGTH.size + length
+        f.seek(position)
+    return np.array(offsets, dtype=np.int64)
+
+
+class ForestStoreWriter():
+    """
+    Appends records to a store, the index is written when the store is closed.
+    """
+
+    def __init__(self, path, keep_records=None):
+        """
+        :param path: the store file
+        :param keep_records: if set, resume writing after the first keep_records records of the (existing) store
+        """
+        self.path = path
+        self.offsets = []
+        if keep_records is not None:
+            if not os.path.exists(path):
+                raise ValueError('I expected a store to resume in %s' % path)
+            self._file = open(path, 'r+b')
+            offsets = _read_offsets(self._file)
+            if len(offsets) < keep_records:
+                raise ValueError('I expected at least %d records in %s, found %d' % (keep_records, path, len(offsets)))
+            self.offsets = offsets[:keep_records].tolist()
+            # everything after the kept records (including an old index) is dropped
+            self._file.seek(offsets[keep_records] if keep_records < len(offsets) else self._end_of_records(offsets))
+            self._file.truncate()
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC)
+
+    def _end_of_records(self, offsets):
+        if len(offsets) == 0:
+            return len(MAGIC)
+        self._file.seek(offsets[-1])
+        length, = _LENGTH.unpack(self._file.read(_LENGTH.size))
+        return offsets[-1] + _LENGTH.size + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, record):
+        """Appends a record, typically a tuple (Dx, Dxy, source, target)"""
+        self.append_bytes(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def append_bytes(self, payload: bytes):
+        """Appends a record that has already been pickled"""
+        self.offsets.append(self._file.tell())
+        self._file.write(_LENGTH.pack(len(payload)))
+        self._file.write(payload)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        index_offset = self._file.tell()
+        self._file.write(np.array(self.offsets, dtype='<u8').tobytes())
+        self._file.write(_FOOTER.pack(len(self.offsets), index_offset, INDEX_MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ForestStore():
+    """
+    Read access to a store: random access with store[i] and sequential streaming by iterating over the store.
+    With memory_map=True records can also be accessed without copies through record_view.
+    """
+
+    def __init__(self, path, memory_map=False):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.offsets = _read_offsets(self._file)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if memory_map else None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_bytes(self, i) -> bytes:
+        """Returns the pickled record i"""
+        self._file.seek(self.offsets[i])
+        length, = _LENGTH.unpack(self._file.read(_LENGTH.size))
+        return self._file.read(length)
+
+    def record_view(self, i) -> memoryview:
+        """Returns record i as a read-only view of the memory map (pages are shared by all readers of the store)"""
+        offset = int(self.offsets[i])
+        length, = _LENGTH.unpack_from(self._map, offset)
+        return memoryview(self._map)[offset + _LENGTH.size:offset + _LENGTH.size + length]
+
+    def __getitem__(self, i):
+        return pickle.loads(self.read_bytes(i))
+
+    def __iter__(self):
+        """Streams records in order (a single sequential read of the file)"""
+        if len(self.offsets) == 0:
+            return
+        with open(self.path, 'rb') as f:  # a handle of its own, so that random access can be interleaved
+            f.seek(self.offsets[0])
+            for _ in range(len(self.offsets)):
+                length, = _LENGTH.unpack(f.read(_LENGTH.size))
+                yield pickle.loads(f.read(length))
+
+    def close(self):
+        self._file.close()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # views of records are still alive, the map is released together with them
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,49 @@
+# This file contains an LRU cache of the compiled source grammars of a lexicon
+from collections import OrderedDict
+import lib.libitg as libitg
+from lib.compiled_grammar import CompiledGrammar
+
+
+class SourceGrammarCache():
+    """
+    The finite source ITG (make_source_side_finite_itg) of a sentence only depends on which lexicon entries appear
+    in it, thus grammars are compiled once per frozen set of source words and the `max_size` most recently used
+    ones are kept.
+    """
+
+    def __init__(self, lexicon, max_size=1024, eps_str='-EPS-'):
+        self.lexicon = lexicon
+        self.max_size = max_size
+        self.eps_str = eps_str
+        self._grammars = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._grammars)
+
+    def key(self, words) -> frozenset:
+        """The lexicon entries among the words (-EPS- is always part of a sub-lexicon)"""
+        return frozenset(w for w in words if w in self.lexicon and w != self.eps_str)
+
+    def sub_lexicon(self, key) -> dict:
+        entries = sorted(key) + [self.eps_str]  # sorted: the rule order does not depend on hashing
+        return {w: self.lexicon[w] for w in entries if w in self.lexicon}
+
+    def get(self, words) -> CompiledGrammar:
+        """Returns the compiled grammar of a sentence given as a list of words"""
+        key = self.key(words)
+        grammar = self._grammars.get(key, None)
+        if grammar is not None:
+            self.hits += 1
+            self._grammars.move_to_end(key)
+            return grammar
+        self.misses += 1
+        grammar = CompiledGrammar(libitg.make_source_side_finite_itg(self.sub_lexicon(key)))
+        self._grammars[key] = grammar
+        if len(self._grammars) > self.max_size:
+            self._grammars.popitem(last=False)  # least recently used
+        return grammar
+
+    def clear(self):
+        self._grammars.clear()
@@ -4,8 +4,19 @@ import lib.libitg as libitg
 
 from collections import defaultdict
 from lib.libitg import Terminal, Nonterminal
+from misc.grammar_cache import SourceGrammarCache
+from misc.forest_store import ForestStore
+from misc.itg_parser import cky_finite_itg, bitext_finite_itg
+from misc.projected_forest import ProjectedForest
 from time import strftime, localtime
 
+# name of the single-file store written by parse_training_data.py
+FOREST_STORE = "forests.store"
+
+# LRU caches of compiled source grammars, one per lexicon (see source_grammar)
+_grammar_caches = {}
+MAX_SOURCE_GRAMMARS = 1024
+
 def load_lexicon(lexicon_file, top_n=5):
     lexicon = defaultdict(set)
     with open(lexicon_file) as f:
@@ -51,6 +62,19 @@ def log_info(log_string):
     print("%s [INFO]: %s" % (time_string, log_string))
 
 def load_parse_trees(parse_tree_dir):
+    """
+    Yields (Dx, Dxy, chinese, english) records, parse_tree_dir is either a forest store, a directory containing
+    one or an old-style directory with one pickle per forest (Dx/<n>, Dxy/<n>).
+    Stores written by parse_training_data.py hold BinaryForest objects: loading them skips the interning of
+    symbols and rules, which only happens for the parts of a forest that are accessed.
+    """
+    store_file = parse_tree_dir if os.path.isfile(parse_tree_dir) else os.path.join(parse_tree_dir, FOREST_STORE)
+    if os.path.exists(store_file):
+        with ForestStore(store_file) as store:
+            for record in store:
+                yield record
+        return
+
     dx_dir = os.path.join(parse_tree_dir, "Dx")
     dxy_dir = os.path.join(parse_tree_dir, "Dxy")
     english_filename = os.path.join(parse_tree_dir, "english")
@@ -75,29 +99,105 @@ def load_parse_trees(parse_tree_dir):
             idx += 1
             yield (Dx, Dxy, ch_sentence[:-1], en_sentence[:-1])
 
-def load_dev_data(filename, lexicon, return_Dxy=False, max_Dxy=None):
+def source_grammar_cache(lexicon):
+    """Returns the LRU cache of compiled source grammars of a lexicon (see SourceGrammarCache)"""
+    cache = _grammar_caches.get(id(lexicon), None)
+    if cache is None or cache.lexicon is not lexicon:  # the cache holds its lexicon, thus ids are not reused
+        cache = _grammar_caches[id(lexicon)] = SourceGrammarCache(lexicon, MAX_SOURCE_GRAMMARS)
+    return cache
+
+def source_grammar(chinese, lexicon):
+    """
+    Returns the finite source ITG of a sentence compiled for earley (see CompiledGrammar), sentences sharing their
+    vocabulary share their grammar
+    """
+    return source_grammar_cache(lexicon).get(chinese.split())
+
+def parse_source(chinese, lexicon, parser="earley", pruning=None, lazy=False):
+    """
+    Returns the forest D(x) of a source sentence
+    :param parser: "earley" (general CFG x FSA intersection, with the compiled source grammar of source_grammar),
+        "earley-plain" (the same intersection with Item objects on the CFG of make_source_side_finite_itg,
+        neither compiled nor cached, i.e. the unoptimized baseline) or "cky" (bottom-up parser for the finite ITG
+        over a sentence, see cky_finite_itg), they all yield the same forest
+    :param pruning: a Pruning object, only its max_inversion_width applies to D(x)
+    :param lazy: if True, returns a ProjectedForest (translations and inversions are not materialized as rules)
+    """
+    if parser == "cky":
+        sub_lexicon = {k:lexicon[k] for k in chinese.split() + ["-EPS-"] if k in lexicon}
+        _Dx = cky_finite_itg(sub_lexicon, chinese)
+    elif parser == "earley":
+        src_grammar = source_grammar(chinese, lexicon)
+
+        # Create an FSA for the source sentence and parse the source sentence.
+        src_fsa = libitg.make_fsa(chinese)
+        _Dx = libitg.earley(src_grammar, src_fsa, start_symbol=Nonterminal('S'), \
+                sprime_symbol=Nonterminal("D(x)"), clean=True)
+    elif parser == "earley-plain":
+        sub_lexicon = {k:lexicon[k] for k in chinese.split() + ["-EPS-"] if k in lexicon}
+        src_cfg = libitg.make_source_side_finite_itg(sub_lexicon)
+        src_fsa = libitg.make_fsa(chinese)
+        _Dx = libitg.earley(src_cfg, src_fsa, start_symbol=Nonterminal('S'), \
+                sprime_symbol=Nonterminal("D(x)"), clean=True)
+    else:
+        raise ValueError("Unknown parser: %s" % parser)
+    max_inversion_width = None if pruning is None else pruning.max_inversion_width
+    if lazy:
+        return ProjectedForest(_Dx, lexicon, max_inversion_width=max_inversion_width)
+    return libitg.make_target_side_itg(_Dx, lexicon, max_inversion_width=max_inversion_width)
+
+def parse_target(Dx, chinese, english, lexicon, parser="earley", pruning=None):
+    """
+    Returns the forest D(x,y) of a sentence pair given D(x)
+    :param parser: "earley" (intersects D(x) with the target sentence), "earley-plain" (the same intersection
+        with Item objects, the unoptimized baseline) or "cky" (parses the bitext directly, see bitext_finite_itg,
+        D(x) is not used), they all yield the same forest
+    :param pruning: a Pruning object (D(x) must have been parsed with the same one), max_complete is only supported
+        by earley
+    """
+    if parser == "cky":
+        if pruning is None:
+            return bitext_finite_itg(lexicon, chinese, english)
+        if pruning.max_complete is not None:
+            raise ValueError("max_complete pruning requires the earley parser")
+        return bitext_finite_itg(lexicon, chinese, english, max_inversion_width=pruning.max_inversion_width,
+                                 cell_mask=pruning.cell_mask(chinese, english))
+    elif parser == "earley":
+        # Create a target FSA and D(x, y)
+        tgt_fsa = libitg.make_fsa(english)
+        max_complete = None if pruning is None else pruning.max_complete
+        prune = None if pruning is None else pruning.earley_filter(chinese, english)
+        return libitg.earley(Dx, tgt_fsa, start_symbol=Nonterminal("D(x)"), \
+                sprime_symbol=Nonterminal('D(x,y)'), clean=True, compact=True, max_complete=max_complete, prune=prune)
+    elif parser == "earley-plain":
+        if pruning is not None:
+            raise ValueError("earley-plain does not support pruning")
+        tgt_fsa = libitg.make_fsa(english)
+        return libitg.earley(Dx, tgt_fsa, start_symbol=Nonterminal("D(x)"), \
+                sprime_symbol=Nonterminal('D(x,y)'), clean=True)
+    else:
+        raise ValueError("Unknown parser: %s" % parser)
+
+def parse_training_instance(chinese, english, lexicon, parser="earley", pruning=None):
+    """Returns the forests D(x) and D(x,y) of a training instance (see parse_source and parse_target for the parser)"""
+    Dx = parse_source(chinese, lexicon, parser, pruning)
+    Dxy = parse_target(Dx, chinese, english, lexicon, parser, pruning)
+    return Dx, Dxy
+
+def load_dev_data(filename, lexicon, return_Dxy=False, max_Dxy=None, parser="earley", pruning=None, lazy=False):
     with open(filename) as f:
         for line in f:
             splits = line.split(" ||| ")
             chinese = splits[0]
             references = splits[1:]
-            sub_lexicon = {k:lexicon[k] for k in chinese.split() + ["-EPS-"] if k in lexicon}
-            src_cfg = libitg.make_source_side_finite_itg(sub_lexicon)
-
-            # Create an FSA for the source sentence and parse the source sentence.
-            src_fsa = libitg.make_fsa(chinese)
-            _Dx = libitg.earley(src_cfg, src_fsa, start_symbol=Nonterminal('S'), \
-                    sprime_symbol=Nonterminal("D(x)"), clean=True)
-            Dx = libitg.make_target_side_itg(_Dx, lexicon)
+            Dx = parse_source(chinese, lexicon, parser, pruning, lazy)
 
-            # Create a target FSA and D(x, y) for the ref translations
+            # Create D(x, y) for the ref translations
             if return_Dxy:
                 Dxys = []
                 refs = references if max_Dxy is None else references[:max_Dxy]
                 for ref in refs:
-                    tgt_fsa = libitg.make_fsa(ref)
-                    Dxy = libitg.earley(Dx, tgt_fsa, start_symbol=Nonterminal("D(x)"), \
-                            sprime_symbol=Nonterminal('D(x,y)'), clean=True)
+                    Dxy = parse_target(Dx, chinese, ref, lexicon, parser, pruning)
                     if len(Dxy._rules)>0:
                         Dxys.append(Dxy)
                 yield (chinese, references, Dx, Dxys)
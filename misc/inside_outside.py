@@ -1,48 +1,96 @@
 # This file contains functions for inside and outside values computation
-from lib.libitg import CFG
+from misc.compiled_forest import CompiledForest, compile_forest, compile_edge_weights
 import numpy as np
 
 EPS = 1e-6
 
-def inside_algorithm(forest: CFG, tsort: list, edge_weights: dict) -> dict:
-    """Returns the inside weight of each node in log space"""
-    I = {}  # inside values in log space
-    for i, node in enumerate(tsort):
-        if node.is_terminal():
-            I[node] = np.log(1.)
-            continue
-        temp_inside = 0.
-        # get rules where node appears as head
-        for rule in forest._rules_by_lhs[node]:
-            weight = edge_weights[rule]  # factor in log space
-            inner_sum = weight
-            for rhs_node in rule.rhs:
-                inner_sum += I[rhs_node]
-            temp_inside += np.exp(inner_sum)
-        temp_inside = np.log(temp_inside) if temp_inside > 0. else 0.
-        I[node] = temp_inside
+
+def inside_algorithm(forest: CompiledForest, edge_weights: np.ndarray, reduce_op=np.logaddexp) -> np.ndarray:
+    """
+    Returns the inside weight of each node (indexed by node id, see compile_forest) in log space.
+    Nodes at the same topological depth do not depend on each other, thus a whole level is computed with one
+    reduce_op.reduceat call over the scores of its edges (pass reduce_op=np.maximum for Viterbi).
+    :param forest: a CompiledForest, or a CFG which is compiled first
+    :param edge_weights: indexed by edge id, or a dictionary rule -> weight
+    """
+    forest = compile_forest(forest)
+    edge_weights = compile_edge_weights(forest, edge_weights)
+    edge_offsets = forest.edge_offsets
+    tail_offsets = forest.tail_offsets
+    I = np.where(forest.terminal_mask, 0., -np.inf)  # nodes without incoming edges only derive terminals
+    # level 0 contains exactly the nodes without incoming edges
+    for first, last in zip(forest.level_offsets[1:-1], forest.level_offsets[2:]):
+        e_first, e_last = edge_offsets[first], edge_offsets[last]
+        t_first, t_last = tail_offsets[e_first], tail_offsets[e_last]
+        # score of each edge: its weight times the inside of its tails (all tails live in lower levels)
+        scores = edge_weights[e_first:e_last] + \
+            np.add.reduceat(I[forest.tails[t_first:t_last]], tail_offsets[e_first:e_last] - t_first)
+        # every node in the level has at least one edge, so no reduceat segment is empty
+        I[first:last] = reduce_op.reduceat(scores, edge_offsets[first:last] - e_first)
     return I
 
 
-def outside_algorithm(forest: CFG, tsort:list, edge_weights: dict, inside: dict) -> dict:
-    """Returns the outside weight of each node in log space"""
-    O = {}  # outside values
-    for i, node in enumerate(reversed(tsort)):
-        # check if the node is root, assuming that it appears fist
-        if i == 0:
-            O[node] = np.log(1.)
-            continue
-        temp_outside = 0.
-        # get rules where node appears as child
-        for rule in forest._rules_by_rhs[node]:
-            w = edge_weights[rule]
-            inner_sum = O[rule._lhs] + w
-            for rhs_node in rule._rhs:
-                if rhs_node == node:
-                    continue
-                inner_sum += inside[rhs_node]
-            temp_outside += np.exp(inner_sum)
-        temp_outside = np.log(temp_outside) if temp_outside > 0. else 0
-        O[node] = temp_outside
+def outside_algorithm(forest: CompiledForest, edge_weights: np.ndarray, inside: np.ndarray) -> np.ndarray:
+    """
+    Returns the outside weight of each node (indexed by node id) in log space.
+    Levels are visited from the root down: the edges of a level only pass outside weight to lower levels,
+    thus each level is handled with one np.logaddexp.at call over the tails of its edges.
+    :param forest: a CompiledForest, or a CFG which is compiled first (see inside_algorithm)
+    """
+    forest = compile_forest(forest)
+    O = np.full(forest.nb_nodes(), -np.inf)
+    if forest.nb_edges() == 0:
+        return O
+    O[forest.root] = 0.
+    edge_offsets = forest.edge_offsets
+    tail_offsets = forest.tail_offsets
+    # edge scores without the outside weight of the head, and the edge of each tail occurrence
+    edge_scores = compile_edge_weights(forest, edge_weights) + forest.tail_sum(inside)
+    tail_edges = np.repeat(np.arange(forest.nb_edges()), np.diff(tail_offsets))
+    for first, last in reversed(list(zip(forest.level_offsets[1:-1], forest.level_offsets[2:]))):
+        t_first, t_last = tail_offsets[edge_offsets[first]], tail_offsets[edge_offsets[last]]
+        edges = tail_edges[t_first:t_last]
+        tails = forest.tails[t_first:t_last]
+        # outside of the head times the edge weight times the inside of the siblings
+        with np.errstate(invalid='ignore'):
+            contributions = O[forest.heads[edges]] + edge_scores[edges] - inside[tails]
+        # a tail without derivations (inside -inf) yields nan, but it cannot take part in any derivation anyway
+        contributions[np.isnan(contributions)] = -np.inf
+        np.logaddexp.at(O, tails, contributions)
     return O
 
+
+def edge_posteriors(forest: CompiledForest, edge_weights: np.ndarray, inside: np.ndarray,
+                    outside: np.ndarray) -> np.ndarray:
+    """Returns the posterior probability of each edge (indexed by edge id)"""
+    forest = compile_forest(forest)
+    edge_weights = compile_edge_weights(forest, edge_weights)
+    log_posteriors = outside[forest.heads] + edge_weights + forest.tail_sum(inside) - inside[forest.root]
+    return np.exp(log_posteriors)
+
+
+class InsideOutside():
+    """
+    Result of a fused pass over a compiled forest: the edge weights are computed once by the caller and shared
+    by the inside values, outside values and edge posteriors (which are computed on demand).
+    """
+
+    def __init__(self, forest: CompiledForest, edge_weights: np.ndarray, compute_outside=True):
+        self.forest = forest
+        self.edge_weights = np.asarray(edge_weights, dtype=float)
+        self.inside = inside_algorithm(forest, self.edge_weights)
+        self.log_normalizer = self.inside[forest.root]
+        self.outside = None
+        self._posteriors = None
+        if compute_outside:
+            self.compute_outside()
+
+    def compute_outside(self) -> np.ndarray:
+        if self.outside is None:
+            self.outside = outside_algorithm(self.forest, self.edge_weights, self.inside)
+        return self.outside
+
+    def edge_posteriors(self) -> np.ndarray:
+        if self._posteriors is None:
+            self._posteriors = edge_posteriors(self.forest, self.edge_weights, self.inside, self.compute_outside())
+        return self._posteriors
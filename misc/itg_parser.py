@@ -0,0 +1,328 @@
+# This file contains a bottom-up chart parser for the finite ITG of make_source_side_finite_itg over a sentence
+import numpy as np
+from lib.formal import Terminal, Nonterminal, Span, Rule, CFG
+
+
+def cky_finite_itg(lexicon: dict, sentence: str, s_str='S', x_str='X', t_str='T', d_str='D', i_str='I',
+                   eps_str='-EPS-', sprime_symbol=Nonterminal("D(x)")) -> CFG:
+    """
+    Returns the same (clean) forest as
+        earley(make_source_side_finite_itg(lexicon), make_fsa(sentence), start_symbol=S, sprime_symbol=..., clean=True)
+    without items or an agenda. Over a linear chain every span of the sentence is a possible constituent, thus the
+    chart reduces to span-indexed arrays:
+        * T spans a single word that is a lexicon entry, D spans a block of deletable words (those translating to eps)
+          and I spans the empty string next to a T (if eps is a lexicon entry)
+        * X spans any block whose words are all lexicon entries (every split of it is a binary X rule)
+    Every derivable span is then useful, unless the sentence itself cannot be derived, in which case the forest is
+    empty.
+    """
+    S = Nonterminal(s_str)
+    X = Nonterminal(x_str)
+    T = Nonterminal(t_str)
+    D = Nonterminal(d_str)
+    I = Nonterminal(i_str)
+    words = sentence.split()
+    n = len(words)
+    if eps_str in lexicon.get(eps_str, ()):
+        raise ValueError('Deleting %s yields a cyclic forest, use earley instead' % eps_str)
+
+    # 1. lexical properties of each word
+    translatable = np.array([w in lexicon and w != eps_str for w in words], dtype=bool)  # T -> w
+    deletable = np.array([w in lexicon and eps_str in lexicon[w] for w in words], dtype=bool)  # D -> w
+    insertion = eps_str in lexicon  # I -> eps
+
+    # 2. span-indexed chart: a block i:j is derivable if all of its words are (prefix sums count the others)
+    not_x = np.concatenate(([0], np.cumsum(~(translatable | deletable))))
+    not_d = np.concatenate(([0], np.cumsum(~deletable)))
+    if n == 0 or not_x[n] > 0:
+        return CFG([])  # the sentence cannot be derived
+    is_d = not_d[None, :] - not_d[:, None] == 0  # is_d[i, j] for i < j
+
+    # 3. rules, bottom-up (all spans are derivable and reachable from the root)
+    def iter_rules():
+        terminals = [Span(Terminal(w), i, i + 1) for i, w in enumerate(words)]
+        empty = [Span(Terminal(eps_str), i, i) for i in range(n + 1)]
+        x_spans = {}
+        d_spans = {}
+        i_spans = [Span(I, i, i) for i in range(n + 1)] if insertion else None
+        if insertion:
+            for i in range(n + 1):
+                # an insertion is anchored to a translated word on its left or right
+                if (i > 0 and translatable[i - 1]) or (i < n and translatable[i]):
+                    yield Rule(i_spans[i], [empty[i]])
+        for i in range(n):
+            x = x_spans[i, i + 1] = Span(X, i, i + 1)
+            if translatable[i]:
+                t = Span(T, i, i + 1)
+                yield Rule(t, [terminals[i]])
+                yield Rule(x, [t])
+                if insertion:
+                    yield Rule(x, [t, i_spans[i + 1]])
+                    yield Rule(x, [i_spans[i], t])
+            if deletable[i]:
+                d = d_spans[i, i + 1] = Span(D, i, i + 1)
+                yield Rule(d, [terminals[i]])
+                yield Rule(x, [d])
+        for width in range(2, n + 1):
+            for i in range(n - width + 1):
+                k = i + width
+                x = x_spans[i, k] = Span(X, i, k)
+                for j in range(i + 1, k):
+                    yield Rule(x, [x_spans[i, j], x_spans[j, k]])
+                if is_d[i, k]:
+                    d = d_spans[i, k] = Span(D, i, k)
+                    for j in range(i + 1, k):
+                        yield Rule(d, [d_spans[i, j], d_spans[j, k]])
+                    yield Rule(x, [d])
+        top = Span(S, 0, n)
+        yield Rule(top, [x_spans[0, n]])
+        if sprime_symbol:
+            yield Rule(sprime_symbol, [top])
+
+    return CFG(iter_rules())
+
+
+def bitext_finite_itg(lexicon: dict, source: str, target: str, s_str='S', x_str='X', t_str='T', d_str='D', i_str='I',
+                      eps_str='-EPS-', sprime_symbol=Nonterminal("D(x)"),
+                      goal_symbol=Nonterminal("D(x,y)"), max_inversion_width=None, cell_mask=None) -> CFG:
+    """
+    Returns the same (clean) forest D(x,y) as the two-step path
+        Dx = make_target_side_itg(cky_finite_itg(lexicon, source), lexicon)
+        earley(Dx, make_fsa(target), start_symbol=sprime_symbol, sprime_symbol=goal_symbol, clean=True)
+    by parsing the bitext directly. The chart holds, for every node of D(x) (a source span), a boolean matrix over
+    target spans (a, b) with a <= b (translations into -EPS- span empty target strings):
+        * inside: a binary rule combines the matrices of its children with a boolean matrix product (splits of the
+          source span times splits of the target span, O(n^3 m^3) overall) and inverted rules swap the children
+        * outside: from the root down, only target spans that take part in a complete derivation are kept,
+          the edges of those spans (with derivable children) are exactly the clean forest
+
+    Pruning (see Pruning), the forest is then the one of earley with the same settings:
+    :param max_inversion_width: children are only inverted under source spans of at most this many words
+    :param cell_mask: a boolean array [i, k, a, b] of the target spans a:b allowed for the X/D nodes of source
+        span i:k (the root span is never pruned)
+    """
+    S = Nonterminal(s_str)
+    X = Nonterminal(x_str)
+    T = Nonterminal(t_str)
+    D = Nonterminal(d_str)
+    I = Nonterminal(i_str)
+    words = source.split()
+    targets = target.split()
+    n = len(words)
+    m = len(targets)
+    if eps_str in lexicon.get(eps_str, ()):
+        raise ValueError('Deleting %s yields a cyclic forest, use earley instead' % eps_str)
+
+    # 1. lexical properties of each source word (see cky_finite_itg)
+    translatable = [w in lexicon and w != eps_str for w in words]
+    deletable = [w in lexicon and eps_str in lexicon[w] for w in words]
+    insertion = eps_str in lexicon
+    if n == 0 or not all(t or d for t, d in zip(translatable, deletable)):
+        return CFG([])  # the source cannot be derived
+
+    # 2. inside: target spans each node of D(x) can derive
+    def lexical(translations) -> np.ndarray:
+        matrix = np.zeros((m + 1, m + 1), dtype=bool)
+        for a, y in enumerate(targets):
+            if y != eps_str and y in translations:
+                matrix[a, a + 1] = True
+        if eps_str in translations:
+            np.fill_diagonal(matrix, True)
+        return matrix
+
+    def inverted(width) -> bool:
+        return max_inversion_width is None or width <= max_inversion_width
+
+    def combine(left, right, width) -> np.ndarray:
+        if inverted(width):
+            return (left @ right) | (right @ left)  # monotone and inverted
+        return left @ right
+
+    def prune(matrix, i, k) -> np.ndarray:
+        if cell_mask is None or k - i == n:
+            return matrix
+        return matrix & cell_mask[i, k]
+
+    inside = {}
+    if insertion:
+        insertion_matrix = lexical(lexicon[eps_str])
+        for i in range(n + 1):
+            inside[I, i, i] = insertion_matrix
+    for i, w in enumerate(words):
+        x = np.zeros((m + 1, m + 1), dtype=bool)
+        if translatable[i]:
+            t = inside[T, i, i + 1] = lexical(lexicon[w])
+            x |= t
+            if insertion:
+                x |= combine(t, inside[I, i + 1, i + 1], 1) | combine(inside[I, i, i], t, 1)
+        if deletable[i]:
+            d = inside[D, i, i + 1] = prune(lexical(lexicon[w]), i, i + 1)
+            x |= d
+        inside[X, i, i + 1] = prune(x, i, i + 1)
+    for width in range(2, n + 1):
+        for i in range(n - width + 1):
+            k = i + width
+            x = np.zeros((m + 1, m + 1), dtype=bool)
+            for j in range(i + 1, k):
+                x |= combine(inside[X, i, j], inside[X, j, k], width)
+            if all(deletable[i:k]):
+                d = np.zeros((m + 1, m + 1), dtype=bool)
+                for j in range(i + 1, k):
+                    d |= combine(inside[D, i, j], inside[D, j, k], width)
+                d = inside[D, i, k] = prune(d, i, k)
+                x |= d
+            inside[X, i, k] = prune(x, i, k)
+    if not inside[X, 0, n][0, m]:
+        return CFG([])  # the target cannot be derived
+
+    # 3. outside (top-down) and rules of the useful target spans
+    nodes = {}
+
+    def node(symbol, i, k) -> Span:
+        span = nodes.get((symbol, i, k), None)
+        if span is None:
+            span = nodes[symbol, i, k] = Span(symbol, i, k)
+        return span
+
+    outside = {key: np.zeros((m + 1, m + 1), dtype=bool) for key in inside}
+    rules = []
+
+    def unary(parent, useful, child):
+        for a, b in zip(*[index.tolist() for index in np.nonzero(useful & inside[child])]):
+            rules.append(Rule(Span(node(*parent), a, b), [Span(node(*child), a, b)]))
+        outside[child] |= useful
+
+    def binary(parent, useful, left, right):
+        # parent[a, b] -> left[a, c] right[c, b]
+        left_inside, right_inside = inside[left], inside[right]
+        combinations = useful[:, None, :] & left_inside[:, :, None] & right_inside[None, :, :]
+        for a, c, b in zip(*[index.tolist() for index in np.nonzero(combinations)]):
+            rules.append(Rule(Span(node(*parent), a, b),
+                              [Span(node(*left), a, c), Span(node(*right), c, b)]))
+        outside[left] |= useful @ right_inside.T
+        outside[right] |= left_inside.T @ useful
+
+    def terminal(parent, useful, i, k):
+        for a, b in zip(*[index.tolist() for index in np.nonzero(useful)]):
+            y = targets[a] if b > a else eps_str
+            rules.append(Rule(Span(node(*parent), a, b), [Span(Span(Terminal(y), i, k), a, b)]))
+
+    top = Span(sprime_symbol, 0, m)
+    rules.append(Rule(goal_symbol, [top]))
+    rules.append(Rule(top, [Span(node(S, 0, n), 0, m)]))
+    rules.append(Rule(Span(node(S, 0, n), 0, m), [Span(node(X, 0, n), 0, m)]))
+    outside[X, 0, n][0, m] = True
+    for width in range(n, 0, -1):
+        for i in range(n - width + 1):
+            k = i + width
+            useful = outside[X, i, k] & inside[X, i, k]
+            if width > 1:
+                for j in range(i + 1, k):
+                    binary((X, i, k), useful, (X, i, j), (X, j, k))
+                    if inverted(width):
+                        binary((X, i, k), useful, (X, j, k), (X, i, j))
+            elif translatable[i]:
+                unary((X, i, k), useful, (T, i, k))
+                if insertion:
+                    binary((X, i, k), useful, (T, i, k), (I, k, k))
+                    binary((X, i, k), useful, (I, i, i), (T, i, k))
+                    if inverted(width):
+                        binary((X, i, k), useful, (I, k, k), (T, i, k))
+                        binary((X, i, k), useful, (T, i, k), (I, i, i))
+            if (D, i, k) in inside:
+                unary((X, i, k), useful, (D, i, k))
+                useful = outside[D, i, k] & inside[D, i, k]
+                for j in range(i + 1, k):
+                    binary((D, i, k), useful, (D, i, j), (D, j, k))
+                    if inverted(width):
+                        binary((D, i, k), useful, (D, j, k), (D, i, j))
+    # preterminals
+    for (symbol, i, k), matrix in inside.items():
+        useful = outside[symbol, i, k] & matrix
+        if symbol == T or (symbol == D and k == i + 1) or symbol == I:
+            terminal((symbol, i, k), useful, i, k)
+    return CFG(rules)
+
+
+def ibm1_beam(source: str, target: str, ibm1_probs: dict, beam: int, eps_str='-EPS-', floor=1e-10) -> np.ndarray:
+    """
+    Returns a boolean array allowed[i, k, a, b]: whether a:b is one of the `beam` best target spans of the source
+    span i:k (ties are kept). A pair of spans is scored by IBM1 over the whole sentence pair, the words inside the
+    target span are generated by the words inside the source span and the other words by the other words (both
+    with NULL):
+        log p(y[a:b] | x[i:k]) + log p(y[:a] y[b:] | x[:i] x[k:])
+    thus target spans of different lengths are comparable.
+    """
+    words = source.split()
+    targets = target.split()
+    n = len(words)
+    m = len(targets)
+    # p(y|x) for every target word (rows) and source word (columns), summed over source prefixes
+    probs = np.array([[ibm1_probs.get((x, y), 0.) for x in words] for y in targets]).reshape(m, n)
+    cumulative = np.concatenate((np.zeros((m, 1)), np.cumsum(probs, axis=1)), axis=1)
+    null = np.array([ibm1_probs.get((eps_str, y), 0.) for y in targets])
+    before = np.arange(m + 1)[:, None] <= np.arange(m + 1)[None, :]  # a <= b
+    allowed = np.zeros((n + 1, n + 1, m + 1, m + 1), dtype=bool)
+    for i in range(n):
+        for k in range(i + 1, n + 1):
+            inner = cumulative[:, k] - cumulative[:, i]
+            outer = cumulative[:, n] - inner
+            inner = np.log(np.maximum((inner + null) / (k - i + 1), floor))
+            outer = np.log(np.maximum((outer + null) / (n - (k - i) + 1), floor))
+            inner = np.concatenate(([0.], np.cumsum(inner)))
+            outer = np.concatenate(([0.], np.cumsum(outer)))
+            scores = (inner[None, :] - inner[:, None]) + outer[m] - (outer[None, :] - outer[:, None])
+            scores = np.where(before, scores, -np.inf)
+            if beam < before.sum():
+                threshold = np.partition(scores.ravel(), -beam)[-beam]
+                allowed[i, k] = before & (scores >= threshold)
+            else:
+                allowed[i, k] = before
+    return allowed
+
+
+class Pruning():
+    """
+    Pruning settings shared by the parsers of D(x) and D(x,y), None disables an option:
+        * max_inversion_width: binary rules are only inverted over source spans of at most this many words
+        * beam: the X/D nodes of D(x) (but the root) only derive their `beam` best target spans (see ibm1_beam)
+        * max_complete: Earley keeps at most this many end states per (lhs, start), the first ones found
+    The pruned forests are subsets of the exact ones, some sentence pairs may lose their parse (coverage loss, see
+    benchmark_pruning.py).
+    """
+
+    def __init__(self, max_inversion_width=None, beam=None, ibm1_probs=None, max_complete=None):
+        if beam is not None and ibm1_probs is None:
+            raise ValueError('A beam requires IBM1 probabilities')
+        self.max_inversion_width = max_inversion_width
+        self.beam = beam
+        self.ibm1_probs = ibm1_probs
+        self.max_complete = max_complete
+
+    def __repr__(self):
+        settings = ['%s=%d' % (name, value) for name, value in [('max_inversion_width', self.max_inversion_width),
+                                                              ('beam', self.beam),
+                                                              ('max_complete', self.max_complete)]
+                    if value is not None]
+        return 'Pruning(%s)' % ', '.join(settings)
+
+    def cell_mask(self, source: str, target: str):
+        """The allowed target spans of every source span (see ibm1_beam), None without a beam"""
+        if self.beam is None:
+            return None
+        return ibm1_beam(source, target, self.ibm1_probs, self.beam)
+
+    def earley_filter(self, source: str, target: str, x_str='X', d_str='D'):
+        """The prune function of compact_earley for D(x) x target, None without a beam"""
+        mask = self.cell_mask(source, target)
+        if mask is None:
+            return None
+        n = len(source.split())
+        symbols = {Nonterminal(x_str), Nonterminal(d_str)}
+
+        def prune(lhs, start, end):
+            if not isinstance(lhs, Span):
+                return False
+            symbol, i, k = lhs.obj()
+            return symbol in symbols and k - i < n and not mask[i, k, start, end]
+        return prune
@@ -1,6 +1,6 @@
 import nltk
 import numpy as np
-from scipy.misc import logsumexp
+from misc.compiled_forest import compile_forest, compile_edge_weights
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 
 # A loss function that simply calculates (1 - BLEU(r, c)).
@@ -9,12 +9,12 @@ def bleu_loss(reference, candidate):
             smoothing_function=SmoothingFunction().method7)
 
 # Performs Minimum Bayes Risk decoding using a given loss function.
-# Expects the root of a translation hypergraph together with
-# the inside values for the nodes in the tree.
-def MBR_decoding(forest, root, I, num_samples, loss_fn=bleu_loss):
+# Expects a forest (a CompiledForest, or a CFG that is compiled first) together
+# with its log edge weights and the inside values of its nodes.
+def MBR_decoding(forest, edge_weights, I, num_samples, loss_fn=bleu_loss):
 
     # Do ancestral sampling to get some sample derivations.
-    samples = ancestral_sampling(forest, root, I, num_samples)
+    samples = ancestral_sampling(forest, edge_weights, I, num_samples)
 
     # Calculate the yields of the sampled derivations.
     candidates = [target_yield(sample) for sample in samples]
@@ -28,49 +28,44 @@ def MBR_decoding(forest, root, I, num_samples, loss_fn=bleu_loss):
     # Return the one that has minimum loss.
     return candidates[np.argmin(candidate_loss)]
 
-# Performs ancestral sampling on a forest and returns num_samples
-# derivation samples.
-def ancestral_sampling(forest, root, I, num_samples):
+# Performs ancestral sampling on a forest given its log edge weights and the
+# inside values of its nodes (see MBR_decoding) and returns num_samples
+# derivation samples, lists of rules in depth-first order.
+def ancestral_sampling(forest, edge_weights, I, num_samples):
+    forest = compile_forest(forest)
+    edge_weights = compile_edge_weights(forest, edge_weights)
+
+    # The probability of an edge given its head, computed once for all edges.
+    probs = np.exp(edge_weights + forest.tail_sum(I) - I[forest.heads])
+    cdf = np.cumsum(probs)
+    starts = forest.edge_offsets[:-1]
+    ends = forest.edge_offsets[1:]
+
     samples = []
-    losses = []
     for i in range(num_samples):
-        node_queue = [root]
+        node_stack = [forest.root]
         sample = []
-        while len(node_queue) > 0:
-            cur_node = node_queue[0]
+        while len(node_stack) > 0:
+            cur_node = node_stack.pop()
 
             # There's nothing to expand anymore for terminal nodes.
-            if cur_node.is_terminal():
-                del node_queue[0]
+            if forest.terminal_mask[cur_node]:
                 continue
 
-            # Calculate the probabilities for all possible rhs rules
-            # using the inside values.
-            FS = forest._rules_by_lhs[cur_node]
-            probs = np.array([log_weight_rule(rule, I) for rule in FS])
-            probs -= logsumexp(probs)
-            probs = np.exp(probs)
+            # Sample an edge by inverting the cumulative distribution of the
+            # edges rewriting the current node.
+            first, last = starts[cur_node], ends[cur_node]
+            offset = cdf[first - 1] if first > 0 else 0.
+            u = offset + np.random.uniform() * (cdf[last - 1] - offset)
+            sampled_id = min(np.searchsorted(cdf[first:last], u, side='right') + first, last - 1)
+            sample.append(forest.rules[sampled_id])
 
-            # Sample a rule to use.
-            sampled_id = np.random.choice(np.arange(len(probs)), p=probs)
-            sampled_rule = FS[sampled_id]
-            sample.append(sampled_rule)
-
-            # Add the RHS of the rule to the nodes to expand and remove
-            # the current node from that list. Make sure that we traverse
-            # the tree in depth-first order.
-            del node_queue[0]
-            for idx, node in enumerate(sampled_rule.rhs):
-                node_queue.insert(idx, node)
+            # Traverse the tree in depth-first order.
+            node_stack.extend(reversed(forest.edge_tails(sampled_id).tolist()))
 
         samples.append(sample)
     return samples
 
-# Returns the cumulative inside weights of a rule.
-def log_weight_rule(rule, I):
-    p_prime = np.array([I[node] for node in rule.rhs])
-    return logsumexp(p_prime)
-
 # Returns the target yield of a derivation. Assumes that the rules
 # are derived in depth-first order, so it can go over the list of
 # rules from left-to-right.
@@ -0,0 +1,153 @@
+# This file contains a lazy view of the target-side projection of a source forest (see libitg.make_target_side_itg)
+import numpy as np
+from lib.formal import Span, Rule, CFG
+from misc.binary_forest import LazySequence, BinaryForest, encode_forest
+from misc.compiled_forest import CompiledForest, compile_forest
+
+
+class ProjectedForest(CompiledForest):
+    """
+    The forest D(x) that make_target_side_itg (or make_target_side_finite_itg if finite=True) builds from a source
+    forest, stored as the arrays of a CompiledForest computed from the compiled source forest:
+        * a terminal rule of the source forest becomes one edge per translation of its word
+        * a binary rule becomes a monotone edge and (unless blocked) an inverted edge with swapped tails
+    Node symbols (e.g. translated terminals) and Rule objects are only created when they are accessed, thus
+    inside/Viterbi (which only read the arrays) run without materializing the CFG.
+
+    It can be used where a CFG is expected by earley (rules are iterated) and pickles as a BinaryForest.
+    """
+
+    def __init__(self, source_forest: CFG, lexicon: dict, max_inversion_width=None, finite=False,
+                 d_str='D', i_str='I', eps_str='-EPS-'):
+        source = compile_forest(source_forest)
+        self.source = source
+        # edges: head (source node id), tails (source node ids, or -1-k for the k-th translated terminal)
+        terminals = []  # translated terminals as (source node id, target string)
+        terminal_ids = {}
+        heads = []
+        tails = []
+        arities = []
+        source_edges = []
+        inverted = []
+        source_tails = source.tails.tolist()
+        source_tail_offsets = source.tail_offsets.tolist()
+        is_terminal = source.terminal_mask.tolist()
+        translations = {}  # sorted targets of each source word
+
+        def project(e, head, edge_tails, is_inverted):
+            heads.append(head)
+            tails.extend(edge_tails)
+            arities.append(len(edge_tails))
+            source_edges.append(e)
+            inverted.append(is_inverted)
+
+        for e, head in enumerate(source.heads.tolist()):
+            edge_tails = source_tails[source_tail_offsets[e]:source_tail_offsets[e + 1]]
+            if len(edge_tails) == 1 and is_terminal[edge_tails[0]]:  # translation
+                t = edge_tails[0]
+                x_str = source.node(t).root().obj()
+                targets = translations.get(x_str, None)
+                if targets is None:
+                    targets = translations[x_str] = sorted(lexicon.get(x_str, ()))
+                if finite:  # D rules only delete, other rules do not
+                    is_d = source.node(head).root().obj() == d_str
+                    targets = [y for y in targets if (y == eps_str) == is_d]
+                for y_str in targets:
+                    k = terminal_ids.get((t, y_str), None)
+                    if k is None:
+                        k = terminal_ids[t, y_str] = len(terminals)
+                        terminals.append((t, y_str))
+                    project(e, head, [-1 - k], False)
+            elif len(edge_tails) == 1:
+                project(e, head, edge_tails, False)
+            elif len(edge_tails) == 2:
+                project(e, head, edge_tails, False)  # monotone
+                if self._invertible(source, head, edge_tails, max_inversion_width, finite, d_str, i_str):
+                    project(e, head, edge_tails[::-1], True)  # inverted
+            else:
+                raise ValueError('ITG rules are unary or binary, got %r' % source.rules[e])
+
+        # nodes: translated terminals first, then the nonterminals of the source forest (in topological order)
+        nonterminals = np.flatnonzero(~source.terminal_mask)
+        nb_terminals = len(terminals)
+        new_ids = np.full(source.nb_nodes(), -1, dtype=np.int64)
+        new_ids[nonterminals] = nb_terminals + np.arange(len(nonterminals))
+        tails = np.array(tails, dtype=np.int64)
+        tails = np.where(tails < 0, -1 - tails, new_ids[np.maximum(tails, 0)])
+        heads = new_ids[np.array(heads, dtype=np.int64)]
+        nb_nodes = nb_terminals + len(nonterminals)
+        terminal_mask = np.arange(nb_nodes) < nb_terminals
+        depth = np.concatenate((np.zeros(nb_terminals, dtype=np.int64), source.depth[nonterminals]))
+        # a nonterminal left without edges (e.g. a word without translations) moves down to level 0, the levels of
+        # the other nodes are still upper bounds of their depth
+        has_edges = np.zeros(nb_nodes, dtype=bool)
+        has_edges[heads] = True
+        depth[~(has_edges | terminal_mask)] = 0
+        self._order = np.argsort(depth, kind='stable')
+        rank = np.empty(nb_nodes, dtype=np.int64)
+        rank[self._order] = np.arange(nb_nodes)
+
+        self._terminals = terminals
+        self._nonterminals = nonterminals
+        self.tails = rank[tails]
+        self.heads = rank[heads]
+        self.tail_offsets = np.concatenate(([0], np.cumsum(arities, dtype=np.int64))).astype(np.int64)
+        self.source_edges = np.array(source_edges, dtype=np.int64)
+        self.inverted = np.array(inverted, dtype=bool)
+        self.depth = depth[self._order]
+        self.level_offsets = np.searchsorted(self.depth, np.arange(self.depth.max(initial=-1) + 2)).astype(np.int64)
+        self.terminal_mask = terminal_mask[self._order]
+        self.root = nb_nodes - 1
+        self.edge_offsets = np.searchsorted(self.heads, np.arange(nb_nodes + 1)).astype(np.int64)
+        self.nodes = LazySequence(nb_nodes, self._make_node)
+        self._node_ids = None
+        self.rules = LazySequence(len(heads), self._make_rule)
+
+    @staticmethod
+    def _invertible(source, head, edge_tails, max_inversion_width, finite, d_str, i_str) -> bool:
+        """Whether a binary source rule also yields an inverted edge (as in make_target_side_itg)"""
+        left, right = edge_tails
+        if left == right:  # avoiding some spurious derivations by blocking invertion of identical spans
+            return False
+        if max_inversion_width is not None and isinstance(source.node(head), Span):
+            _, start, end = source.node(head).obj()
+            if end - start > max_inversion_width:
+                return False
+        if finite:  # no point in flipping two deletions or two insertions
+            left_root = source.node(left).root().obj()
+            if left_root == source.node(right).root().obj() and left_root in (d_str, i_str):
+                return False
+        return True
+
+    def _make_node(self, v):
+        v = int(self._order[v])
+        if v < len(self._terminals):
+            t, y_str = self._terminals[v]
+            return self.source.node(t).translate(y_str)
+        return self.source.node(int(self._nonterminals[v - len(self._terminals)]))
+
+    def _make_rule(self, e) -> Rule:
+        return Rule(self.nodes[int(self.heads[e])], [self.nodes[v] for v in self.edge_tails(e).tolist()])
+
+    def __len__(self):
+        return self.nb_edges()
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __reduce__(self):
+        return BinaryForest, (encode_forest(self).tobytes(),)
+
+    def compile(self) -> CompiledForest:
+        return self
+
+    def get(self, lhs, default=frozenset()):
+        """rules whose LHS is the given symbol"""
+        v = self.node_ids.get(lhs, None)
+        if v is None:
+            return default
+        return [self.rules[e] for e in self.edges(v)]
+
+    def to_cfg(self) -> CFG:
+        """Materializes the forest as a CFG (rules in edge order)"""
+        return CFG(list(self.rules))
@@ -1,6 +1,8 @@
 # this file contains support functions that are specific for CRF model
 from lib.libitg import CFG
-from toposort import toposort
+from lib.formal import InternArena
+from misc.compiled_forest import CompiledForest, compile_forest, compile_edge_weights
+from misc.inside_outside import inside_algorithm
 import numpy as np
 from misc.log import Log
 from misc.utils import read_pickle_objects
@@ -9,88 +11,95 @@ import pickle
 from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
 
 
-def viterbi_decoding(forest: CFG, tsort: list, edge_weights: dict) -> dict:
-    """Returns max I(v) subtree under v potentials and back pointers """
-    I = {}
-    I_a = {}  # back-pointer
-    for node in tsort:
-        if node.is_terminal():
-            I[node] = np.log(1.)
-            continue
-        temp_max = np.float('-inf')
-        temp_arg_max = None
-        # get rules where node appears as head
-        for rule in forest._rules_by_lhs[node]:
-            weight = edge_weights[rule]  # factor in log space
-            inner_sum = weight
-            for rhs_node in rule.rhs:
-                inner_sum += I[rhs_node]
-            if inner_sum > temp_max:
-                temp_max = inner_sum
-                temp_arg_max = rule
-        I[node] = temp_max
-        I_a[node] = temp_arg_max
+def viterbi_decoding(forest: CompiledForest, edge_weights: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Returns max I(v) subtree under v potentials and back pointers (edge ids, -1 for nodes without edges)
+    :param forest: a CompiledForest, or a CFG which is compiled first (node and edge ids are those of compile_forest)
+    :param edge_weights: indexed by edge id, or a dictionary rule -> weight
+    """
+    forest = compile_forest(forest)
+    edge_weights = compile_edge_weights(forest, edge_weights)
+    I = inside_algorithm(forest, edge_weights, reduce_op=np.maximum)
+    # back-pointer: the first edge of each node that attains the max
+    scores = edge_weights + forest.tail_sum(I)
+    candidates = np.where(scores >= I[forest.heads], np.arange(forest.nb_edges()), forest.nb_edges())
+    starts = forest.edge_offsets[:-1]
+    has_edges = starts < forest.edge_offsets[1:]
+    I_a = np.full(forest.nb_nodes(), -1, dtype=np.int64)
+    if forest.nb_edges() > 0:
+        I_a[has_edges] = np.minimum.reduceat(candidates, starts[has_edges])
     return I, I_a
 
 
-def expected_feature_vector(forest: CFG, inside: dict, outside: dict, edge_features) -> dict:
-    """Returns an expected feature vector (here a sparse python dictionary)"""
+def expected_feature_vector(forest: CompiledForest, edge_posteriors: np.ndarray, edge_features) -> dict:
+    """
+    Returns an expected feature vector (a sparse python dictionary) given the posterior of each edge
+    (see inside_outside.edge_posteriors), edge_features maps a rule to its features
+    """
+    forest = compile_forest(forest)
     phi = {}
-    for rule in forest._rules:
-        k = outside[rule._lhs]
-        for rhs_node in rule._rhs:
-            k += inside[rhs_node]
-        features = edge_features(rule)
-        for feature_name, feature_value in features.items():
+    for e, posterior in enumerate(edge_posteriors.tolist()):
+        for feature_name, feature_value in edge_features(forest.rules[e]).items():
             if feature_name not in phi:
                 phi[feature_name] = 0.
-            phi[feature_name] += k * feature_value
+            phi[feature_name] += posterior * feature_value
     return phi
 
 
+def sum_sparse(ids: np.ndarray, values: np.ndarray) -> (np.ndarray, np.ndarray):
+    """Sums the values that share an id, returns (sorted unique ids, sums)"""
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    return unique_ids, np.bincount(inverse.ravel(), weights=values, minlength=len(unique_ids))
+
+
+def sparse_expected_feature_vector(feature_matrix, edge_posteriors: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Returns the expected feature vector X^T p for a CSR feature matrix X (edges x features) as a pair
+    (feature ids, expectations) restricted to the features that fire in the forest.
+    """
+    row_lengths = np.diff(feature_matrix.indptr)
+    return sum_sparse(feature_matrix.indices, feature_matrix.data * np.repeat(edge_posteriors, row_lengths))
+
+
+def block_expected_feature_vector(features, forest, edge_posteriors: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Returns the expected feature vector of a compiled forest as a pair (feature ids, expectations): the sparse
+    part plus B^T p for each dense block B (see Features)
+    """
+    ids, expectations = sparse_expected_feature_vector(features.matrix(forest), edge_posteriors)
+    blocks = features.blocks(forest)
+    if not blocks:
+        return ids, expectations
+    return sum_sparse(np.concatenate([ids] + [block.ids for block in blocks]),
+                      np.concatenate([expectations] + [block.values.T.dot(edge_posteriors[block.rows])
+                                                       for block in blocks]))
+
+
 def top_sort(forest: CFG) -> list:
-    """Returns ordered list of nodes according to topsort order in an acyclic forest"""
-    # the idea is to traverse each rule, by creating a dependency set that is inputted to toposort
-    # we traverse by adding dependency in such a way: X->Y,Z, then X depends on Y, and Z
-    dependencies = {}
-    for rule in forest._rules:
-        lhs = rule.lhs
-        if lhs not in dependencies:
-            dependencies[lhs] = set()
-        for rhs in rule.rhs:
-            dependencies[lhs].add(rhs)
-    # run topological sort
-    temp_res = list(toposort(dependencies))
-    # flatten
-    res = []
-    for a in temp_res:
-        for b in a:
-            res.append(b)
-    return res
-
-
-def traverse_back_pointers(back_pointers, start_node, terminals_decoration_func=lambda x :x):
+    """Returns ordered list of nodes according to topsort order in an acyclic forest (the root comes last)"""
+    return list(compile_forest(forest).nodes)
+
+
+def traverse_back_pointers(forest: CompiledForest, back_pointers: np.ndarray, terminals_decoration_func=lambda x: x):
     """
-    Recursive traversal of a tree by following back-pointers. This logic is used for decoding.
+    Traversal of a tree by following back-pointers from the root (see viterbi_decoding). This logic is used for
+    decoding.
     :param terminals_decoration_func: a function that can be used to decorate terminals, e.g. strip spans
     :return list of terminals in sequential order
     """
+    forest = compile_forest(forest)
     terminals = []
-    rule = back_pointers[start_node]
-    for node in rule._rhs:
-        __traverse(back_pointers, node, terminals, terminals_decoration_func)
+    stack = [forest.root]
+    while stack:
+        v = stack.pop()
+        if forest.terminal_mask[v]:
+            terminals.append(terminals_decoration_func(forest.node(v)))
+            continue
+        # push children right to left so that the leftmost child is visited first
+        stack.extend(reversed(forest.edge_tails(back_pointers[v]).tolist()))
     return terminals
 
 
-def __traverse(back_pointers, start_node, collector, terminals_decoration_func):
-    if start_node.is_terminal():
-        collector.append(terminals_decoration_func(start_node))
-        return
-    rule = back_pointers[start_node]
-    for node in rule._rhs:
-        __traverse(back_pointers, node, collector, terminals_decoration_func)
-
-
 def compute_learning_rate(start_learning_rate, step, decay_rate=1 ):
     """
     computes adaptive learning rate that is based on the number of updates already performed.
@@ -98,10 +107,13 @@ def compute_learning_rate(start_learning_rate, step, decay_rate=1 ):
     return start_learning_rate/(1. + start_learning_rate*decay_rate*step)
 
 
-def evaluate(crf, featurizer, val_data_path, compute_ll=True, translations_output_file_path=None):
+def evaluate(crf, featurizer, val_data_path, compute_ll=True, translations_output_file_path=None,
+             feature_cache=None):
     """
     Performs evaluation via BLEU and log-likelihood
     :param translations_output_file_path: where to write translations in the format < source, translation>
+    :param feature_cache: a FeatureCache of the data (see misc/dataset.py), features are computed once per sentence
+        (for D(x) and the D(x,y) of every reference) and cached there if given
     """
     all_refs = []
     hypotheses = []
@@ -109,32 +121,38 @@ def evaluate(crf, featurizer, val_data_path, compute_ll=True, translations_outpu
     counter = 0.
     if translations_output_file_path:
         translations_output_file = open(translations_output_file_path, 'w')
-    for data in read_pickle_objects(val_data_path):
-        if compute_ll:
-            chinese, references, Dx, Dxys = data
-            for reference, Dxy in zip(references, Dxys):
+    for i, data in enumerate(read_pickle_objects(val_data_path)):
+        # spans and rules created for this sentence are released together after decoding
+        with InternArena():
+            if compute_ll:
+                chinese, references, Dx, Dxys = data
                 # there is no way we can compute log-likelihood if Dxy is empty
-                if len(Dxy._rules) == 0:
-                    continue
+                Dxys = [Dxy for Dxy in Dxys if len(Dxy) > 0]
+            else:
+                chinese, references, Dx = data
+                Dxys = []
+            if feature_cache is not None:
+                crf.features = feature_cache.reference_features(i, Dx, Dxys, chinese)
+            else:
+                crf.features = featurizer.featurize_references(Dx, Dxys, chinese)
+            for Dxy in Dxys:
                 counter += 1
-                crf.features = featurizer.featurize_parse_trees(Dx, Dxy, chinese)
 
                 # compute log-likelihood
                 total_loglikelihood += crf.compute_loglikelihood(source_sentence=chinese, Dxy=Dxy, Dnx=Dx)
-        else:
-            chinese, references, Dx = data
-        crf.features = featurizer.featurize_parse_trees(Dx, None, chinese)
-        viterbi_y = crf.decode_viterbi(source_sentence=chinese, Dnx=Dx)
-        # it's 1 because of /usr/local/lib/python3.6/site-packages/nltk/translate/bleu_score.py", line 544
-        if len(viterbi_y) > 1:
-            cur_refs = [r.split() for r in references]
-            hypotheses.append(viterbi_y)
-            all_refs.append(cur_refs)
-            if translations_output_file_path:
-                # write to the file if a path is provided
-                translations_output_file.write("\t".join([chinese, " ".join(viterbi_y)])+"\n")
+            viterbi_y = crf.decode_viterbi(source_sentence=chinese, Dnx=Dx)
+            # it's 1 because of /usr/local/lib/python3.6/site-packages/nltk/translate/bleu_score.py", line 544
+            if len(viterbi_y) > 1:
+                cur_refs = [r.split() for r in references]
+                hypotheses.append(viterbi_y)
+                all_refs.append(cur_refs)
+                if translations_output_file_path:
+                    # write to the file if a path is provided
+                    translations_output_file.write("\t".join([chinese, " ".join(viterbi_y)])+"\n")
     if translations_output_file_path:
         translations_output_file.close()
+    if feature_cache is not None:
+        feature_cache.finish()
     bleu = corpus_bleu(all_refs, hypotheses, smoothing_function=SmoothingFunction().method7)
     if compute_ll:
         if counter == 0:
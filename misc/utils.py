@@ -35,7 +35,7 @@ def get_immediate_subdirectories(a_dir):
 
 def create_batches(parse_tree_dir, batch_size):
     current_batch = []
-    # parses : (Dx, Dxy, chinese, english)
+    # parses : (Dx, Dxy, chinese, english), streamed from a forest store when parse_tree_dir holds one
     for i, parses in enumerate(load_parse_trees(parse_tree_dir)):
         current_batch.append(parses)
         if len(current_batch) >= batch_size:
@@ -61,6 +61,10 @@ def extend_forest_with_rules_by_rhs(forest: CFG):
     forest._rules_by_rhs = by_rhs
 
 def read_pickle_objects(file_path):
+    """
+    Yields the objects pickled one after the other in a file. Forests pickled as BinaryForest (see parse_data.py)
+    are loaded straight from their encoding, symbols and rules are only interned when they are accessed.
+    """
     f = open(file_path, "rb")
     while True:
         try:
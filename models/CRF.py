@@ -4,73 +4,179 @@ from pickle import UnpicklingError
 import lib.libitg as libitg
 from lib.formal import Span
 from misc.mbr import MBR_decoding
-from misc.inside_outside import inside_algorithm, outside_algorithm
-from misc.support import top_sort, expected_feature_vector, viterbi_decoding, traverse_back_pointers,\
-    compute_learning_rate
+from misc.compiled_forest import compile_forest
+from misc.inside_outside import InsideOutside
+from misc.support import viterbi_decoding, traverse_back_pointers, compute_learning_rate, \
+    block_expected_feature_vector, sum_sparse
+from misc.features import FeatureIndex, Features
 import numpy as np
+import math
+import multiprocessing
+import shutil
+import tempfile
 from misc.utils import sort_hash_by_key
 
 np.random.seed(1)
 
+# Gradient workers are forked once per training run (see CRF.start_workers) and inherit the CRF through this global.
+# They map the parameters from a file the parent keeps up to date, and a task only carries the forests (arrays only)
+# and features of one instance.
+_worker_crf = None
+_worker_parameters = {}  # parameters file -> memory map, in workers
+
+
+def _worker_gradient(task):
+    """Returns the log-likelihood and gradient of an instance (see CRF.compute_batch_gradients)"""
+    parameters_file, nb_features, forests, features = task
+    parameters = _worker_parameters.get(parameters_file, None)
+    if parameters is None:  # the parent moved the parameters to a larger file
+        _worker_parameters.clear()
+        parameters = _worker_parameters[parameters_file] = np.memmap(parameters_file, dtype=float, mode='r')
+    parameters = parameters[:nb_features]
+    inside_outside = tuple(InsideOutside(forest, features.edge_scores(forest, parameters)) for forest in forests)
+    _worker_crf.features = features
+    loglikelihood = _worker_crf.compute_loglikelihood(None, None, None, inside_outside)
+    feature_ids, derivatives = _worker_crf.compute_gradient(None, None, None, inside_outside)
+    return loglikelihood, feature_ids, derivatives
+
 
 class CRF():
 
-    def __init__(self, learning_rate=1e-8, regul_strength=1e-8, decay_rate=1e-2):
-        self.parameters = {}  # initialization is performed as a feature function is observed
+    def __init__(self, learning_rate=1e-8, regul_strength=1e-8, decay_rate=1e-2, feature_index=None, num_workers=1):
+        # parameters are a dense vector indexed by feature ids (see FeatureIndex), it grows as features are observed
+        # and only its first len(self.feature_index) entries are in use
+        self.feature_index = feature_index if feature_index is not None else FeatureIndex()
+        self.parameters = np.zeros(0)
         self.features = None
         self.learning_rate = learning_rate
         self.regul_strength = regul_strength
         self.decay_rate = decay_rate
         self.current_step = 0  # track how many times we've updated our parameters
-        self.params_to_save = ['parameters']
+        self.num_workers = num_workers  # processes used to compute the gradients of a batch
+        self.params_to_save = ['parameters', 'feature_index']
+        # L2 regularization is applied lazily: self._log_decay accumulates log(1 - learning_rate * regul_strength)
+        # over updates, and self._decay_applied stores its value when each parameter was last regularized
+        self._log_decay = 0.
+        self._decay_applied = np.zeros(0)
+        self._nb_initialized = 0
+        # pool of gradient workers and the directory of the parameters file they map (see start_workers)
+        self._pool = None
+        self._shared_dir = None
+        self._parameters_file = None
 
-    def compute_gradient(self, source_sentence, Dxy, Dnx):
-        src_fsa = libitg.make_fsa(source_sentence)
+    def compute_gradient(self, source_sentence, Dxy, Dnx, inside_outside=None):
+        """
+        Computes the gradient of the log-likelihood, i.e. E_Dxy[phi] - E_Dnx[phi].
+        :param inside_outside: (Dxy, Dnx) pair of InsideOutside results, they are computed if not provided
+        :return: (feature ids, derivatives)
+        """
+        # 1. compute expectations (a single fused pass per forest)
+        if inside_outside is None:
+            inside_outside = self.inside_outside_pair(source_sentence, Dxy, Dnx)
+        Dxy_io, Dnx_io = inside_outside
 
-        # 1. compute expectations
-        Dnx_inside, _ = self.compute_inside_values(Dnx, src_fsa)
-        Dxy_inside, _ = self.compute_inside_values(Dxy, src_fsa)
-        Dnx_outside = self.compute_outside_values(Dnx, src_fsa, Dnx_inside)
-        Dxy_outside = self.compute_outside_values(Dxy, src_fsa, Dxy_inside)
-
-        edge_features = lambda rule: self.get_features(rule, src_fsa)
-
-        first_expectation = expected_feature_vector(forest=Dxy, inside=Dxy_inside, outside=Dxy_outside,
-                                                     edge_features=edge_features)
-        second_expectation = expected_feature_vector(forest=Dnx, inside=Dnx_inside, outside=Dnx_outside,
-                                                    edge_features=edge_features)
-        derivatives = {}
-        # 2. update parameters
-        for feature_name in second_expectation.keys():
-            derivative = - second_expectation[feature_name]
-            if feature_name in first_expectation:
-                derivative += first_expectation[feature_name]
-            derivatives[feature_name] = derivative
-        return derivatives
+        # expected feature vectors are X^T p, where p holds the posterior of each edge
+        first_ids, first_expectation = block_expected_feature_vector(self.features, Dxy_io.forest,
+                                                                     Dxy_io.edge_posteriors())
+        second_ids, second_expectation = block_expected_feature_vector(self.features, Dnx_io.forest,
+                                                                       Dnx_io.edge_posteriors())
+        # 2. derivatives as a sparse vector (feature ids, values) over the features that fire in D(x),
+        # features of D(x,y) are a subset of those
+        return sum_sparse(np.concatenate([first_ids, second_ids]),
+                          np.concatenate([first_expectation, -second_expectation]))
 
     def train_batch(self, batch):
         """
         Training on a batch of instances with SGD, notice that we divide gradients by the number of data-points.
-        In addition, we perform regularization.
+        In addition, we perform regularization: it is applied lazily, so that an update costs O(active features).
         :param batch: (Dnx, Dxy, source, target) list
+        :return: log-likelihood of the batch before the update (it comes for free with the gradient computation)
         """
         self.current_step += 1
         learning_rate = compute_learning_rate(self.learning_rate, step=self.current_step, decay_rate=self.decay_rate)
         # print(learning_rate)
-        gradients_acc = {}
         # accumulate gradients
+        loglikelihoods, gradient_ids, gradient_values = zip(*self.compute_batch_gradients(batch))
+        loglikelihood = sum(loglikelihoods)
+        feature_ids, derivatives = sum_sparse(np.concatenate(gradient_ids), np.concatenate(gradient_values))
+
+        # update: w = w + learning_rate * (derivative/len(batch) - regul_strength * w)
+        decay = 1. - learning_rate * self.regul_strength
+        self._grow()
+        self._regularize(feature_ids)
+        if decay > 0.:
+            self.parameters[feature_ids] = decay * self.parameters[feature_ids] + learning_rate * derivatives/len(batch)
+            self._log_decay += math.log(decay)
+            self._decay_applied[feature_ids] = self._log_decay
+        else:  # the decay cannot be tracked in log space, thus we apply it to every parameter right away
+            self._regularize(np.arange(self._nb_initialized))
+            self.parameters[:self._nb_initialized] *= decay
+            self.parameters[feature_ids] += learning_rate * derivatives/len(batch)
+        return loglikelihood/len(batch)
+
+    def compute_instance_gradient(self, Dnx, Dxy, source_sentence, target_sentence):
+        """
+        Returns the log-likelihood of an instance and its gradient as (feature ids, derivatives)
+        """
+        inside_outside = self.inside_outside_pair(source_sentence, Dxy, Dnx)
+        loglikelihood = self.compute_loglikelihood(source_sentence, Dxy, Dnx, inside_outside)
+        feature_ids, derivatives = self.compute_gradient(source_sentence, Dxy, Dnx, inside_outside)
+        return loglikelihood, feature_ids, derivatives
+
+    def compute_batch_gradients(self, batch):
+        """
+        Returns compute_instance_gradient for every instance of a batch. With num_workers > 1 instances are
+        split across a pool of worker processes (see start_workers): the parameters are brought up to date in the
+        file workers map, and each task only carries the compiled forests (arrays only) and features of an instance.
+        """
+        if min(self.num_workers, len(batch)) <= 1 or not self.start_workers():
+            return [self.compute_instance_gradient(*instance) for instance in batch]
+        tasks = []
         for Dnx, Dxy, source_sentence, target_sentence in batch:
-            gradient = self.compute_gradient(source_sentence, Dxy, Dnx)
-            for feature_name, derivative in gradient.items():
-                if feature_name not in gradients_acc:
-                    gradients_acc[feature_name] = 0.
-                gradients_acc[feature_name] += derivative
-
-        # update
-        for feature_name, derivative in gradients_acc.items():
-            current_weight_value = self.get_parameter(feature_name)
-            self.parameters[feature_name] = \
-                current_weight_value + learning_rate * (derivative/len(batch) - self.regul_strength * current_weight_value)
+            features = Features()
+            forests = []
+            for forest in (compile_forest(Dxy), compile_forest(Dnx)):
+                # parameters of new features are initialized here, so that all workers see the same values
+                self.parameter_vector(forest)
+                forests.append(forest.without_symbols())
+                features.add(forests[-1], self.features.matrix(forest), self.features.blocks(forest))
+            tasks.append((forests, features))
+        # the parameters file is only known once every new feature has been initialized
+        return self._pool.map(_worker_gradient, [(self._parameters_file, len(self.feature_index), forests, features)
+                                                 for forests, features in tasks], chunksize=1)
+
+    def start_workers(self) -> bool:
+        """
+        Forks the num_workers processes that compute the gradients of batches, they are kept until stop_workers
+        (call it at the end of training). Parameters are moved to a memory-mapped file that workers read, thus they
+        are never pickled. Returns False if workers cannot be used (num_workers <= 1 or no fork start method).
+        """
+        if self._pool is not None:
+            return True
+        if self.num_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return False
+        global _worker_crf
+        self._grow()
+        self._shared_dir = tempfile.mkdtemp(prefix='crf-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.parameters = self._allocate_parameters(len(self.parameters))
+        _worker_crf = self
+        try:
+            self._pool = multiprocessing.get_context('fork').Pool(self.num_workers)
+        finally:
+            _worker_crf = None
+        return True
+
+    def stop_workers(self):
+        """Terminates the gradient workers (see start_workers), parameters are moved back to memory"""
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self.parameters = np.array(self.parameters)
+        shutil.rmtree(self._shared_dir, ignore_errors=True)
+        self._shared_dir = None
+        self._parameters_file = None
 
     def compute_loglikelihood_batch(self, batch):
         """
@@ -82,51 +188,50 @@ class CRF():
             loglikelihood += self.compute_loglikelihood(source_sentence, Dxy, Dnx)
         return loglikelihood/len(batch)
 
-    def compute_loglikelihood(self, source_sentence, Dxy, Dnx):
-        src_fsa = libitg.make_fsa(source_sentence)
-        a, log_Zxy = self.compute_inside_values(Dxy, src_fsa)
-        _, log_Znx = self.compute_inside_values(Dnx, src_fsa)
-        return log_Zxy - log_Znx
-
-    def weight_function(self, edge, src_fsa, temperature=1.0) -> float:
-        features = self.get_features(edge, src_fsa)
-        dot_product = 0.
-        for feature_name in features.keys():
-            dot_product += features[feature_name] * self.get_parameter(feature_name) * temperature
-        return dot_product
+    def compute_loglikelihood(self, source_sentence, Dxy, Dnx, inside_outside=None):
+        """
+        :param inside_outside: (Dxy, Dnx) pair of InsideOutside results computed with the current parameters,
+            e.g. those used for the gradient, if not provided we only run the inside algorithm
+        """
+        if inside_outside is None:
+            src_fsa = libitg.make_fsa(source_sentence)
+            inside_outside = (self.inside_outside(Dxy, src_fsa, compute_outside=False),
+                              self.inside_outside(Dnx, src_fsa, compute_outside=False))
+        Dxy_io, Dnx_io = inside_outside
+        return Dxy_io.log_normalizer - Dnx_io.log_normalizer
 
-    def compute_inside_values(self, grammar, src_fsa):
+    def compute_edge_weights(self, forest, src_fsa, temperature=1.0) -> np.ndarray:
         """
-        Wrapper function that computes inside values, returns both inside values and log normalizer
+        Scores every edge of a compiled forest (indexed by edge id) with one sparse mat-vec X theta and a dense
+        mat-vec per block of dense features
         """
-        sorted_nodes, edge_weights = self.__sort_nodes_and_compute_weights(grammar, src_fsa)
-        root_node = sorted_nodes[-1]
-        inside_values = inside_algorithm(grammar, sorted_nodes, edge_weights=edge_weights)
-        return inside_values, inside_values[root_node]
+        return self.features.edge_scores(forest, self.parameter_vector(forest)) * temperature
 
-    def compute_outside_values(self, grammar, src_fsa, inside_values):
+    def inside_outside(self, grammar, src_fsa, compute_outside=True) -> InsideOutside:
         """
-        Wrapper function that computes outside values
+        Fused inference over a forest: it is sorted once (see compile_forest), its edges are scored once,
+        and the resulting inside, outside values and edge posteriors are shared via an InsideOutside object.
         """
-        # TODO: make a separate function that computes both inside and outside to avoid sorting and computing
-        # TODO: edge values multiple times.
-        sorted_nodes, edge_weights = self.__sort_nodes_and_compute_weights(grammar, src_fsa)
-        return outside_algorithm(grammar, sorted_nodes, edge_weights, inside_values)
+        forest = compile_forest(grammar)
+        return InsideOutside(forest, self.compute_edge_weights(forest, src_fsa), compute_outside=compute_outside)
 
-    def __sort_nodes_and_compute_weights(self, grammar, src_fsa, temperature=1.0):
+    def inside_outside_pair(self, source_sentence, Dxy, Dnx):
         """
-        This logic is preliminary to inside and outside computations (also Viterbi decoding)
+        Returns the (Dxy, Dnx) pair of InsideOutside results used by both the gradient and the log-likelihood
         """
-        sorted_nodes = top_sort(grammar)
-        edge_weights = {rule: self.weight_function(rule, src_fsa, temperature) for rule in grammar._rules}
-        return sorted_nodes, edge_weights
+        src_fsa = libitg.make_fsa(source_sentence)
+        return self.inside_outside(Dxy, src_fsa), self.inside_outside(Dnx, src_fsa)
 
     def decode_mbr(self, source_sentence, Dnx, num_samples, temperature):
+        """
+        Minimum Bayes Risk decoding over num_samples derivations sampled from D(x)
+        :param temperature: edge scores are multiplied by it, values below 1 flatten the sampling distribution
+        """
         src_fsa = libitg.make_fsa(source_sentence)
-        sorted_nodes, edge_weights = self.__sort_nodes_and_compute_weights(Dnx, src_fsa, temperature=1.0)
-        root_node = sorted_nodes[-1]
-        I, _ = self.compute_inside_values(Dnx, src_fsa)
-        return MBR_decoding(Dnx, root_node, I, num_samples)
+        forest = compile_forest(Dnx)
+        result = InsideOutside(forest, self.compute_edge_weights(forest, src_fsa, temperature=temperature),
+                               compute_outside=False)
+        return MBR_decoding(forest, result.edge_weights, result.inside, num_samples)
 
     def decode_viterbi(self, source_sentence, Dnx, excluded_terminals=['-EPS-']):
         """
@@ -134,29 +239,74 @@ class CRF():
         :return: :rtype: list of terminals in order
         """
         src_fsa = libitg.make_fsa(source_sentence)
-        sorted_nodes, edge_weights = self.__sort_nodes_and_compute_weights(Dnx, src_fsa)
-        root_node = sorted_nodes[-1]
-        _, back_pointers = viterbi_decoding(Dnx, sorted_nodes, edge_weights)
+        forest = compile_forest(Dnx)
+        edge_weights = self.compute_edge_weights(forest, src_fsa)
+        _, back_pointers = viterbi_decoding(forest, edge_weights)
 
-        # create a decoration function, and traverse back pointers recursively
+        # create a decoration function, and traverse back pointers
         terminals_decoration_func = lambda x: x._symbol._symbol
-        terminals = traverse_back_pointers(back_pointers, root_node, terminals_decoration_func)
+        terminals = traverse_back_pointers(forest, back_pointers, terminals_decoration_func)
         # do cleaning by excluding unwanted terminals
         terminals = [t for t in terminals if t not in excluded_terminals]
 
         return terminals
 
-    def get_features(self, edge, src_fsa):
-        return self.features.get(edge)
-
     def get_parameter(self, feature_name):
         """
         Returns a parameter that corresponds to the feature_name. If parameter has not be initialized previously, it will
         initialize it.
         """
-        if feature_name not in self.parameters:
-            self.parameters[feature_name] = np.random.normal(0, 1.)
-        return self.parameters[feature_name]
+        feature_id = self.feature_index.get_id(feature_name)
+        self._grow()
+        self._regularize([feature_id])
+        return self.parameters[feature_id]
+
+    def parameter_vector(self, forest) -> np.ndarray:
+        """
+        Returns the parameters as a dense vector indexed by feature ids, only the parameters of features that fire
+        in the compiled forest are brought up to date.
+        """
+        assert self.features.index is self.feature_index, 'Features must be indexed by the CRF feature index'
+        self._grow()
+        self._regularize(self.features.feature_ids(forest))
+        return self.parameters[:len(self.feature_index)]
+
+    def _grow(self):
+        """Initializes the parameters of features that have been added to the index since the last call"""
+        nb_features = len(self.feature_index)
+        capacity = len(self.parameters)
+        if nb_features > capacity:
+            capacity = max(nb_features, 2 * capacity)
+            self.parameters = self._allocate_parameters(capacity)
+            self._decay_applied = np.concatenate([self._decay_applied,
+                                                  np.zeros(capacity - len(self._decay_applied))])
+        # new features are initialized with a standard normal and have no pending regularization
+        if nb_features > self._nb_initialized:
+            self.parameters[self._nb_initialized:nb_features] = \
+                np.random.normal(0, 1., size=nb_features - self._nb_initialized)
+            self._decay_applied[self._nb_initialized:nb_features] = self._log_decay
+            self._nb_initialized = nb_features
+
+    def _allocate_parameters(self, capacity) -> np.ndarray:
+        """
+        Returns a vector of the given capacity that starts with the current parameters (zeros after them), while
+        workers are running it is a new file they can map (see start_workers)
+        """
+        if self._shared_dir is None:
+            parameters = np.zeros(capacity)
+        else:
+            old_file = self._parameters_file
+            self._parameters_file = os.path.join(self._shared_dir, 'parameters%d' % capacity)
+            parameters = np.memmap(self._parameters_file, dtype=float, mode='w+', shape=(max(capacity, 1),))
+            if old_file is not None and old_file != self._parameters_file:
+                os.remove(old_file)  # workers that map it keep their mapping until they switch to the new file
+        parameters[:len(self.parameters)] = self.parameters
+        return parameters
+
+    def _regularize(self, feature_ids):
+        """Applies the regularization that is pending for some parameters"""
+        self.parameters[feature_ids] *= np.exp(self._log_decay - self._decay_applied[feature_ids])
+        self._decay_applied[feature_ids] = self._log_decay
 
     def save_parameters(self, output_dir, name='params.pkl'):
         """
@@ -164,6 +314,10 @@ class CRF():
         has to have self.params_to_save list of params name that is desired to save, e.g. ["theta", "gamma"]
         """
         print('writing parameters to %s folder' % output_dir)
+        self._grow()
+        self._regularize(np.arange(len(self.feature_index)))
+        self.parameters = self.parameters[:len(self.feature_index)]
+        self._decay_applied = self._decay_applied[:len(self.feature_index)]
         f = open(os.path.join(output_dir, name), 'wb')
         for param_name in self.params_to_save:
             pickle.dump([param_name, getattr(self, param_name)], f)
@@ -173,8 +327,10 @@ class CRF():
     def load_parameters(self, file_path):
         """
         Loads params from pickle saved file and assigns to attributes.
-        The function will work for the saving made by save_parameters only
+        The function will work for the saving made by save_parameters only. Files saved before parameters were a
+        dense vector (a dict feature name -> value, without feature_index) are converted.
         """
+        self.stop_workers()  # they map the current parameters, they are started again by the next batch
         f = open(file_path, 'rb')
         print('loading parameters')
         while True:
@@ -184,4 +340,19 @@ class CRF():
             except (EOFError, UnpicklingError):
                 break
         f.close()
+        # saved parameters are up to date with respect to regularization
+        self._log_decay = 0.
+        if isinstance(self.parameters, dict):
+            # old format: features are registered in the index, those that are not in the file are initialized
+            named_parameters = self.parameters
+            feature_ids = [self.feature_index.get_id(name) for name in named_parameters]
+            self.parameters = np.zeros(0)
+            self._decay_applied = np.zeros(0)
+            self._nb_initialized = 0
+            self._grow()
+            self.parameters[feature_ids] = list(named_parameters.values())
+            print('done')
+            return
+        self._decay_applied = np.zeros(len(self.parameters))
+        self._nb_initialized = len(self.parameters)
         print('done')
@@ -1,21 +1,24 @@
 from misc.helper import load_lexicon, load_dev_data
+from misc.binary_forest import encode_forest
 import pickle
 
 lexicon = load_lexicon("data/sorted_ibm1_translations.txt", top_n=50)
+# D(x) is a lazy projection (ProjectedForest), its translation edges are not materialized as a CFG
 data_path = "data/raw/dev1.zh-en"
 
 print(data_path)
 
 output_file = open('data/val/parses_max_5_top_50.pkl', 'wb')
-for i, (chinese, references, Dx, Dxys) in enumerate(load_dev_data(data_path, lexicon, return_Dxy=True, max_Dxy=5)):
+for i, (chinese, references, Dx, Dxys) in enumerate(load_dev_data(data_path, lexicon, return_Dxy=True, max_Dxy=5, lazy=True)):
     print(i)
-    pickle.dump([chinese, references, Dx, Dxys], output_file, pickle.HIGHEST_PROTOCOL)
+    # forests are stored in their binary encoding, thus loading them does not intern any symbol
+    pickle.dump([chinese, references, encode_forest(Dx), [encode_forest(Dxy) for Dxy in Dxys]], output_file, pickle.HIGHEST_PROTOCOL)
 output_file.close()
 
 
 
 # output_file = open('data/test/parses_top_50.pkl', 'wb')
-# for i, (chinese, references, Dx) in enumerate(load_dev_data(data_path, lexicon)):
+# for i, (chinese, references, Dx) in enumerate(load_dev_data(data_path, lexicon, lazy=True)):
 #     print(i)
-#     pickle.dump([chinese, references, Dx], output_file, pickle.HIGHEST_PROTOCOL)
+#     pickle.dump([chinese, references, encode_forest(Dx)], output_file, pickle.HIGHEST_PROTOCOL)
 # output_file.close()
\ No newline at end of file
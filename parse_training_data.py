@@ -1,86 +1,106 @@
 import dill as pickle
-import sys, os
-import lib.libitg as libitg
-from lib.libitg import Symbol, Terminal, Nonterminal, Span
-from lib.libitg import Rule, CFG
-from lib.libitg import FSA
-from misc.helper import load_lexicon, scan_line, log_info
+import sys, os, time
+import itertools
+import multiprocessing
+from misc.helper import load_lexicon, scan_line, log_info, parse_training_instance, FOREST_STORE
+from misc.forest_store import ForestStoreWriter
+from misc.binary_forest import encode_forest
 
 if len(sys.argv) < 4:
-    print("Use: python parse_training_data.py <training_data> <lexicon> <output_dir>")
+    print("Use: python parse_training_data.py <training_data> <lexicon> <output_dir> [num_workers]")
     sys.exit()
 
 # Data files.
 training_data = sys.argv[1]
 lexicon = sys.argv[2]
 output_dir = sys.argv[3]
-dx_dir = "Dx"
-dxy_dir = "Dxy"
+num_workers = multiprocessing.cpu_count() if len(sys.argv) < 5 else int(sys.argv[4])
 
 # Hyperparameters.
 max_length = 10
 top_n = 5
-log_info("Hyperparams: max_length=%s, top_n=%s" % (max_length, top_n))
+parser = "cky"  # source parser, "cky", "earley" and "earley-plain" yield the same D(x) (see benchmark_parsers.py)
+log_info("Hyperparams: max_length=%s, top_n=%s, parser=%s" % (max_length, top_n, parser))
 
 log_info("Loading lexicon...")
 lexicon = load_lexicon(lexicon, top_n=top_n)
 
-log_info("Creating output folders if necessary...")
-dxy_path = os.path.join(output_dir, dxy_dir)
-dx_path = os.path.join(output_dir, dx_dir)
-english_file = os.path.join(output_dir, "english")
-chinese_file = os.path.join(output_dir, "chinese")
+log_info("Creating output folder if necessary...")
+if not os.path.exists(output_dir):
+    log_info("Creating %s" % output_dir)
+    os.makedirs(output_dir)
 
-if not os.path.exists(dx_path):
-    log_info("Creating %s" % dx_path)
-    os.makedirs(dx_path)
+# All (Dx, Dxy, chinese, english) records go to a single indexed store (see misc/forest_store.py), in input order.
+# The progress file holds the number of input lines consumed and of records written, it is updated after each line.
+store_file = os.path.join(output_dir, FOREST_STORE)
+progress_file = os.path.join(output_dir, "progress")
 
-if not os.path.exists(dxy_path):
-    log_info("Creating %s" % dxy_path)
-    os.makedirs(dxy_path)
 
-total = 0
-covered = 0
-with open(training_data) as f, open(english_file, "w+") as en_file, open(chinese_file, "w+") as ch_file:
-    for line in f:
-        total += 1
-        chinese, english = scan_line(line)
-
-        # Skip training sentences longer than some max_length if max_length is set.
-        if max_length is not None and len(chinese) > max_length:
-            continue
+def parse_line(line):
+    """
+    Parses a line of the training data (this runs in a worker process).
+    Returns the pickled record (Dx, Dxy, chinese, english) or None if the sentence is skipped.
+    """
+    chinese, english = scan_line(line)
 
-        sub_lexicon = {k:lexicon[k] for k in chinese.split() + ["-EPS-"] if k in lexicon}
-        src_cfg = libitg.make_source_side_finite_itg(sub_lexicon)
+    # Skip training sentences longer than some max_length if max_length is set.
+    if max_length is not None and len(chinese) > max_length:
+        return None
 
-        # Create an FSA for the source sentence and parse the source sentence.
-        src_fsa = libitg.make_fsa(chinese)
-        _Dx = libitg.earley(src_cfg, src_fsa, start_symbol=Nonterminal('S'), \
-                sprime_symbol=Nonterminal("D(x)"), clean=True)
-        Dx = libitg.make_target_side_itg(_Dx, lexicon)
+    Dx, Dxy = parse_training_instance(chinese, english, lexicon, parser)
 
-        # Create a target FSA and D_i(x, y)
-        tgt_fsa = libitg.make_fsa(english)
-        Dxy = libitg.earley(Dx, tgt_fsa, start_symbol=Nonterminal("D(x)"), \
-                sprime_symbol=Nonterminal('D(x,y)'), clean=True)
+    # Continue in the case the parse for this training sentence is empty.
+    if len(Dx) == 0 or len(Dxy) == 0:
+        return None
 
-        # Continue in the case the parse for this training sentence is empty.
-        if len(Dx) == 0 or len(Dxy) == 0:
-            continue
+    # Workers also take care of serialization, the main process only writes to disk.
+    # Forests are stored in their binary encoding, thus loading them does not intern any symbol.
+    return pickle.dumps((encode_forest(Dx), encode_forest(Dxy), chinese, english), protocol=pickle.HIGHEST_PROTOCOL)
 
-        # Store Dix.
-        with open(os.path.join(dx_path, str(covered)), "wb") as f:
-            pickle.dump(Dx, f)
 
-        # # Store Dixy.
-        with open(os.path.join(dxy_path, str(covered)), "wb") as f:
-            pickle.dump(Dxy, f)
+def write_progress(total, covered):
+    """Records how many input lines have been processed and how many trees extracted (atomically)"""
+    with open(progress_file + ".tmp", "w") as f:
+        f.write("%d %d\n" % (total, covered))
+    os.replace(progress_file + ".tmp", progress_file)
 
-        # Store the english and chinese sentence.
-        en_file.write("%s\n" % english)
-        ch_file.write("%s\n" % chinese)
 
-        covered += 1
-        log_info("%d/%d trees extracted." % (covered, total))
+# Resume from the last finished sentence if a previous run was interrupted: the consumed input lines are skipped and
+# the store is cut back to the recorded number of records (a progress file without a store is ignored).
+total = 0
+covered = 0
+resume = os.path.exists(progress_file)
+if resume and not os.path.exists(store_file):
+    log_info("Ignoring %s: there is no store to resume, starting from the first sentence." % progress_file)
+    resume = False
+if resume:
+    with open(progress_file) as f:
+        total, covered = [int(x) for x in f.read().split()]
+    log_info("Resuming after %d sentences (%d trees extracted)." % (total, covered))
+# Records written after the last progress update are dropped and parsed again.
+writer = ForestStoreWriter(store_file, keep_records=covered if resume else None)
+
+log_info("Parsing with %d workers..." % num_workers)
+pool = multiprocessing.get_context("fork").Pool(num_workers) if num_workers > 1 else None
+start = time.time()
+parsed = 0
+with open(training_data) as f, writer:
+    lines = itertools.islice(f, total, None)
+
+    # imap returns results in the order of the input, thus the output is deterministic.
+    results = pool.imap(parse_line, lines) if pool is not None else map(parse_line, lines)
+    for result in results:
+        total += 1
+        parsed += 1
+        if result is not None:
+            writer.append_bytes(result)
+            writer.flush()
+            covered += 1
+            log_info("%d/%d trees extracted (%.2f sentences/s)." % (covered, total, parsed / (time.time() - start)))
+        write_progress(total, covered)
+
+if pool is not None:
+    pool.close()
+    pool.join()
 
 print("Training instances covered: %d/%d" % (covered, total))
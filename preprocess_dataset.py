@@ -0,0 +1,37 @@
+import os, sys
+from misc.helper import load_ibm1_probs, log_info, load_parse_trees
+from misc.featurizer import Featurizer
+from misc.embeddings import WordEmbeddings
+from misc.dataset import write_dataset
+
+# Arguments.
+if len(sys.argv) < 5:
+    print("Use: python preprocess_dataset.py <parse_tree_dir> <ibm1_probs> <embeddings_dir> <output_dir>")
+    sys.exit()
+
+# Data files.
+parse_tree_dir = sys.argv[1]
+ibm1_probs_file = sys.argv[2]
+
+embeddings_dir = sys.argv[3]
+word_embeddings_file_ch = os.path.join(embeddings_dir, "zh.pkl")
+word_embeddings_file_en = os.path.join(embeddings_dir, "en.pkl")
+word_clusters_file_ch = os.path.join(embeddings_dir, "clusters.zh")
+word_clusters_file_en = os.path.join(embeddings_dir, "clusters.en")
+
+output_dir = sys.argv[4]
+
+# Load the IBM 1 probabilities.
+log_info("Loading IBM 1 probs...")
+ibm1_probs = load_ibm1_probs(ibm1_probs_file)
+
+# Load the word embeddings.
+log_info("Loading word embeddings...")
+embeddings_ch = WordEmbeddings(word_embeddings_file_ch, word_clusters_file_ch)
+embeddings_en = WordEmbeddings(word_embeddings_file_en, word_clusters_file_en)
+
+# Featurize every training instance once, training then memory-maps the result (see MappedDataset).
+featurizer = Featurizer(ibm1_probs, embeddings_ch, embeddings_en)
+log_info("Writing dataset to %s..." % output_dir)
+nb_instances = write_dataset(output_dir, load_parse_trees(parse_tree_dir), featurizer)
+log_info("%d instances, %d features." % (nb_instances, len(featurizer.feature_index)))
@@ -1,11 +1,14 @@
 # this file contains an example how to run the model
 import os
+import multiprocessing
 from models.CRF import CRF
 from misc.helper import load_ibm1_probs
-from misc.utils import extend_forest_with_rules_by_rhs, create_batches, get_run_var
+from misc.utils import create_batches, get_run_var
 from misc.featurizer import Featurizer
+from misc.dataset import MappedDataset, FeatureCache
 from misc.embeddings import WordEmbeddings
 from misc.log import Log
+from lib.formal import InternArena
 from misc.support import evaluate
 import time
 
@@ -16,9 +19,11 @@ epochs = 5
 batch_size = 50
 decay_rate = 100.
 load_params = False
+num_workers = multiprocessing.cpu_count()  # processes used to compute the gradients of a batch (forked once)
 
 # paths
 parse_tree_dir = "data/train_top25/"  # format:[ source, target, Dx, Dxy, Dnx]
+dataset_dir = "data/train_top25_dataset/"  # written by preprocess_dataset.py, parse_tree_dir is used if missing
 ibm1_probs_file_path = "data/lexicon"
 embeddings_dir = "data/embeddings/"
 word_embeddings_ch_file_path = os.path.join(embeddings_dir, "zh.pkl")
@@ -30,6 +35,7 @@ output_folder_path = os.path.join(output_folder_path, str(get_run_var(output_fol
 val_data_path = "data/val/parses_max_5_top_25.pkl"
 test_data_path = "data/test/parses_top_25.pkl"
 translations_file_path = os.path.join(output_folder_path, "translations.txt")
+feature_cache_dir = "data/feature_cache/"  # features of parse_tree_dir and of the validation set, kept across runs
 params_file_path = "output/21/params.pkl"
 
 
@@ -43,47 +49,70 @@ log = Log(output_folder_path)
 # write experimental setup
 log.write("EXPERIMENTAL SETUP: ")
 log.write("parse_tree_dir: %s" % parse_tree_dir)
+log.write("dataset_dir: %s (exists: %r)" % (dataset_dir, os.path.exists(dataset_dir)))
 log.write("lexicon_file_path: %s" % ibm1_probs_file_path)
 log.write("learning rate: %f" % learning_rate)
 log.write("regul. strength: %f" % regul_strength)
 log.write("batch size: %d" % batch_size)
 log.write("decay rate: %f" % decay_rate)
 log.write("load params? : %r" % load_params)
+log.write("num. workers: %d" % num_workers)
 log.write("-------------------------------")
 
 
-featurizer = Featurizer(ibm1_probs, embeddings_ch, embeddings_en)
-crf = CRF(learning_rate=learning_rate, regul_strength=regul_strength, decay_rate=decay_rate)
+crf = CRF(learning_rate=learning_rate, regul_strength=regul_strength, decay_rate=decay_rate,
+          num_workers=num_workers)
 # load params if set
 if load_params:
     crf.load_parameters(params_file_path)
+featurizer = Featurizer(ibm1_probs, embeddings_ch, embeddings_en, feature_index=crf.feature_index)
+# a preprocessed dataset is memory-mapped and its features are not computed again every epoch
+dataset = MappedDataset(dataset_dir, crf.feature_index) if os.path.exists(dataset_dir) else None
+# otherwise features are computed during the first epoch and read from a cache afterwards, the caches are computed
+# again when the featurizer settings or the files features depend on change
+feature_inputs = [ibm1_probs_file_path, word_embeddings_ch_file_path, word_embeddings_en_file_path,
+                  word_clusters_ch_file_path, word_clusters_en_file_path]
+train_cache = None if dataset is not None else \
+    FeatureCache(os.path.join(feature_cache_dir, "train"), featurizer, [parse_tree_dir] + feature_inputs)
+val_cache = FeatureCache(os.path.join(feature_cache_dir, "val"), featurizer, [val_data_path] + feature_inputs)
+log.write("feature cache: %s (training set cached: %r, validation set cached: %r)" %
+          (feature_cache_dir, train_cache is not None and train_cache.is_complete(), val_cache.is_complete()))
 
 for epoch in range(1, epochs+1):
     start = time.time()
     log.write("epoch %d" % epoch)
-    for j, batch in enumerate(create_batches(parse_tree_dir, batch_size=batch_size)):
-
-        for Dx, Dxy, chinese, english in batch:
-            # add extra attribute that use in outside computations
-            # TODO: move it to some better place
-            extend_forest_with_rules_by_rhs(Dx)
-            extend_forest_with_rules_by_rhs(Dxy)
-
-        # load features ( TODO: make a simple function call in the class itself )
-        crf.features = featurizer.featurize_parse_trees_batch(batch)
-        crf.train_batch(batch=batch)
-
-
-        ll_after = crf.compute_loglikelihood_batch(batch=batch)
-        log.write("batch's #%d log-likelihood is: %f" % (j+1, ll_after))
-
-    val_bleu, val_loglikelihood = evaluate(crf, featurizer, val_data_path)
+    if dataset is not None:
+        batches = dataset.batches(batch_size)
+    else:
+        batches = ((batch, None) for batch in create_batches(parse_tree_dir, batch_size=batch_size))
+    first = 0  # position of the batch in the training set
+    for j, (batch, features) in enumerate(batches):
+        # spans and rules created for this batch are released together at the end of it
+        with InternArena() as arena:
+            # load features
+            if features is None:
+                features = train_cache.batch_features(first, batch)
+            first += len(batch)
+            crf.features = features
+            crf.train_batch(batch=batch)
+
+
+            ll_after = crf.compute_loglikelihood_batch(batch=batch)
+            log.write("batch's #%d log-likelihood is: %f (%d interned objects)" % (j+1, ll_after, len(arena)))
+
+    if train_cache is not None:
+        train_cache.finish()
+
+    val_bleu, val_loglikelihood = evaluate(crf, featurizer, val_data_path, feature_cache=val_cache)
     log.write("validation BLEU is: %f" % val_bleu)
     log.write("validation log-likelihood is: %f" % (val_loglikelihood))
 
     end = time.time()
     log.write("epoch completed in %f minutes " % ((end - start)/60.0))
 
+# the gradient workers are kept for the whole training run
+crf.stop_workers()
+
 
 # Finally evaluate on test set
 test_bleu = evaluate(crf, featurizer, test_data_path, compute_ll=False, translations_output_file_path=translations_file_path)
@@ -7,7 +7,7 @@ from lib.libitg import FSA
 from misc.helper import load_ibm1_probs, log_info, load_parse_trees, load_dev_data, load_lexicon
 from misc.featurizer import Featurizer
 from misc.embeddings import WordEmbeddings
-from misc.utils import create_batches, extend_forest_with_rules_by_rhs
+from misc.utils import create_batches
 from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
 from models.CRF import CRF
 
@@ -45,8 +45,8 @@ embeddings_ch = WordEmbeddings(word_embeddings_file_ch, word_clusters_file_ch)
 embeddings_en = WordEmbeddings(word_embeddings_file_en, word_clusters_file_en)
 
 # Create the featurizer and the CRF.
-featurizer = Featurizer(ibm1_probs, embeddings_ch, embeddings_en)
 crf = CRF(learning_rate=learning_rate)
+featurizer = Featurizer(ibm1_probs, embeddings_ch, embeddings_en, feature_index=crf.feature_index)
 
 # Start training.
 log_info("Starting training.")
@@ -57,21 +57,14 @@ for epoch in range(1, num_epochs + 1):
     for batch_num, batch in enumerate(create_batches(parse_tree_dir, batch_size=batch_size)):
         log_info("Batch %d" % batch_num)
 
-        for Dx, Dxy, chinese, english in batch:
-            extend_forest_with_rules_by_rhs(Dx)
-            extend_forest_with_rules_by_rhs(Dxy)
-
         # Compute features for this training instance.
         features = featurizer.featurize_parse_trees_batch(batch)
         crf.features = features
 
-        # Compute the log-likelihood before the batch.
-        ll_before = crf.compute_loglikelihood_batch(batch=batch)
+        # Train on the batch, this also gives us the log-likelihood before the update.
+        ll_before = crf.train_batch(batch=batch)
         log_info("Log-likelihood before = %f" % ll_before)
 
-        # Train on the batch.
-        crf.train_batch(batch=batch)
-
         # Report the new log-likelihood on this batch.
         ll_after = crf.compute_loglikelihood_batch(batch=batch)
         log_info("Log-likelihood after = %f" % ll_after)